@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the decode and publish hot paths of jkbms_ble.py
+
+Reports frames per second and microseconds per frame for every stage, from
+the checksum to the complete path fragment -> reassembly -> decode ->
+publish (into the in-process mqtt sink of jkbms_sim.py). The results are
+written to a json file; with --baseline a previous result file is compared
+and the script exits with 1 if a case got slower than the tolerance.
+
+    python3 benchmark.py --output bench.json
+    python3 benchmark.py --baseline bench.json --tolerance 20
+    python3 benchmark.py --budget --budget-cpu 25
+    python3 benchmark.py --packs 8
+
+--packs runs the complete pipeline (threads, reassembly, decode, publish)
+with 1, 2, 4 ... simulated streaming packs and reports the cpu time per
+record and pack and the memory of the process. Run it on the target, the
+numbers of an x86 box do not say much about a Pi.
+-------------------------------------------------------------------------
+"""
+
+import sys
+import time
+import json
+import struct
+import random
+import logging
+import platform
+import argparse
+import resource
+import threading
+
+import jkbms_ble
+import jkbms_sim
+import jkbms_capture
+import jkbms_queue
+
+
+# ---
+# time a function, returns the best time per call in seconds
+# ---
+def measure(func, frames, minTime=0.2, repeat=5):
+    count = len(frames)
+    # find the number of rounds that takes at least minTime
+    rounds = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for frame in frames:
+                func(frame)
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime:
+            break
+        rounds *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for frame in frames:
+                func(frame)
+        best = min(best, time.perf_counter() - start)
+    return best / (rounds * count)
+
+
+# ---
+# test frames
+# ---
+def cellDataFrames(count, length=300):
+    pack = jkbms_sim.PackModel(seed=1)
+    return [pack.cellDataRecord(length) for _ in range(count)]
+
+
+def cellData04Frames(count):
+    # legacy 4 byte format: 24 cell voltages and 25 resistances as 4 byte values
+    rnd = random.Random(1)
+    frames = []
+    for i in range(count):
+        values = [rnd.uniform(3.1, 3.5) for _ in range(jkbms_ble.CELL_COUNT)]
+        values += [rnd.uniform(0.05, 0.2) for _ in range(jkbms_ble.RESISTANCE_COUNT)]
+        frames.append(jkbms_sim.buildRecord(jkbms_ble.CELL_DATA, struct.pack('<49f', *values), i))
+    return frames
+
+
+def infoFrames(count):
+    return [jkbms_sim.buildInfoRecord(uptime=86400 + i, counter=i) for i in range(count)]
+
+
+def readFrames(filename):
+    # recorded frames, one record as hex string per line
+    with open(filename) as f:
+        return [bytes.fromhex(line.strip()) for line in f if line.strip()]
+
+
+def fragments(frames, size=20):
+    return [[frame[i:i + size] for i in range(0, len(frame), size)] for frame in frames]
+
+
+# ---
+# the benchmark cases, each returns (name, function, frames)
+# ---
+def createDelegate(format='mqtt', refresh=0, queue=None):
+    bms = jkbms_ble.jkbms(name='bench', model='bench', mac='00:00:00:00:00:00', command='command', tag='BENCH',
+                          format=format, refreshInterval=refresh, transport=jkbms_sim.SimulatedTransport, queue=queue)
+    delegate = jkbms_ble.BLEDelegate(bms)
+    bms.delegate = delegate
+    return delegate
+
+
+def captureCase(filename):
+    # every notification of a capture through the delegate of its device
+    delegates = {}
+    def handle(fragment):
+        mac, data = fragment
+        delegate = delegates.get(mac)
+        if delegate is None:
+            delegate = delegates[mac] = createDelegate()
+        delegate.handleNotification(0x10, data)
+    fragments = [(mac, data) for _, mac, data in jkbms_capture.readCapture(filename)]
+    return ('capture_notifications', handle, fragments)
+
+
+def benchmarkCases(cellFrames, cell320Frames):
+    cases = []
+    cases.append(('crc8_300', lambda frame: jkbms_ble.crc8(frame[:-1]), cellFrames))
+    cases.append(('crc8_320', lambda frame: jkbms_ble.crc8(frame[:-1]), cell320Frames))
+
+    reassembler = jkbms_ble.FrameReassembler()
+    def reassemble(frameFragments):
+        for fragment in frameFragments:
+            for record in reassembler.feed(fragment):
+                pass
+    cases.append(('reassembly', reassemble, fragments(cellFrames)))
+
+    cases.append(('decodeCellDataRecord02', jkbms_ble.decodeCellDataRecord02, cellFrames))
+    for format in ('mqtt', 'json', 'binary'):
+        delegate = createDelegate(format)
+        cases.append(('processCellDataRecord02_' + format, lambda frame, d=delegate: d.processCellDataRecord02(bytearray(frame)), cellFrames))
+
+    delegate = createDelegate()
+    cases.append(('decodeCellDataRecord04', jkbms_ble.decodeCellDataRecord04, cellData04Frames(len(cellFrames))))
+    cases.append(('processCellDataRecord04', lambda frame: delegate.processCellDataRecord04(bytearray(frame)), cellData04Frames(len(cellFrames))))
+    hexValues = [bytes(frame[6 + 4 * i:10 + 4 * i]) for frame in cellData04Frames(4) for i in range(49)]
+    cases.append(('decodeHex', jkbms_ble.decodeHex, hexValues))
+    cases.append(('processInfoRecord', lambda frame: delegate.processInfoRecord(bytearray(frame)), infoFrames(len(cellFrames))))
+
+    for format in ('mqtt', 'json'):
+        for refresh in (0, 300):
+            delegate = createDelegate(format, refresh)
+            def handle(frameFragments, d=delegate):
+                for fragment in frameFragments:
+                    d.handleNotification(0x10, fragment)
+            cases.append(('handleNotification_{}_refresh{}'.format(format, refresh), handle, fragments(cellFrames)))
+
+    # the callback with the publisher queue: reassembly and put, the queue is not drained (coalesce)
+    delegate = createDelegate(queue=jkbms_queue.RecordQueue())
+    def handleQueued(frameFragments):
+        for fragment in frameFragments:
+            delegate.handleNotification(0x10, fragment)
+    cases.append(('handleNotification_queued', handleQueued, fragments(cellFrames)))
+    return cases
+
+
+# ---
+# cost per pack: the complete pipeline with 1, 2, 4 ... simulated streaming packs
+# ---
+def packCost(maxPacks, seconds):
+    '''
+    Returns a list of (packs, cell data records, cpu seconds, max. rss in kB), the
+    records are delivered as fast as possible
+    '''
+    counts = []
+    packs = 1
+    while packs < maxPacks:
+        counts.append(packs)
+        packs *= 2
+    counts.append(maxPacks)
+    results = []
+    for packs in counts:
+        simArgs = jkbms_sim.parseArguments(['--packs', str(packs), '--stream', '--fast'])
+        bmsList = jkbms_sim.createPacks(simArgs)
+        threads = [threading.Thread(target=jkbms_ble.pollBMS, args=(bms,), name=bms.name, daemon=True) for bms in bmsList]
+        cpu = time.process_time()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        for bms in bmsList:
+            bms.running = False
+        for thread in threads:
+            thread.join(5.0)
+        cpu = time.process_time() - cpu
+        records = sum(bms.recordCount.get(jkbms_ble.CELL_DATA, 0) for bms in bmsList)
+        results.append((packs, records, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    return results
+
+
+# ---
+# compare with a previous result file
+# ---
+def compare(results, baselineFile, tolerance):
+    with open(baselineFile) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = 100.0 * (result['usPerFrame'] / baseline[name]['usPerFrame'] - 1)
+        flag = ''
+        if change > tolerance:
+            flag = '  <-- REGRESSION'
+            regressions.append(name)
+        print('{:40s} {:10.2f} us  baseline {:10.2f} us  {:+7.1f}%{}'.format(
+            name, result['usPerFrame'], baseline[name]['usPerFrame'], change, flag))
+    return regressions
+
+
+# ---
+# parse arguments
+# ---
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the decode and publish paths of jkbms_ble')
+    parser.add_argument('--frames', type=str, help='file with recorded cell data records, one hex string per line')
+    parser.add_argument('--capture', type=str, help='also replay the notifications of this capture file (jkbms_ble.py --record)')
+    parser.add_argument('--count', default=50, type=int, help='number of synthetic frames')
+    parser.add_argument('--output', default='benchmark.json', type=str, help='result file (json)')
+    parser.add_argument('--baseline', type=str, help='compare with this result file')
+    parser.add_argument('--tolerance', default=20.0, type=float, help='allowed slowdown against the baseline in percent')
+    parser.add_argument('--budget', action="store_true", help='report the cpu needed for 1 record per second and pack')
+    parser.add_argument('--budget-cpu', default=25.0, type=float, help='cpu share (percent of one core) available for jkbms_ble')
+    parser.add_argument('--min-time', default=0.2, type=float, help='minimum time per measurement in seconds')
+    parser.add_argument('--packs', default=0, type=int, help='also run the complete pipeline with 1, 2, 4 ... PACKS simulated packs')
+    parser.add_argument('--pack-time', default=3.0, type=float, help='seconds per number of packs')
+    return parser.parse_args(argv)
+
+
+# ---
+# main part of the script
+# ---
+if __name__ == "__main__":
+
+    args = parseArguments()
+    jkbms_ble.log.setLevel(logging.WARNING)
+    jkbms_ble.mqttClient = jkbms_sim.MQTTSink()
+
+    if args.frames:
+        cellFrames = [frame for frame in readFrames(args.frames) if len(frame) == 300]
+        cell320Frames = [frame for frame in readFrames(args.frames) if len(frame) == 320] or cellDataFrames(args.count, 320)
+    else:
+        cellFrames = cellDataFrames(args.count)
+        cell320Frames = cellDataFrames(args.count, 320)
+
+    results = {}
+    cases = benchmarkCases(cellFrames, cell320Frames)
+    if args.capture:
+        cases.append(captureCase(args.capture))
+    for name, func, frames in cases:
+        seconds = measure(func, frames, args.min_time)
+        results[name] = {'usPerFrame': seconds * 1e6, 'framesPerSecond': 1.0 / seconds}
+        print('{:40s} {:10.2f} us/frame {:12.0f} frames/s'.format(name, seconds * 1e6, 1.0 / seconds))
+
+    perPack = []
+    if args.packs:
+        print('\ncomplete pipeline, N streaming packs in one process ({}, records as fast as possible):'.format(platform.machine()))
+        print('{:>5s} {:>9s} {:>14s} {:>24s} {:>12s}'.format('packs', 'records', 'us cpu/record', 'cpu per pack at 1 rec/s', 'max rss kB'))
+        for packs, records, cpu, rss in packCost(args.packs, args.pack_time):
+            usPerRecord = cpu / max(records, 1) * 1e6
+            perPack.append({'packs': packs, 'records': records, 'usPerRecord': usPerRecord, 'maxRssKB': rss})
+            print('{:5d} {:9d} {:14.1f} {:23.4f}% {:12d}'.format(packs, records, usPerRecord, usPerRecord / 1e4, rss))
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results, 'packs': perPack}, f, indent=2)
+    print('results written to {}'.format(args.output))
+
+    if args.budget:
+        print('\nPi budget, 1 cell data record per second and pack ({:.0f}% of one core available):'.format(args.budget_cpu))
+        print('(decode and publish path only, bluepy-helper and the paho network loop are not included)')
+        for name, result in results.items():
+            if name.startswith('handleNotification'):
+                cpu = result['usPerFrame'] / 1e6 * 100.0
+                print('{:40s} {:8.4f}% cpu per pack, {:8.0f} packs'.format(name, cpu, args.budget_cpu / cpu))
+
+    if args.baseline:
+        print('')
+        if compare(results, args.baseline, args.tolerance):
+            sys.exit(1)
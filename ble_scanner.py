@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 """
-Script to scan for BLE devices and show the relevant information
+Script to scan for BLE devices and show the relevant information.
+The devices seen are written to the discovery cache (jkbms_discovery.py)
+that jkbms_ble.py --discovery uses to only connect to present devices.
 
 --> has to be run as root!
 
@@ -22,6 +24,8 @@ from bluepy.btle import Scanner, DefaultDelegate
 
 from collections import OrderedDict
 
+from jkbms_discovery import readCache, writeCache, scanEntry
+
 
 # scan delegate class for BLE
 class ScanDelegate(DefaultDelegate):
@@ -69,6 +73,10 @@ parser.add_argument('--debug', action="store_true", help='enable DEBUG logging')
 # parser.add_argument('--off', action="store_true", help='switch all MIs OFF')
 # parser.add_argument('--mqtt', action="store_true", help= 'enable mqtt data output')
 requiredArguments = parser.add_argument_group('required arguments')
+parser.add_argument('--cache', default='jkbms_discovery.json', type=str, help='discovery cache file for jkbms_ble.py (empty: log only)')
+parser.add_argument('--interval', default=60.0, type=float, help='seconds between two scans')
+parser.add_argument('--scan-time', default=10.0, type=float, help='duration of a scan in seconds')
+parser.add_argument('--forget', default=24.0, type=float, help='hours after which a device that was not seen is removed from the cache')
 args = parser.parse_args()
 
 # switch to info level
@@ -106,8 +114,9 @@ def startupSequence():
 # ---
 if __name__ == "__main__":
 
-    interval = 60.0
-    lastrun = time.time() - 55
+    interval = args.interval
+    lastrun = time.time() - interval + 5
+    updated, cache = readCache(args.cache) if args.cache else (0, {})
     
     while True:
         try:            
@@ -119,11 +128,20 @@ if __name__ == "__main__":
                 actualrun = time.time()
                 if actualrun - lastrun > interval:
                     
-                    devices = scanner.scan(10.0)
+                    lastrun = actualrun
+                    devices = scanner.scan(args.scan_time)
+                    now = time.time()
                     for dev in devices:
                         log.info("## Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi))
                         for (adtype, desc, value) in dev.getScanData():
                             log.info("    %s = %s" % (desc, value))
+                        entry = scanEntry(dev, now)
+                        cache[entry.mac] = entry
+                    if args.cache:
+                        # devices not seen for a long time are dropped, the others keep their last entry
+                        cache = dict((mac, entry) for mac, entry in cache.items() if now - entry.lastSeen < args.forget * 3600)
+                        writeCache(args.cache, cache, now)
+                        log.info("%d devices seen, %d in %s" % (len(devices), len(cache), args.cache))
                 else:
                     time.sleep(1)
 
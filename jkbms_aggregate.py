@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+"""
+Windowed aggregation of the decoded cell data before publishing.
+
+Min, max, mean and last of every value are updated with each record
+(constant work per value, no samples are kept) over tumbling windows that
+are aligned to multiples of the window length. The aggregates of a window
+are returned when the first record of the next window arrives, flush()
+returns the partial window when the device stops.
+-------------------------------------------------------------------------
+"""
+
+import threading
+from collections import namedtuple
+from operator import attrgetter
+
+
+Aggregate = namedtuple('Aggregate', ['start', 'end', 'count', 'names', 'min', 'max', 'mean', 'last'])
+
+
+# ---
+# names and values of the aggregated CellData values
+# ---
+def aggregateColumns(cellCount):
+    '''
+    Cell voltages, temperatures and pack current: returns the names and a
+    function(cellData) -> values in the same order
+    '''
+    names = ['VoltageCell_{:02d}'.format(cell + 1) for cell in range(cellCount)]
+    names += ['PackTemp_1', 'PackTemp_2', 'MOSTemp', 'PackCurrent']
+    scalars = attrgetter('packtemp1', 'packtemp2', 'mostemp', 'packcurrent')
+    return names, lambda cellData: cellData.volts + scalars(cellData)
+
+
+class WindowAggregator:
+    '''
+    window:     length of a window in seconds
+    columns:    names and function(cellData) -> values, see aggregateColumns
+    '''
+    def __init__(self, window, columns):
+        self.window = window
+        self.names, self.row = columns
+        self.start = None           # start of the current window
+        self.lock = threading.Lock()    # flush() is called from another thread than add()
+        self.reset()
+
+    def reset(self):
+        size = len(self.names)
+        self.count = 0
+        self.min = [float('inf')] * size
+        self.max = [float('-inf')] * size
+        self.sum = [0.0] * size
+        self.last = None
+
+    def add(self, timestamp, cellData):
+        '''
+        Add the values of a record, returns the Aggregate of the previous
+        window if the record is the first of a new window, else None
+        '''
+        result = None
+        start = timestamp - timestamp % self.window
+        values = self.row(cellData)
+        with self.lock:
+            if start != self.start:
+                result = self.result()
+                self.start = start
+                self.reset()
+            mins, maxs, sums = self.min, self.max, self.sum
+            for i, value in enumerate(values):
+                if value < mins[i]:
+                    mins[i] = value
+                if value > maxs[i]:
+                    maxs[i] = value
+                sums[i] += value
+            self.last = values
+            self.count += 1
+        return result
+
+    def flush(self):
+        '''
+        Returns the Aggregate of the current, partial window (None if it has
+        no records), the next record starts a new window
+        '''
+        with self.lock:
+            result = self.result()
+            self.start = None
+            self.reset()
+        return result
+
+    def result(self):
+        # aggregates of the current window, None if it has no records
+        if not self.count:
+            return None
+        return Aggregate(start=self.start, end=self.start + self.window, count=self.count, names=self.names,
+                         min=tuple(self.min), max=tuple(self.max),
+                         mean=tuple([value / self.count for value in self.sum]), last=tuple(self.last))
@@ -15,21 +15,270 @@ import math
 import json
 import sys
 import time
+import threading
 import logging
 import logging.handlers
 import argparse
+import configparser
+import signal
 from xmlrpc.client import boolean
-from bluepy import btle
-from bluepy.btle import Scanner, DefaultDelegate
 
+# bluepy and paho are only needed for real devices and a real broker,
+# the decoding and the simulation (jkbms_sim.py) run without them
+try:
+    from bluepy import btle
+    from bluepy.btle import Scanner, DefaultDelegate
+except ImportError:
+    btle = None
+
+    class DefaultDelegate:
+        def __init__(self):
+            pass
+
+try:
+    import paho.mqtt.client as mqtt
+    from paho.mqtt.client import MQTT_ERR_SUCCESS
+    from paho.mqtt.client import MQTT_ERR_NO_CONN
+    from paho.mqtt.client import MQTT_ERR_QUEUE_SIZE
+except ImportError:
+    mqtt = None
+
+from collections import OrderedDict, namedtuple
+from struct import unpack, Struct
+
+from jkbms_protocol import EXTENDED_RECORD, CELL_DATA, INFO_RECORD, SOR, ACK, RECORD_LENGTHS
+from jkbms_protocol import crc8, getInfo, getCellInfo, switchCommand
+from jkbms_metrics import metrics, CONNECT, ESTABLISH, DISCOVERY, WAIT, REASSEMBLY, DECODE, PUBLISH
+from jkbms_history import HistoryStore, cellDataColumns
+from jkbms_aggregate import WindowAggregator, aggregateColumns
+from jkbms_spool import SpoolingClient
+from jkbms_capture import CaptureWriter, ReplayTransport, readCapture
+from jkbms_registry import DeviceConfig, Scheduler, loadConfig
+from jkbms_discovery import DiscoveryCache, JK_SERVICE
+from jkbms_reconnect import ReconnectPolicy
+from jkbms_handles import GattHandles, HandleCache
+from jkbms_queue import RecordQueue, POLICIES, COALESCE
+from jkbms_payload import encodeCellData, SCHEMA
+from jkbms_energy import EnergyCounter
+
+
+# reassembly of the records sent by the BMS in several notifications
+class FrameReassembler:
+    '''
+    Collects notification fragments in a fixed size buffer and yields every
+    complete record with a valid checksum.
+
+    The buffer is used as a ring: data is appended at the end and consumed
+    at the start, the remaining bytes are only moved back to the front when
+    the end of the buffer is reached. The 'SOR' marker is searched anywhere
+    in the buffered data, so a stray or lost fragment only costs the record
+    it belongs to and not the following ones.
+
+    The 8 bit checksum of about 1 in 256 records of 320 bytes also matches
+    at 300 bytes, so a length is only taken if the next 'SOR' follows it or
+    if it is the only valid one of the complete lengths. Otherwise the length
+    the device was seen to use is preferred, and the reassembler waits for
+    more bytes before it falls back to the shorter length. flush() takes the
+    record when no more bytes come (end of a response).
+    '''
+    def __init__(self, capacity=4 * 320):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0          # first unconsumed byte
+        self.end = 0            # end of the buffered data
+        self.summed = 0         # number of bytes of the current record in crc
+        self.crc = 0            # running checksum of the current record
+        self.checked = 0        # record lengths already checked
+        self.valid = []         # checked record lengths with a valid checksum
+        self.recordLength = None    # length of the records of this device, once known
+        # statistics
+        self.frames = 0
+        self.acks = 0
+        self.resyncs = 0
+        self.partialFrames = 0
+        self.droppedBytes = 0
+
+    def reset(self):
+        # drop the buffered data (new connection), the statistics and the record length are kept
+        self.start = self.end = 0
+        self._consume(0)
+
+    def feed(self, data):
+        '''
+        Append a notification fragment, return a generator of complete records
+        '''
+        length = len(data)
+        if self.end + length > self.capacity:
+            # move the unconsumed data back to the front of the buffer
+            pending = self.end - self.start
+            if pending + length > self.capacity:
+                # buffer overrun, drop the oldest data
+                drop = pending + length - self.capacity
+                self.droppedBytes += drop
+                self._consume(drop)
+                pending -= drop
+                if pending < 0:
+                    data = data[-pending:]
+                    length = len(data)
+                    pending = 0
+            self.buffer[0:pending] = self.buffer[self.start:self.start + pending]
+            self.start = 0
+            self.end = pending
+        self.view[self.end:self.end + length] = data
+        self.end += length
+        return self.records()
+
+    def flush(self):
+        '''
+        No more bytes to come for now: generator of the records whose length was still open
+        '''
+        return self.records(final=True)
+
+    def records(self, final=False):
+        '''
+        Generator yielding all complete records found in the buffered data
+        '''
+        buffer = self.buffer
+        longest = RECORD_LENGTHS[-1]
+        while True:
+            pending = self.end - self.start
+            if pending < len(SOR):
+                return
+            if not buffer.startswith(SOR, self.start):
+                pos = buffer.find(SOR, self.start, self.end)
+                if pos < 0:
+                    # keep a possibly incomplete 'SOR' at the end of the buffer
+                    pos = self.end - (len(SOR) - 1)
+                if buffer.startswith(ACK, self.start):
+                    log.debug('notificationData has ACK')
+                    self.acks += 1
+                elif pos > self.start:
+                    log.debug('No SOR found in notificationData, skipped {} bytes'.format(pos - self.start))
+                    self.resyncs += 1
+                    self.droppedBytes += pos - self.start
+                self._consume(pos - self.start)
+                continue
+            # complete lengths with a valid checksum, the running checksum covers the buffered bytes
+            valid = self.valid
+            for length in RECORD_LENGTHS:
+                if length <= self.checked:
+                    continue
+                if pending < length:
+                    self._checksum(pending)
+                    break
+                if self._checksum(length - 1) == buffer[self.start + length - 1]:
+                    valid.append(length)
+                self.checked = length
+            length = None
+            known = False       # the length is certain, not just preferred
+            for candidate in valid:
+                if buffer.startswith(SOR, self.start + candidate, self.end) and (length is None or candidate == self.recordLength):
+                    length = candidate
+                    known = True
+            if length is None and final and pending in valid:
+                length = pending        # nothing follows the record
+                known = True
+            if length is None and len(valid) == 1 and (pending >= longest or final):
+                length = valid[0]
+                known = True
+            if length is None and valid:
+                if self.recordLength in valid:
+                    length = self.recordLength
+                elif pending >= longest + len(SOR) or final:
+                    length = valid[0]
+            if length is not None:
+                if known:
+                    self.recordLength = length
+                record = bytearray(self.view[self.start:self.start + length])
+                self._consume(length)
+                self.frames += 1
+                yield record
+            elif pending >= longest:
+                # no valid record at this 'SOR', skip it and search the next one
+                log.debug('Incomplete or corrupt record dropped')
+                self.partialFrames += 1
+                self.droppedBytes += len(SOR)
+                self._consume(len(SOR))
+            else:
+                return
+
+    def _consume(self, length):
+        self.start += length
+        if self.start >= self.end:
+            self.start = self.end = 0
+        self.summed = 0
+        self.crc = 0
+        self.checked = 0
+        self.valid = []
+
+    def _checksum(self, length):
+        # extend the running checksum to the first `length` bytes of the record
+        if self.summed < length:
+            self.crc = (self.crc + sum(self.view[self.start + self.summed:self.start + length])) & 0xff
+            self.summed = length
+        return self.crc
+
+
+# cache of the values published by one device
+class PublishCache:
+    '''
+    Remembers the last published value per topic, so values that did not
+    change by more than their deadband are not published again. Every value
+    is republished after `refreshInterval` seconds, so late subscribers still
+    get a complete picture.
+    '''
+    def __init__(self, refreshInterval=300):
+        self.refreshInterval = refreshInterval
+        self.values = {}        # topic -> (value, time published)
+        self.published = 0
+        self.suppressed = 0
+        self.lastStats = time.time()
+
+    def changed(self, topic, value, deadband=0):
+        # True if the value has to be published
+        last = self.values.get(topic)
+        if last is None or time.time() - last[1] >= self.refreshInterval:
+            return True
+        if value == last[0]:
+            return False
+        if deadband and not isinstance(value, str):
+            return abs(value - last[0]) > deadband + 1e-9
+        return True
+
+    def changedValues(self, topic, values, deadband=0):
+        # True if any value of a list has to be published
+        last = self.values.get(topic)
+        if last is None or time.time() - last[1] >= self.refreshInterval or len(values) != len(last[0]):
+            return True
+        for value, lastValue in zip(values, last[0]):
+            if abs(value - lastValue) > deadband + 1e-9:
+                return True
+        return False
+
+    def store(self, topic, value):
+        self.values[topic] = (value, time.time())
+
+    def count(self, published):
+        if published:
+            self.published += 1
+        else:
+            self.suppressed += 1
+        return published
 
-import paho.mqtt.client as mqtt
-from paho.mqtt.client import MQTT_ERR_SUCCESS
-from paho.mqtt.client import MQTT_ERR_NO_CONN
-from paho.mqtt.client import MQTT_ERR_QUEUE_SIZE
+    def update(self, topic, value, deadband=0):
+        # check a single value and remember it if it has to be published
+        if not self.count(self.changed(topic, value, deadband)):
+            return False
+        self.store(topic, value)
+        return True
 
-from collections import OrderedDict
-from struct import unpack
+    def statsDue(self):
+        now = time.time()
+        if now - self.lastStats < max(self.refreshInterval, 60):
+            return False
+        self.lastStats = now
+        return True
 
 
 # delegate class for BLE
@@ -38,7 +287,13 @@ class BLEDelegate(DefaultDelegate):
         DefaultDelegate.__init__(self)
         self.jkbms = jkbms
         # log.debug('Delegate {}'.format(str(jkbms)))
-        self.notificationData = bytearray()
+        self.reassembler = jkbms.reassembler
+        self.lastRecord = jkbms.lastRecord
+        self.recordCount = jkbms.recordCount
+        self.firstFragment = None   # time of the first fragment after the last request
+        self.busy = 0.0             # time spent in handleNotification [s]
+        self.clock = time.time      # time stamp of the decoded records (capture time in a replay)
+        self.queue = jkbms.queue    # RecordQueue to the publisher thread, None: process in the callback
 
     def handleDiscovery(self, dev, isNewDev, isNewData):
         if isNewDev:
@@ -46,413 +301,235 @@ class BLEDelegate(DefaultDelegate):
         elif isNewData:
             log.info("Received new data from " +  dev.addr)
 
-    def recordIsComplete(self):
+    def updateConnectionState(self, record, recordType, now):
         '''
+        Called in the BLE callback before the record is queued: the commands (requestInfo,
+        enableNotifications, setSwitch) depend on this state, only decoding and publishing
+        go to the publisher thread. Returns False for a record that needs no processing.
         '''
-        # log.debug('Notification Data {}'.format(self.notificationData))
-        # check for 'ack' record
-        if self.notificationData.startswith(bytes.fromhex('aa5590eb')):
-            log.debug('notificationData has ACK')
-            self.notificationData = bytearray()
-            return False  # strictly record is complete, but we dont process this
-        # check record starts with 'SOR'
-        SOR = bytes.fromhex('55aaeb90')
-        if not self.notificationData.startswith(SOR):
-            log.debug('No SOR found in notificationData')
-            self.notificationData = bytearray()
-            return False
-        # check that length one of the valid lengths (300, 320)
-        if len(self.notificationData) == 300 or len(self.notificationData) == 320:
-            # check the crc/checksum is correct for the record data
-            crc = ord(self.notificationData[-1:])
-            calcCrc = crc8(self.notificationData[:-1])
-            # log.debug (crc, calcCrc)
-            if crc == calcCrc:
-                return True
-        return False
+        if recordType == EXTENDED_RECORD:
+            # the settings record comes with every getCellInfo; it is only decoded after a (re)connect,
+            # every settingsInterval seconds and after a write command
+            if self.jkbms.settingsValid and now - self.jkbms.settingsTime < self.jkbms.settingsInterval:
+                return False
+            self.jkbms.settingsValid = True
+            self.jkbms.settingsTime = now
+        elif recordType == INFO_RECORD:
+            info = decodeInfoRecord(record)
+            cached = infoCache.get(self.jkbms.mac)
+            if cached is not None and cached.powerUpTimes != info.powerUpTimes:
+                log.info('{}: BMS was restarted, power up times {} -> {}'.format(self.jkbms.name, cached.powerUpTimes, info.powerUpTimes))
+            infoCache[self.jkbms.mac] = info
+            self.jkbms.infoValid = True
+            self.jkbms.checkHandles(info.softwareVersion)
+        elif recordType == CELL_DATA:
+            uptime = cellDataUptime(record)
+            if uptime < self.jkbms.lastUptime:
+                log.info('{}: uptime went backwards, requesting the info record again'.format(self.jkbms.name))
+                self.jkbms.infoValid = False
+            self.jkbms.lastUptime = uptime
+            self.jkbms.reconnect.success()      # a good record ends a reconnect incident
+        return True
 
     def processInfoRecord(self, record):
         log.debug('Processing info record')
-        del record[0:5]
-        counter = record.pop(0)
-        log.debug('Record number: {}'.format(counter))
-        vendorID = bytearray()
-        hardwareVersion = bytearray()
-        softwareVersion = bytearray()
-        uptime = 0
-        powerUpTimes = 0
-        deviceName = bytearray()
-        passCode = bytearray()
-        # start at byte 7, go till 0x00 for device model
-        while len(record) > 0:
-            _int = record.pop(0)
-            # log.debug (_int)
-            if _int == 0x00:
-                break
-            else:
-                vendorID += bytes(_int.to_bytes(1, byteorder='big'))
-        # consume remaining null bytes
-        _int = record.pop(0)
-        while _int == 0x00:
-            _int = record.pop(0)
-        # process hardware version
-        hardwareVersion += bytes(_int.to_bytes(1, byteorder='big'))
-        while len(record) > 0:
-            _int = record.pop(0)
-            # log.debug (_int)
-            if _int == 0x00:
-                break
-            else:
-                hardwareVersion += bytes(_int.to_bytes(1, byteorder='big'))
-        # consume remaining null bytes
-        _int = record.pop(0)
-        while _int == 0x00:
-            _int = record.pop(0)
-        # process software version
-        softwareVersion += bytes(_int.to_bytes(1, byteorder='big'))
-        while len(record) > 0:
-            _int = record.pop(0)
-            # log.debug (_int)
-            if _int == 0x00:
-                break
-            else:
-                softwareVersion += bytes(_int.to_bytes(1, byteorder='big'))
-        # consume remaining null bytes
-        _int = record.pop(0)
-        while _int == 0x00:
-            _int = record.pop(0)
-        # process uptime version
-        upTimePos = 0
-        uptime = _int * 256**upTimePos
-        while len(record) > 0:
-            _int = record.pop(0)
-            upTimePos += 1
-            # log.debug (_int)
-            if _int == 0x00:
-                break
-            else:
-                uptime += _int * 256**upTimePos
-        # consume remaining null bytes
-        _int = record.pop(0)
-        while _int == 0x00:
-            _int = record.pop(0)
-        # power up times
-        powerCycle = _int
-        # consume remaining null bytes
-        _int = record.pop(0)
-        while _int == 0x00:
-            _int = record.pop(0)
-        # device name
-        deviceName += bytes(_int.to_bytes(1, byteorder='big'))
-        while len(record) > 0:
-            _int = record.pop(0)
-            # log.debug (_int)
-            if _int == 0x00:
-                break
-            else:
-                deviceName += bytes(_int.to_bytes(1, byteorder='big'))
-        # consume remaining null bytes
-        _int = record.pop(0)
-        while _int == 0x00:
-            _int = record.pop(0)
-        # Passcode
-        passCode += bytes(_int.to_bytes(1, byteorder='big'))
-        while len(record) > 0:
-            _int = record.pop(0)
-            # log.debug (_int)
-            if _int == 0x00:
-                break
-            else:
-                passCode += bytes(_int.to_bytes(1, byteorder='big'))
-
-        log.debug('VendorID: {}'.format(vendorID.decode('utf-8')))
-        mqttClient.publish(self.jkbms.tag + '/Info/VendorID', vendorID.decode('utf-8'))
-        log.debug('Device Name: {}'.format(deviceName.decode('utf-8')))
-        mqttClient.publish(self.jkbms.tag + '/Info/DeviceName', deviceName.decode('utf-8'))
-        log.debug('Pass Code: {}'.format(passCode.decode('utf-8')))
-        # mqttClient.publish(self.jkbms.tag + '/Info/PassCode', passCode.decode('utf-8'))
-        log.debug('Hardware Version: {}'.format(hardwareVersion.decode('utf-8')))
-        mqttClient.publish(self.jkbms.tag + '/Info/HardwareVersion', hardwareVersion.decode('utf-8'))
-        log.debug('Software Version: {}'.format(softwareVersion.decode('utf-8')))
-        mqttClient.publish(self.jkbms.tag + '/Info/SoftwareVersion', softwareVersion.decode('utf-8'))
-        daysFloat = uptime / (60 * 60 * 24)
-        days = math.trunc(daysFloat)
-        hoursFloat = (daysFloat - days) * 24
-        hours = math.trunc(hoursFloat)
-        minutesFloat = (hoursFloat - hours) * 60
-        minutes = math.trunc(minutesFloat)
-        secondsFloat = (minutesFloat - minutes) * 60
-        seconds = math.trunc(secondsFloat)
-        log.debug('Uptime: {}D{}H{}M{}S'.format(days, hours, minutes, seconds))
-        # mqttClient.publish(self.jkbms.tag + '/Info/Uptime', deviceName.decode('utf-8'))
-        log.debug('Power Up Times: {}'.format(powerCycle))
-        mqttClient.publish(self.jkbms.tag + '/Info/PowerCycle', powerCycle)
-        
-    def processExtendedRecord(self, record):
+        info = decodeInfoRecord(record)
+        log.debug('Record number: {}'.format(info.counter))
+
+        log.debug('VendorID: {}'.format(info.vendorID))
+        self.publish('/Info/VendorID', info.vendorID)
+        log.debug('Device Name: {}'.format(info.deviceName))
+        self.publish('/Info/DeviceName', info.deviceName)
+        log.debug('Pass Code: {}'.format(info.passCode))
+        # mqttClient.publish(self.jkbms.tag + '/Info/PassCode', info.passCode)
+        log.debug('Hardware Version: {}'.format(info.hardwareVersion))
+        self.publish('/Info/HardwareVersion', info.hardwareVersion)
+        log.debug('Software Version: {}'.format(info.softwareVersion))
+        self.publish('/Info/SoftwareVersion', info.softwareVersion)
+        log.debug('Uptime: {}'.format(seconds2uptime(info.uptime)))
+        # mqttClient.publish(self.jkbms.tag + '/Info/Uptime', seconds2uptime(info.uptime))
+        log.debug('Power Up Times: {}'.format(info.powerUpTimes))
+        self.publish('/Info/PowerCycle', info.powerUpTimes)
+
+    def processExtendedRecord(self, record, now=None):
+        # a settings record that is due (see updateConnectionState), published if it changed
         log.debug('Processing extended record')
-        del record[0:5]
-        counter = record.pop(0)
-        log.debug('Record number: {}'.format(counter))
-
-    def processCellDataRecord02(self, record):      # 2 Byte Format
+        settings = decodeSettingsRecord(record)
+        log.debug('Record number: {}'.format(settings.counter))
+        cached = settingsCache.get(self.jkbms.mac)
+        settingsCache[self.jkbms.mac] = settings
+        if cached is not None and cached[1:] == settings[1:]:
+            return      # the retained messages are current
+        if cached is not None:
+            log.info('{}: settings changed'.format(self.jkbms.name))
+        self.publishSettings(settings)
+
+    def publishSettings(self, settings):
+        # retained, so a consumer gets the configuration when it subscribes (json with --format binary too)
+        tag = self.jkbms.tag
+        if self.jkbms.format != 'mqtt':
+            payload = dict((name, getattr(settings, field)) for name, field, _ in SETTINGS_VALUES)
+            payload['WireResistance'] = settings.wireResistances
+            mqttClient.publish(tag + '/Settings', json.dumps(payload, separators=(',', ':')), retain=True)
+            return
+        for name, field, _ in SETTINGS_VALUES:
+            mqttClient.publish(tag + '/Settings/' + name, getattr(settings, field), retain=True)
+        for topic, value in zip(WIRE_RESISTANCE_TOPICS, settings.wireResistances):
+            mqttClient.publish(tag + topic, value, retain=True)
+
+    def processCellDataRecord02(self, record, now=None):      # 2 Byte Format
         # log.debug('Processing 2 Byte cell data record')
         # log.debug('Record length {}'.format(len(record)))
-        del record[0:5]
-        counter = record.pop(0)
-        # log.debug('Record number: {}'.format(counter))
-        # Process cell voltages
-        volts = []
-        size = 2                # changed from 4 to 2
-        number = 24
-        c_high=0
-        c_low=10
-        c_diff=0
-        for i in range(0, number):
-            volts.append(record[0:size])
-            del record[0:size]
-        # log.debug('Volts: {}'.format(volts))
-        _totalvolt = 0
-        for cell, volt in enumerate(volts):
-            _volt = float(LittleHex2Short(volt)) / 1000.0
-            out['B{:d}'.format(cell+1)]=round(_volt,4)
-            # log.debug('Cell: {:02d}, Volts: {:.4f}'.format(cell + 1, _volt))
-            mqttClient.publish(self.jkbms.tag + '/CellData/VoltageCell_{:02d}'.format(cell+1), _volt)
-                
-        # log.debug (record)
-        unknown1 = float(LittleHex2Short(record[0:size])) / 1000.0           # unknown
-        del record[0:size]
-        unknown2 = float(LittleHex2Short(record[0:size])) / 1000.0           # unknown
-        del record[0:size]
-        avgcellvoltage = float(LittleHex2Short(record[0:size])) / 1000.0     # Avg. cell voltage in pack
-        del record[0:size]
-        deltacellvoltage = float(LittleHex2Short(record[0:size]))            # delta voltage between highest and lowest cell
-        del record[0:size]
-        balancercurrent = float(LittleHex2Short(record[0:size])) / 1000.0    # balancer cell / current / ?
-        del record[0:size]
-        
-        # log.debug('Unknown value #1:   %s' % (unknown1))
-        # log.debug('Unknown value #2:   %s' % (unknown2))
-        # log.debug('Avg. cell voltage:  %s' % (avgcellvoltage))
-        mqttClient.publish(self.jkbms.tag + '/CellData/AvgCellVoltage', avgcellvoltage)
-        # log.debug('Delta cell voltage: %s' % (deltacellvoltage))
-        mqttClient.publish(self.jkbms.tag + '/CellData/DeltaCellVoltage', deltacellvoltage)
-        # log.debug('Balancer cell/ current?:   %s' % (balancercurrent))
-        mqttClient.publish(self.jkbms.tag + '/CellData/BalancerCurrent', balancercurrent)
-        
-        # Process cell wire resistances
-        # log.debug('Processing wire resistances')
-
-        resistances = []
-        size = 2
-        number = 25
-        for i in range(0, number):
-            resistances.append(record[0:size])
-            del record[0:size]
-        for cell, resistance in enumerate(resistances):
-            _resistance = float(LittleHex2Short(resistance)) / 1000.0
-            out['R{:d}'.format(cell+1)]=round(_resistance,4)
-            # log.debug('Cell: {:02d}, Resistance: {:.4f}'.format(cell, _resistance))
-            mqttClient.publish(self.jkbms.tag + '/CellData/ResistanceCell_{:02d}'.format(cell), _resistance)
-        
-        # process additional values
-        '''
-        unknown3 = float(LittleHex2Short(record[0:2])) / 1000.0           # unknown
-        del record[0:2]
-        # log.debug('Unknown value #3:   %s' % (unknown3))
-        '''
-        unknown4 = float(LittleHex2Short(record[0:2])) / 1000.0           # unknown
-        del record[0:2]
-        # log.debug('Unknown value #4:   %s' % (unknown4))
-        unknown5 = float(LittleHex2Short(record[0:2])) / 1000.0           # unknown
-        del record[0:2]
-        # log.debug('Unknown value #5:   %s' % (unknown5))
-        packvoltage = float(LittleHex2UInt(record[0:4])) / 1000.0            # pack voltag
-        del record[0:4]
-        # log.debug('Pack voltage:       %s' % (packvoltage))
-        mqttClient.publish(self.jkbms.tag + '/CellData/PackVoltage', packvoltage)
-        packpower = float(LittleHex2UInt(record[0:4])) / 1000.0              # pack power
-        del record[0:4]
-        # log.debug('Pack power:         %s' % (packpower))
-        mqttClient.publish(self.jkbms.tag + '/CellData/PackPower', packpower)
-        packcurrent = float(LittleHex2Int(record[0:4])) / 1000.0           # pack current
-        del record[0:4]
-        # log.debug('Balance current:    %s' % (balancecurent))
-        mqttClient.publish(self.jkbms.tag + '/CellData/PackCurrent', packcurrent)
-        packtemp1 = float(LittleHex2Short(record[0:2])) / 10.0               # Temp. sensor #1
-        del record[0:2]
-        # log.debug('T1:                 %s' % (packtemp1))
-        mqttClient.publish(self.jkbms.tag + '/CellData/PackTemp_1', packtemp1)
-        packtemp2 = float(LittleHex2Short(record[0:2])) / 10.0               # Temp. sensor #2
-        del record[0:2]
-        # log.debug('T2:                 %s' % (packtemp2))
-        mqttClient.publish(self.jkbms.tag + '/CellData/PackTemp_2', packtemp2)
-        mostemp = float(LittleHex2Short(record[0:2])) / 10.0                 # MOS Temp. sensor
-        del record[0:2]
-        # log.debug('MOS Temp.:          %s' % (mostemp))
-        mqttClient.publish(self.jkbms.tag + '/CellData/MOSTemp', mostemp)
-        unknown6 = float(LittleHex2Short(record[0:2])) / 1000.0              # unknown
-        del record[0:2]
-        # log.debug('Unknown value #6:   %s' % (unknown6))
-        unknown7 = float(LittleHex2Short(record[0:2])) / 1000.0              # unknown
-        del record[0:2]
-        # log.debug('Unknown value #7:   %s' % (unknown7))
-        unknown8 = float(Hex2Int(record[0:1])) / 1000.0                      # unknown
-        del record[0:1]
-        # log.debug('Unknown value #8:   %s' % (unknown8))
-        soc = Hex2Int(record[0:1])                                           # pack SOC
-        del record[0:1]
-        # log.debug('Pack SOC:   %s' % (soc))
-        mqttClient.publish(self.jkbms.tag + '/CellData/PackSOC', soc)
-        caparemaining = float(LittleHex2UInt(record[0:4])) / 1000.0          # remaining capacity
-        del record[0:4]
-        # log.debug('Capa remaining:     %s' % (caparemaining))
-        capanominal = float(LittleHex2UInt(record[0:4])) / 1000.0            # nominal capacity
-        del record[0:4]
-        # log.debug('Capa nominal:       %s' % (capanominal))
-        mqttClient.publish(self.jkbms.tag + '/CellData/CapaNominal', capanominal)
-        cyclecount = float(LittleHex2UInt(record[0:4]))                      # cycle count
-        del record[0:4]
-        # log.debug('Cycle count:        %s' % (cyclecount))
-        mqttClient.publish(self.jkbms.tag + '/CellData/CycleCount', cyclecount)
-        capacycle = float(LittleHex2UInt(record[0:4])) / 1000.0              # cycle capacity
-        del record[0:4]
-        # log.debug('Capa cycled:       %s' % (capacycle))
-        mqttClient.publish(self.jkbms.tag + '/CellData/CapaCycled', capacycle)
-        unknown9 = float(LittleHex2Short(record[0:2])) / 1000.0              # unknown
-        del record[0:2]
-        # log.debug('Unknown value #9:   %s' % (unknown9))
-        unknown10 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #10:  %s' % (unknown10))
-        uptime = Hex2uptime(record[0:3])                                     # uptime
-        del record[0:3]
-        # log.debug('Uptime:             %s' % (uptime))
-        mqttClient.publish(self.jkbms.tag + '/CellData/BMSUptime', uptime)
-        unknown11 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #11:  %s' % (unknown11))
-        unknown12 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #12:  %s' % (unknown12))
-        unknown13 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #13:  %s' % (unknown13))
-        unknown14 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #14:  %s' % (unknown14))
-        unknown15 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #15:  %s' % (unknown15))
-        unknown16 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #16:  %s' % (unknown16))
-        unknown17 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #17:  %s' % (unknown17))
-        unknown18 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #18:  %s' % (unknown18))
-        unknown19 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #19:  %s' % (unknown19))
-        unknown20 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #20:  %s' % (unknown20))
-        unknown21 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #21:  %s' % (unknown21))
-        unknown22 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #22:  %s' % (unknown22))
-        charge = float(LittleHex2Short(record[0:2])) / 1000.0                # charge?
-        del record[0:2]
-        # log.debug('Charge?:            %s' % (charge))
-        mqttClient.publish(self.jkbms.tag + '/CellData/ChargeCurrent', charge)
-        discharge = float(LittleHex2Short(record[0:2])) / 1000.0             # discharge?
-        del record[0:2]
-        # log.debug('Discharge?:         %s' % (discharge))
-        mqttClient.publish(self.jkbms.tag + '/CellData/DischargeCurrent', discharge)
-        unknown23 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #23:  %s' % (unknown23))
-        unknown24 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #24:  %s' % (unknown24))
-        unknown25 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #25:  %s' % (unknown25))
-        unknown26 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #26:  %s' % (unknown26))
-        unknown27 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #27:  %s' % (unknown27))
-        unknown28 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #28:  %s' % (unknown28))
-        unknown29 = float(LittleHex2Short(record[0:2])) / 1000.0             # unknown
-        del record[0:2]
-        # log.debug('Unknown value #29:  %s' % (unknown29))
-        # further 93 bytes ignored for the moment...
-        
+        start = time.perf_counter()
+        cellData = decodeCellDataRecord02(record)
+        # log.debug('Record number: {}'.format(cellData.counter))
+        for cell, _volt in enumerate(cellData.volts):
+            self.jkbms.out[CELL_KEYS[cell]] = round(_volt, 4)
+        for cell, _resistance in enumerate(cellData.resistances):
+            self.jkbms.out[RESISTANCE_KEYS[cell]] = round(_resistance, 4)
+        if now is None:
+            now = self.clock()
+        if self.jkbms.history is not None:
+            self.jkbms.history.append(now, cellData)
+        if self.jkbms.energy is not None and self.jkbms.energy.add(now, cellData):
+            self.publishEnergy(self.jkbms.energy)
+        decoded = time.perf_counter()
+        metrics.observe(DECODE, self.jkbms.name, decoded - start)
+        if self.jkbms.aggregator is not None:
+            aggregate = self.jkbms.aggregator.add(now, cellData)
+            if aggregate is not None:
+                self.publishAggregate(aggregate)
+        if now - self.jkbms.lastRaw >= self.jkbms.rawInterval:
+            self.jkbms.lastRaw = now
+            if self.jkbms.format == 'json':
+                self.publishCellDataJson(cellData)
+            elif self.jkbms.format == 'binary':
+                self.publishCellDataBinary(cellData)
+            else:
+                self.publishCellDataTopics(cellData)
+        self.publishStats()
+        metrics.observe(PUBLISH, self.jkbms.name, time.perf_counter() - decoded)
+
+    def publish(self, topic, value, deadband=0):
+        # publish a single value, unless it is within the deadband of the last published one
+        if self.jkbms.publishCache.update(topic, value, deadband):
+            mqttClient.publish(self.jkbms.tag + topic, value)
+
+    def publishCellDataTopics(self, cellData):
+        # one topic per value
+        deadband = DEADBANDS.get('VoltageCell', 0)
+        for cell, _volt in enumerate(cellData.volts):
+            self.publish(VOLTAGE_TOPICS[cell], _volt, deadband)
+        deadband = DEADBANDS.get('ResistanceCell', 0)
+        for cell, _resistance in enumerate(cellData.resistances):
+            self.publish(RESISTANCE_TOPICS[cell], _resistance, deadband)
+        for name, field in CELL_DATA_VALUES:
+            self.publish('/CellData/' + name, getattr(cellData, field), DEADBANDS.get(name, 0))
+
+    def cellDataChanged(self, cellData):
+        # True if any value of the record left its deadband, the record is then stored as published
+        cache = self.jkbms.publishCache
+        changed = cache.changedValues('/CellData/VoltageCell', cellData.volts, DEADBANDS.get('VoltageCell', 0))
+        changed |= cache.changedValues('/CellData/ResistanceCell', cellData.resistances, DEADBANDS.get('ResistanceCell', 0))
+        for name, field in CELL_DATA_VALUES:
+            if name != 'BMSUptime':     # changes with every record, not a reason to publish
+                changed |= cache.changed('/CellData/' + name, getattr(cellData, field), DEADBANDS.get(name, 0))
+        if not cache.count(changed):
+            return False
+        cache.store('/CellData/VoltageCell', cellData.volts)
+        cache.store('/CellData/ResistanceCell', cellData.resistances)
+        for name, field in CELL_DATA_VALUES:
+            cache.store('/CellData/' + name, getattr(cellData, field))
+        return True
+
+    def publishCellDataJson(self, cellData):
+        # all values of the record in one json document, sent if any value left its deadband
+        if not self.cellDataChanged(cellData):
+            return
+        payload = {'VoltageCell': cellData.volts, 'ResistanceCell': cellData.resistances}
+        for name, field in CELL_DATA_VALUES:
+            payload[name] = getattr(cellData, field)
+        mqttClient.publish(self.jkbms.tag + '/CellData', json.dumps(payload, separators=(',', ':')))
+
+    def publishCellDataBinary(self, cellData):
+        # the same values packed as integers (jkbms_payload.py), the layout retained on <tag>/CellData/Schema
+        if not self.cellDataChanged(cellData):
+            return
+        if not self.jkbms.schemaPublished:
+            mqttClient.publish(self.jkbms.tag + '/CellData/Schema', json.dumps(SCHEMA, separators=(',', ':')), retain=True)
+            self.jkbms.schemaPublished = True
+        mqttClient.publish(self.jkbms.tag + '/CellData', encodeCellData(cellData))
+
+    def publishAggregate(self, aggregate):
+        # min / max / mean / last of a window, always published (every window is new information)
+        tag = self.jkbms.tag
+        if self.jkbms.format != 'mqtt':
+            payload = {'Start': aggregate.start, 'End': aggregate.end, 'Samples': aggregate.count}
+            for i, name in enumerate(aggregate.names):
+                payload[name] = {'Min': aggregate.min[i], 'Max': aggregate.max[i],
+                                 'Mean': round(aggregate.mean[i], 4), 'Last': aggregate.last[i]}
+            mqttClient.publish(tag + '/Aggregate', json.dumps(payload, separators=(',', ':')))
+        else:
+            for i, name in enumerate(aggregate.names):
+                topic = tag + '/Aggregate/' + name
+                mqttClient.publish(topic + '/Min', aggregate.min[i])
+                mqttClient.publish(topic + '/Max', aggregate.max[i])
+                mqttClient.publish(topic + '/Mean', round(aggregate.mean[i], 4))
+                mqttClient.publish(topic + '/Last', aggregate.last[i])
+            mqttClient.publish(tag + '/Aggregate/Samples', aggregate.count)
+
+    def publishEnergy(self, energy):
+        # charged / discharged Wh and Ah, cell voltage and spread, efficiency; retained, they are totals
+        tag = self.jkbms.tag
+        values = energy.values()
+        if self.jkbms.format != 'mqtt':
+            mqttClient.publish(tag + '/Energy', json.dumps(values, separators=(',', ':')), retain=True)
+            return
+        for period, periodValues in values.items():
+            for name, value in periodValues.items():
+                mqttClient.publish('{}/Energy/{}/{}'.format(tag, period, name), value, retain=True)
+
+    def publishStats(self):
+        # publish the counters of the publish cache, used to tune the deadbands
+        cache = self.jkbms.publishCache
+        if cache.statsDue():
+            log.info('{}: published {} values, suppressed {} values'.format(self.jkbms.name, cache.published, cache.suppressed))
+            mqttClient.publish(self.jkbms.tag + '/Stats/PublishedValues', cache.published)
+            mqttClient.publish(self.jkbms.tag + '/Stats/SuppressedValues', cache.suppressed)
 
     def processCellDataRecord04(self, record):       # 4 Byte Format
-        log.debug('Processing cell data record')
-        log.debug('Record length {}'.format(len(record)))
-        del record[0:5]
-        counter = record.pop(0)
-        log.debug('Record number: {}'.format(counter))
-        # Process cell voltages
-        volts = []
-        size = 4
-        number = 24
-        c_high=0
-        c_low=10
-        c_diff=0
-        for i in range(0, number):
-            volts.append(record[0:size])
-            del record[0:size]
-        log.debug('Volts: {}'.format(volts))
+        counter, volts, resistances = decodeCellDataRecord04(record)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Cell data record (4 byte format) #{}: {}'.format(counter, bytes(record).hex()))
+        out = self.jkbms.out
         _totalvolt = 0
-        for cell, volt in enumerate(volts):
-            _volt = float(decodeHex(volt))
-            out['B{:d}'.format(cell+1)]=round(_volt,4)
-            log.debug('Cell: {:02d}, Volts: {:.4f}'.format(cell + 1, _volt))
-            #publish({'VoltageCell{:02d}'.format(cell + 1): _volt}, format=self.jkbms.format, broker=self.jkbms.mqttBroker, tag=self.jkbms.tag)
+        c_high = 0
+        c_low = 10
+        for cell, _volt in enumerate(volts):
+            _volt = float(_volt)
+            out[CELL_KEYS[cell]] = round(_volt, 4)
             _totalvolt += _volt
             if c_high < _volt:
-                c_high= _volt
+                c_high = _volt
             if c_low > _volt and _volt != 0:
-                c_low=_volt
-        #publish({'VoltageTotal': _totalvolt}, format=self.jkbms.format, broker=self.jkbms.mqttBroker, tag=self.jkbms.tag)
-        # Process cell wire resistances
-        # log.debug (record)
-        #log.debug('Processing wire resistances')
-        out["Total"]= round(_totalvolt,4)
-        out["Cell_High"]= round(c_high,4)
-        out["Cell_Low"]= round(c_low,4)
-        out["Cell_Diff"]= round(c_high-c_low,4)
-        resistances = []
-        size = 4
-        number = 25
-        for i in range(0, number):
-            resistances.append(record[0:size])
-            del record[0:size]
+                c_low = _volt
+        out["Total"] = round(_totalvolt, 4)
+        out["Cell_High"] = round(c_high, 4)
+        out["Cell_Low"] = round(c_low, 4)
+        out["Cell_Diff"] = round(c_high - c_low, 4)
         for cell, resistance in enumerate(resistances):
-            out['R{:d}'.format(cell+1)]=round(decodeHex(resistance),4)
-            log.debug('Cell: {:02d}, Resistance: {:.4f}'.format(cell, decodeHex(resistance)))
-            #publish({'ResistanceCell{:02d}'.format(cell): float(decodeHex(resistance))}, format=self.jkbms.format, broker=self.jkbms.mqttBroker, tag=self.jkbms.tag)
-        # log.debug (record)
+            out[RESISTANCE_KEYS[cell]] = round(resistance, 4)
 
-    def processRecord(self, record):
+    def processRecord(self, record, now=None):
+        # now: time the record was received, default: now
         recordType = record[4]
         # counter = record[5]
         if recordType == INFO_RECORD:
             self.processInfoRecord(record)
         elif recordType == EXTENDED_RECORD:
-            self.processExtendedRecord(record)
+            self.processExtendedRecord(record, now)
         elif recordType == CELL_DATA:
-            self.processCellDataRecord02(record)
+            self.processCellDataRecord02(record, now)
         else:
             log.debug('Unknown record type')
 
@@ -460,98 +537,136 @@ class BLEDelegate(DefaultDelegate):
         # handle is the handle of the characteristic / descriptor that posted the notification
         # data is the data in this notification - may take multiple notifications to get all of a message
         #log.debug('From handle: {:#04x} Got {} bytes of data'.format(handle, len(data)))
-        self.notificationData += bytearray(data)
-        if self.recordIsComplete():
-            record = self.notificationData
-            self.notificationData = bytearray()
-            self.processRecord(record)
-
+        start = time.perf_counter()
+        if recorder is not None:
+            recorder.write(self.jkbms.mac, data)
+        if self.firstFragment is None:
+            self.firstFragment = time.time()
+        processing = self.handleRecords(self.reassembler.feed(data))
+        elapsed = time.perf_counter() - start
+        metrics.observe(REASSEMBLY, self.jkbms.name, elapsed - processing)
+        self.busy += elapsed
+
+    def flush(self):
+        # no notification within the wait, the record at the end of a response is complete
+        start = time.perf_counter()
+        self.handleRecords(self.reassembler.flush())
+        self.busy += time.perf_counter() - start
+
+    def handleRecords(self, records):
+        # count the complete records and queue (or process) them, returns the time spent processing
+        processing = 0.0
+        for record in records:
+            recordType = record[4]
+            self.lastRecord[recordType] = time.time()
+            self.recordCount[recordType] = self.recordCount.get(recordType, 0) + 1
+            metrics.mark('jkbms_frames', self.jkbms.name)
+            received = self.clock()
+            if not self.updateConnectionState(record, recordType, received):
+                continue
+            if self.queue is not None:
+                # decoded and published by the publisher thread, never wait for the broker here
+                self.queue.put((self.jkbms.name, recordType), (self, record, received))
+                continue
+            processStart = time.perf_counter()
+            self.processRecord(record, received)
+            processing += time.perf_counter() - processStart
+        return processing
 
-# parse arguments
-parser = argparse.ArgumentParser(description = 'Victron modbus control test')
-parser.add_argument('--version', action='version', version='%(prog)s v')
-parser.add_argument('--debug', action="store_true", help='enable DEBUG logging')
-parser.add_argument('--info', action="store_true", help='enable INFO logging')
-parser.add_argument('--name', default='defaultName', type=str, help='set the device name (informative)')
-parser.add_argument('--mac', type=str, help='set the device name (informative)')
-# parser.add_argument('--max', action="store_true", help='set the output of all MIs to 100 percent')
-# parser.add_argument('--min', action="store_true", help='set the output of all MIs to 2 percent')
-# parser.add_argument('--on', action="store_true", help='switch all MIs ON')
-# parser.add_argument('--off', action="store_true", help='switch all MIs OFF')
-# parser.add_argument('--mqtt', action="store_true", help= 'enable mqtt data output')
-requiredArguments = parser.add_argument_group('required arguments')
-parser.add_argument('--bms', default=1, type=int, help='set the device number to be queried (required)')
-
-args = parser.parse_args()
 
 # setup mqtt infos
 PORT = 1883
 BROKER = "mosquitto.fritz.box"
 
 # global variables
-EXTENDED_RECORD = 1
-CELL_DATA = 2
-INFO_RECORD = 3
-
-getInfo = b'\xaa\x55\x90\xeb\x97\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x11'
-getCellInfo = b'\xaa\x55\x90\xeb\x96\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x10'
-
 namelist = ['JKBMS-Top', 'JKBMS-Bottom']
 model = 'JK-B2A24S'
 maclist = ['C8:47:8C:E2:81:41', 'C8:47:8C:E2:92:0C']
 command = 'command'
 taglist = ['JKBMS_top', 'JKBMS_bot']
-format = 'mqtt'
-listitem = args.bms
 
-out=dict()
-c_high=0.00
-c_low=10.00
-c_diff=0.00
+# seconds between two looks at the discovery cache while a device is not advertising
+DISCOVERY_RECHECK = 2.0
 
-# --------------------------------------------------------------------------- #
-# configure the client logging
-# --------------------------------------------------------------------------- #
-# create logger
+# seconds without a notification after which a buffered record of a still open length is taken
+FLUSH_IDLE = 0.2
+
+# output formats: one topic per value, one json document or one packed struct (jkbms_payload.py) per record
+FORMATS = ['mqtt', 'json', 'binary']
+
+# values are only published if they differ by more than the deadband from the
+# last published value (key: topic name without cell number)
+DEADBANDS = {
+    'VoltageCell': 0.002,       # V
+    'AvgCellVoltage': 0.002,    # V
+    'DeltaCellVoltage': 2,      # mV
+    'PackVoltage': 0.02,        # V
+    'PackTemp_1': 0.1,          # degC
+    'PackTemp_2': 0.1,          # degC
+    'MOSTemp': 0.1,             # degC
+}
+
+# logger, the handlers are set up in setupLogging()
 log = logging.getLogger('jkbms_ble')
-log.setLevel(logging.WARNING)
-# create file handler which logs even debug messages
-if listitem < len(namelist):
-    fh = logging.handlers.TimedRotatingFileHandler('jkbms_ble_{}.log'.format(namelist[listitem]),'D', 1, 5)
-else:
-    log.error('There are only {} devices selectable! --bms must be <= number of devices.'.format(len(namelist)))
-    exit()
-fh.setLevel(logging.INFO)
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.ERROR)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-# add the handlers to the logger
-log.addHandler(fh)
-log.addHandler(ch)
-
-if args.info: # switch to info level
-    log.setLevel(logging.INFO)
-    ch.setLevel(logging.INFO)
-    fh.setLevel(logging.INFO)
 
-if args.debug: # switch to debug level
-    # create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(threadName)s - '
-                                    '%(levelname)s - %(module)s:%(lineno)s - %(message)s')
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-    # add the handlers to the logger
-    log.addHandler(fh)
-    log.addHandler(ch)
-    
-    log.setLevel(logging.DEBUG)
-    ch.setLevel(logging.DEBUG)
-    fh.setLevel(logging.DEBUG)
+# transport to the BMS using bluepy
+class BluepyTransport:
+    '''
+    BLE transport using a bluepy Peripheral. jkbms only uses connect, write,
+    waitForNotifications and disconnect, so any object with these methods
+    can replace it (see jkbms_sim.SimulatedTransport).
+    '''
+    def __init__(self):
+        self.peripheral = btle.Peripheral(None)
+
+    def setDelegate(self, delegate):
+        self.peripheral.withDelegate(delegate)
+
+    def connect(self, mac, addrType='public'):
+        self.peripheral.connect(mac, addrType)
+        self.peripheral.setMTU(330)    # line copied from mpp-solar project (reason?)
+
+    def discoverHandles(self):
+        # Connect to the notify service
+        serviceNotifyUuid = 'ffe0'
+        serviceNotify = self.peripheral.getServiceByUUID(serviceNotifyUuid)
+
+        # Get the handles that we need to talk to
+        # Read
+        characteristicReadUuid = 'ffe1'     #'ffe3' seems to be an "old" value
+        characteristicRead = serviceNotify.getCharacteristics(characteristicReadUuid)
+        # log.debug('read char. %s' % (characteristicRead))
+        # log.debug('read char. [0] %s' % (characteristicRead[0]))
+        handleRead = characteristicRead[0].getHandle()
+        # log.debug('Read characteristic: {}, handle {:x}'.format(characteristicRead[0], handleRead))
+        # client characteristic configuration descriptor, usually the handle after the value
+        descriptors = characteristicRead[0].getDescriptors(forUUID=0x2902)
+        handleConfig = descriptors[0].handle if descriptors else handleRead + 1
+        return GattHandles(notify=handleRead, write=handleRead, cccd=handleConfig)
+
+    def getServices(self):
+        services = self.peripheral.getServices()
+        # log.debug("services: %s" % (services))
+        for item in services:
+            log.debug('service item: %s' % (item))
+            characteristics = item.getCharacteristics()
+            # log.debug('  - characteristics: %s' % (characteristics))
+            for c in characteristics:
+                log.debug('    -- characteristic item: %s' % (c))
+            descriptors = item.getDescriptors()
+            # log.debug('  - descriptors: %s' % (descriptors))
+            for d in descriptors:
+                log.debug('    -- descriptor item: %s' % (d))
+        return services
+
+    def write(self, handle, data):
+        self.peripheral.writeCharacteristic(handle, data)
+
+    def waitForNotifications(self, timeout):
+        return self.peripheral.waitForNotifications(timeout)
 
+    def disconnect(self):
+        self.peripheral.disconnect()
 
 
 class jkbms:
@@ -563,7 +678,7 @@ class jkbms:
         #return 'JKBMS instance --- name: {}, model: {}, mac: {}, command: {}, tag: {}, format: {}, records: {}, maxConnectionAttempts: {}, mqttBroker: {}'.format(self.name, self.model, self.mac, self.command, self.tag, self.format, self.records, self.maxConnectionAttempts, self.mqttBroker)
 #        return out
 
-    def __init__(self, name, model, mac, command, tag, format, records=1, maxConnectionAttempts=30, mqttBroker=None):
+    def __init__(self, name, model, mac, command, tag, format, records=1, maxConnectionAttempts=30, mqttBroker=None, refreshInterval=300, stream=False, streamTimeout=10, requestTimeout=10, transport=None, history=None, energy=None, aggregate=0, rawInterval=None, interval=1, priority=0, discovery=None, reconnect=None, handleCache=None, settingsInterval=3600, queue=None):
         '''
         '''
         self.name = name
@@ -571,57 +686,131 @@ class jkbms:
         self.mac = mac
         self.command = command
         self.tag = tag
-        self.format = format
+        self.format = format        # one of FORMATS
+        self.schemaPublished = False    # --format binary: layout published on <tag>/CellData/Schema
         try:
             self.records = int(records)
         except Exception:
             self.records = 1
         self.maxConnectionAttempts = maxConnectionAttempts
         self.mqttBroker = mqttBroker
-        self.device = btle.Peripheral(None)
+        self.publishCache = PublishCache(refreshInterval)
+        self.out = dict()
+        self.stream = stream
+        self.streamTimeout = streamTimeout
+        self.requestTimeout = requestTimeout
+        self.responseTimes = {}     # record type -> (first fragment, record complete) in s
+        self.lastRecord = {}        # record type -> time the last complete record was received
+        self.recordCount = {}       # record type -> number of complete records received
+        self.subscribed = False
+        self.stalled = False
+        self.infoValid = False      # info record received on the current connection
+        self.settingsValid = False  # settings record decoded on the current connection
+        self.settingsTime = 0
+        self.settingsInterval = settingsInterval    # decode the settings record again after this many seconds
+        self.lastUptime = 0
+        self.reassembler = FrameReassembler()
+        self.connections = 0
+        self.history = history      # HistoryStore of the decoded cell data, or None
+        self.energy = energy        # EnergyCounter (energy and charge totals), or None
+        # with aggregate (window in s) min / max / mean / last are published per window and the
+        # raw values only every rawInterval seconds (default: once per window)
+        self.aggregator = WindowAggregator(aggregate, aggregateColumns(CELL_COUNT)) if aggregate else None
+        if rawInterval is None:
+            rawInterval = aggregate
+        self.rawInterval = rawInterval
+        self.lastRaw = 0
+        self.interval = interval    # seconds between two polls (not streaming)
+        self.priority = priority    # lower values are polled first when several devices are due
+        self.connected = False
+        self.running = True         # cleared when the device is removed from the config
+        self.discovery = discovery  # DiscoveryCache of ble_scanner.py, or None
+        self.serviceWarned = False  # logged that the device does not advertise the JK-BMS service
+        self.reconnect = reconnect or ReconnectPolicy(name)
+        self.retryDelay = 0.0       # delay before the next connection attempt after connect() failed
+        # GATT handles, from the cache or discovered once, and the firmware they belong to
+        # (None: not yet stored, done with the next info record)
+        self.handleCache = handleCache or HandleCache()
+        self.handles, self.handlesFirmware = self.handleCache.lookup(mac)
+        self.notifying = False      # notifications enabled on the current connection
+        self.queue = queue          # RecordQueue of the publisher thread, None: publish in the BLE callback
+        self.transport = transport or BluepyTransport
+        self.device = self.transport()
         #log.debug('Config data - name: {}, model: {}, mac: {}, command: {}, tag: {}, format: {}'.format(self.name, self.model, self.mac, self.command, self.tag, self.format))
         #log.debug('Additional config - records: {}, maxConnectionAttempts: {}, mqttBroker: {}'.format(self.records, self.maxConnectionAttempts, self.mqttBroker))
         #log.debug('jkBMS Logging level: {}'.format(log.level))
 
-    def connect(self):
+    def connect(self, maxAttempts=None):
+        '''
+        At most maxAttempts (default maxConnectionAttempts) connection attempts,
+        with the delays of the reconnect policy in between
+        '''
         # Intialise BLE device
-        self.device = btle.Peripheral(None)
+        self.device = self.transport()
         # log.debug('device info (not yet connected) {}'.format(self.device))
-        self.device.withDelegate(BLEDelegate(self))
+        self.delegate = BLEDelegate(self)
+        self.device.setDelegate(self.delegate)
+        self.reassembler.reset()
+        self.subscribed = False
+        self.stalled = False
+        self.infoValid = False
+        self.settingsValid = False
+        self.connected = False
+        self.notifying = False
+        if self.connections:
+            metrics.inc('jkbms_reconnects_total', self.name)
         # Connect to BLE Device
         connected = False
         attempts = 0
+        addrType = 'public'
+        established = time.perf_counter()
+        if maxAttempts is None:
+            maxAttempts = self.maxConnectionAttempts
         while not connected:
             attempts += 1
             log.info('Attempt #{} to connect to {}'.format(attempts, self.name))
-            if attempts > self.maxConnectionAttempts:
+            if attempts > maxAttempts:
                 log.info('Cannot connect to {} with mac {} - exceeded {} attempts'.format(self.name, self.mac, attempts - 1))
                 return connected
+            if attempts > 1:
+                time.sleep(self.retryDelay)
+            if self.discovery is not None:
+                # only try a device the scanner has seen recently, with the address type it advertised
+                present, entry = self.discovery.lookup(self.mac)
+                if entry is not None:
+                    addrType = entry.addrType
+                    if not entry.jkService and not self.serviceWarned:
+                        # still tried, but most likely the mac of another device is configured
+                        log.warning('{}: {} ({}) does not advertise the JK-BMS service {}, check the mac'.format(
+                            self.name, self.mac, entry.name, JK_SERVICE))
+                        self.serviceWarned = True
+                if present is False:
+                    log.info('{} not seen by the scanner within {}s, not trying to connect'.format(self.name, self.discovery.maxAge))
+                    metrics.inc('jkbms_connect_skipped_total', self.name)
+                    # not a failure, the backoff stays where it is while the device is away;
+                    # looking at the cache costs nothing, check it again after 2s
+                    self.retryDelay = DISCOVERY_RECHECK
+                    continue
+            metrics.inc('jkbms_connect_attempts_total', self.name)
+            start = time.perf_counter()
             try:
-                self.device.connect(self.mac)
+                self.device.connect(self.mac, addrType)
                 log.debug('connected')
-                self.device.setMTU(330)    # line copied from mpp-solar project (reason?)
-                # log.debug('MTU set')
                 connected = True
+                self.connected = True
+                self.connections += 1
             except Exception:
-                time.sleep(2)     # wait 2s before next connection attempt
+                metrics.observe(CONNECT, self.name, time.perf_counter() - start)
+                metrics.inc('jkbms_connect_failures_total', self.name)
+                self.retryDelay = self.reconnect.failure()
                 continue
+            metrics.observe(CONNECT, self.name, time.perf_counter() - start)
+        metrics.observe(ESTABLISH, self.name, time.perf_counter() - established)
+        log.info('{}: connected after {} attempts in {:.1f}s'.format(self.name, attempts, time.perf_counter() - established))
         return connected
     
-    def getServices(self):            
-            self.services = self.device.getServices()
-            # log.debug("services: %s" % (self.services))
-            for item in self.services:
-                log.debug('service item: %s' % (item))
-                self.characteristic = item.getCharacteristics()
-                # log.debug('  - characteristics: %s' % (self.characteristic))
-                for c in self.characteristic:
-                    log.debug('    -- characteristic item: %s' % (c))
-                self.descriptors = item.getDescriptors()
-                # log.debug('  - descriptors: %s' % (self.descriptors))
-                for d in self.descriptors:
-                    log.debug('    -- descriptor item: %s' % (d))
-            
+    def getServices(self):
+        self.device.getServices()
 
     def getBLEData(self):
         '''# Get the device name
@@ -632,72 +821,201 @@ class jkbms:
         log.debug('Connected to %s' % (deviceName[0]))
         log.debug('Connected to %s' % (deviceName[0].read())) '''
 
+        if self.stream:
+            return self.streamBLEData()
         log.info('Getting BLE Data from {}; MAC: {}'.format(self.name, self.mac))
 
-        # Connect to the notify service
-        serviceNotifyUuid = 'ffe0'
-        serviceNotify = self.device.getServiceByUUID(serviceNotifyUuid)
-
-        # Get the handles that we need to talk to
-        # Read
-        characteristicReadUuid = 'ffe1'     #'ffe3' seems to be an "old" value
-        characteristicRead = serviceNotify.getCharacteristics(characteristicReadUuid)
-        # log.debug('read char. %s' % (characteristicRead))
-        # log.debug('read char. [0] %s' % (characteristicRead[0]))
-        handleRead = characteristicRead[0].getHandle()
-        # log.debug('Read characteristic: {}, handle {:x}'.format(characteristicRead[0], handleRead))
-
-        # ## TODO sort below
-        # Need to dynamically find this handle....
-        # log.debug('Enable 0x0b handle', self.device.writeCharacteristic(0x0b, b'\x01\x00'))
-        self.device.writeCharacteristic(0x0b, b'\x01\x00')
-        # log.debug('Enable read handle', self.device.writeCharacteristic(handleRead, b'\x01\x00'))
-        self.device.writeCharacteristic(handleRead, b'\x01\x00')
-        # log.debug('Write getInfo to read handle', self.device.writeCharacteristic(handleRead, getInfo))
-        self.device.writeCharacteristic(handleRead, getInfo)
-        secs = 0
+        handleRead = self.enableNotifications()
         try:
-            while True:
-                if self.device.waitForNotifications(1.0):
-                    continue
-                secs += 1
-                if secs > 5:
-                    break
+            self.requestInfo(handleRead)
+            # log.debug('Write getCellInfo to read handle', self.device.write(handleRead, getCellInfo))
+            self.device.write(handleRead, getCellInfo)
+            if not self.waitForRecord(CELL_DATA, self.records):
+                log.info('No cell data from {}, connected but not answering'.format(self.name))
+                return(0)   # counted as a failure, the device is reconnected
+            return(1)       # everything ok
         except:
             log.debug('Exception thrown, disconnected? --> return(0)')
             return(0)       # there was a problem while getting the data
 
-        # log.debug('Write getCellInfo to read handle', self.device.writeCharacteristic(handleRead, getCellInfo))
-        self.device.writeCharacteristic(handleRead, getCellInfo)
-        loops = 0
-        recordsToGrab = self.records
-        # log.debug('Grabbing {} records (after inital response)'.format(recordsToGrab))
-
+    def waitForRecord(self, recordType, count=1):
+        '''
+        Wait until `count` complete records (checksum ok) of the given type
+        arrived, at most `requestTimeout` seconds. Returns the number of records.
+        '''
+        delegate = self.delegate
+        start = time.time()
+        deadline = start + self.requestTimeout
+        delegate.firstFragment = None
+        received = delegate.recordCount.get(recordType, 0)
+        while delegate.recordCount.get(recordType, 0) - received < count:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.waitForNotifications(min(remaining, 1.0))
+        end = time.time()
+        received = delegate.recordCount.get(recordType, 0) - received
+        if delegate.firstFragment is None:
+            log.info('{}: no response for record type {} within {}s'.format(self.name, recordType, self.requestTimeout))
+        else:
+            firstFragment = delegate.firstFragment - start
+            complete = end - start
+            self.responseTimes[recordType] = (firstFragment, complete)
+            log.info('{}: record type {}: first fragment after {:.3f}s, {}/{} records complete after {:.3f}s'.format(
+                self.name, recordType, firstFragment, received, count, complete))
+        return received
+
+    def streamBLEData(self):
+        '''
+        Streaming mode: notifications are enabled and the commands are sent once
+        per connection, the BMS then keeps sending cell data records on its own.
+        Returns after each cell data record, the commands are only sent again
+        if the stream stops.
+        '''
         try:
-            while True:
-                loops += 1
-                if loops > recordsToGrab * 15 + 16:
-                    # log.debug('Got {} records'.format(recordsToGrab))
-                    break
-                if self.device.waitForNotifications(1.0):
-                    continue
-            return(1)       # everything ok
+            if not self.subscribed:
+                log.info('Subscribing to BLE Data from {}; MAC: {}'.format(self.name, self.mac))
+                self.subscribe()
+            lastRecord = self.delegate.lastRecord.get(CELL_DATA, 0)
+            deadline = time.time() + self.streamTimeout
+            while time.time() < deadline:
+                self.waitForNotifications(1.0)
+                if self.delegate.lastRecord.get(CELL_DATA, 0) != lastRecord:
+                    self.stalled = False
+                    return(1)   # got a new record
+            if self.stalled:
+                log.info('No data from {} after resending the commands'.format(self.name))
+                return(0)
+            log.info('Stream from {} stopped, resending commands'.format(self.name))
+            self.stalled = True
+            self.subscribe()
+            return(1)
         except:
             log.debug('Exception thrown, disconnected? --> return(0)')
             return(0)       # there was a problem while getting the data
-            
+
+    def subscribe(self):
+        # enable notifications and start the stream of cell data records
+        handleRead = self.enableNotifications()
+        self.requestInfo(handleRead)
+        self.device.write(handleRead, getCellInfo)
+        self.subscribed = True
+
+    def requestInfo(self, handleRead):
+        # the info record is only requested once per connection and after a restart of the BMS
+        if self.infoValid:
+            return
+        # log.debug('Write getInfo to read handle', self.device.write(handleRead, getInfo))
+        self.device.write(handleRead, getInfo)
+        self.waitForRecord(INFO_RECORD)
+
+    def waitForNotifications(self, timeout):
+        # time spent waiting for the BMS, the processing of the notifications is measured by the delegate
+        start = time.perf_counter()
+        busy = self.delegate.busy
+        if self.reassembler.valid:
+            # the fragments of a record come within milliseconds, a short silence ends it
+            timeout = min(timeout, FLUSH_IDLE)
+        result = self.device.waitForNotifications(timeout)
+        if not result:
+            self.delegate.flush()
+        metrics.observe(WAIT, self.name, time.perf_counter() - start - (self.delegate.busy - busy))
+        return result
+
+    def enableNotifications(self):
+        '''
+        Enable the notifications once per connection, returns the handle for
+        the commands. The GATT discovery only runs without a cached entry, or
+        when a write with the cached handles fails.
+        '''
+        if self.notifying:
+            return self.handles.write
+        cached = self.handles is not None
+        if not cached:
+            start = time.perf_counter()
+            self.handles = self.device.discoverHandles()
+            self.handlesFirmware = None
+            metrics.observe(DISCOVERY, self.name, time.perf_counter() - start)
+            metrics.inc('jkbms_handle_discoveries_total', self.name)
+        try:
+            # log.debug('Enable notifications', self.device.write(self.handles.cccd, b'\x01\x00'))
+            self.device.write(self.handles.cccd, b'\x01\x00')
+            # log.debug('Enable read handle', self.device.write(handleRead, b'\x01\x00'))
+            self.device.write(self.handles.notify, b'\x01\x00')
+        except Exception:
+            if not cached:
+                raise
+            log.info('{}: write with the cached GATT handles failed, discovering them again'.format(self.name))
+            self.handles = None
+            self.handleCache.remove(self.mac)
+            return self.enableNotifications()
+        self.notifying = True
+        return self.handles.write
+
+    def checkHandles(self, firmware):
+        # called with the firmware of every info record: discovered handles are stored with it,
+        # handles cached for another firmware are discovered again
+        if self.handles is None or self.handlesFirmware == firmware:
+            return
+        if self.handlesFirmware is None:
+            self.handleCache.store(self.mac, firmware, self.handles)
+            self.handlesFirmware = firmware
+            return
+        log.info('{}: firmware {} -> {}, discovering the GATT handles again'.format(self.name, self.handlesFirmware, firmware))
+        self.handleCache.remove(self.mac)
+        self.handles = None
+        self.notifying = False
+
+    def setSwitch(self, switch, on):
+        # switch the charge / discharge MOSFETs or the balancer, see jkbms_protocol.SWITCHES
+        log.info('{}: switching {} {}'.format(self.name, switch, 'on' if on else 'off'))
+        handleRead = self.enableNotifications()
+        self.device.write(handleRead, switchCommand(switch, on))
+        # read the settings (with the switch states) again with the next getCellInfo,
+        # a stream is subscribed again for that
+        self.settingsValid = False
+        self.subscribed = False
 
     def disconnect(self):
         log.debug('Disconnecting...')
         self.device.disconnect()
 
+    def flushAggregate(self):
+        # publish the partial window of the aggregation when the device stops
+        if self.aggregator is None:
+            return
+        aggregate = self.aggregator.flush()
+        if aggregate is not None:
+            self.delegate.publishAggregate(aggregate)
+
+    def collectMetrics(self):
+        # values kept by the reassembler, the delegate and the publish cache, see jkbms_metrics
+        device = {'device': self.name}
+        values = []
+        for recordType, count in sorted(self.recordCount.items()):
+            values.append(('jkbms_frames_total', 'counter', 'Complete records with a valid checksum',
+                           {'device': self.name, 'type': recordType}, count))
+        reassembler = self.reassembler
+        values.append(('jkbms_crc_failures_total', 'counter', 'Incomplete records or records with a checksum error', device, reassembler.partialFrames))
+        values.append(('jkbms_resyncs_total', 'counter', 'Data skipped to find the next start of record', device, reassembler.resyncs))
+        values.append(('jkbms_dropped_bytes_total', 'counter', 'Bytes dropped by the reassembler', device, reassembler.droppedBytes))
+        values.append(('jkbms_published_values_total', 'counter', 'Values sent to mqtt', device, self.publishCache.published))
+        values.append(('jkbms_suppressed_values_total', 'counter', 'Values suppressed by the publish cache', device, self.publishCache.suppressed))
+        return values
+
 
 
 # ---
 # The callback for when the mqtt client receives a CONNACK response from the server.
 # ---
+mqttRecovery = ReconnectPolicy('mqtt')  # only the incidents, paho retries with its own backoff
+
 def on_connect(client, userdata, flags, rc):
     log.info("MQTT Connected with result code "+str(rc))
+    if rc == 0:
+        mqttRecovery.success()
+    else:
+        mqttRecovery.failure()
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
@@ -705,6 +1023,14 @@ def on_connect(client, userdata, flags, rc):
     # client.subscribe("HM-Control/AutoControl")
 
 
+# ---
+# The callback for a lost broker connection, a BMS keeps its BLE connection and the messages are spooled
+# ---
+def on_disconnect(client, userdata, rc):
+    if rc != 0:
+        mqttRecovery.failure()
+
+
 # ---
 # The callback for when a PUBLISH message is received from the mqtt server.
 # ---
@@ -713,22 +1039,6 @@ def on_message(client, userdata, msg):
     log.debug(msg.topic+" "+str(msg.payload))
     
 
-# ---
-# caclulate crc8 checksum
-# ---
-def crc8(byteData):
-    '''
-    Generate 8 bit CRC of supplied string
-    '''
-    CRC = 0
-    # for j in range(0, len(str),2):
-    for b in byteData:
-        # char = int(str[j:j+2], 16)
-        # log.debug(b)
-        CRC = CRC + b
-        CRC &= 0xff
-    return CRC
-
 # ---
 # Decode the first byte of a hexString to int
 # ---
@@ -787,6 +1097,12 @@ def Hex2uptime(byteData):
         # b = byteData.pop(0)
         value += b * 256 ** x
         # log.debug(f"Uptime int value {value} for pos {x}")
+    return seconds2uptime(value)
+
+# ---
+# Format a number of seconds as JKBMS uptime string
+# ---
+def seconds2uptime(value):
     daysFloat = value / (60 * 60 * 24)
     days = math.trunc(daysFloat)
     hoursFloat = (daysFloat - days) * 24
@@ -799,6 +1115,258 @@ def Hex2uptime(byteData):
     # log.debug(f"Uptime result {uptime}")
     return uptime
 
+# ---
+# layout of the 2 byte cell data record (type 0x02), little endian
+# all offsets are relative to the start of the record (incl. the 'SOR' header)
+# ---
+CELL_COUNT = 24
+RESISTANCE_COUNT = 25
+CELL_DATA_02 = Struct('<'
+    '4x'        # 0   SOR 55aaeb90
+    'B'         # 4   record type
+    'B'         # 5   record counter
+    '24h'       # 6   cell voltages [mV]
+    '2h'        # 54  unknown1, unknown2
+    'h'         # 58  avg. cell voltage [mV]
+    'h'         # 60  delta cell voltage [mV]
+    'h'         # 62  balancer current [mA]
+    '25h'       # 64  cell wire resistances [mOhm]
+    '2h'        # 114 unknown4, unknown5
+    'I'         # 118 pack voltage [mV]
+    'I'         # 122 pack power [mW]
+    'i'         # 126 pack current [mA]
+    '3h'        # 130 temp. sensor #1, #2, MOS temp. [0.1 degC]
+    '2h'        # 136 unknown6, unknown7
+    'B'         # 140 unknown8
+    'B'         # 141 pack SOC [%]
+    'I'         # 142 remaining capacity [mAh]
+    'I'         # 146 nominal capacity [mAh]
+    'I'         # 150 cycle count
+    'I'         # 154 cycle capacity [mAh]
+    '2h'        # 158 unknown9, unknown10
+    '3B'        # 162 uptime [s], 3 bytes
+    '12h'       # 165 unknown11 ... unknown22
+    'h'         # 189 charge current? [mA]
+    'h'         # 191 discharge current? [mA]
+    '7h'        # 193 unknown23 ... unknown29 (further 93 bytes ignored)
+    )
+
+# index of the first value of each group in the tuple returned by CELL_DATA_02
+_CD_COUNTER = 1
+_CD_VOLTS = 2
+_CD_AVG = _CD_VOLTS + CELL_COUNT + 2
+_CD_RESISTANCES = _CD_AVG + 3
+_CD_PACK = _CD_RESISTANCES + RESISTANCE_COUNT + 2
+_CD_SOC = _CD_PACK + 3 + 3 + 2 + 1
+_CD_CAPA = _CD_SOC + 1
+_CD_UPTIME = _CD_CAPA + 4 + 2
+_CD_CHARGE = _CD_UPTIME + 3 + 12
+
+# precomputed keys / topics, so they are not formatted for every record
+CELL_KEYS = ['B{:d}'.format(cell + 1) for cell in range(CELL_COUNT)]
+RESISTANCE_KEYS = ['R{:d}'.format(cell + 1) for cell in range(RESISTANCE_COUNT)]
+VOLTAGE_TOPICS = ['/CellData/VoltageCell_{:02d}'.format(cell + 1) for cell in range(CELL_COUNT)]
+RESISTANCE_TOPICS = ['/CellData/ResistanceCell_{:02d}'.format(cell) for cell in range(RESISTANCE_COUNT)]
+
+# published pack values: topic / json name, CellData field
+CELL_DATA_VALUES = (
+    ('AvgCellVoltage', 'avgcellvoltage'),
+    ('DeltaCellVoltage', 'deltacellvoltage'),
+    ('BalancerCurrent', 'balancercurrent'),
+    ('PackVoltage', 'packvoltage'),
+    ('PackPower', 'packpower'),
+    ('PackCurrent', 'packcurrent'),
+    ('PackTemp_1', 'packtemp1'),
+    ('PackTemp_2', 'packtemp2'),
+    ('MOSTemp', 'mostemp'),
+    ('PackSOC', 'soc'),
+    ('CapaNominal', 'capanominal'),
+    ('CycleCount', 'cyclecount'),
+    ('CapaCycled', 'capacycle'),
+    ('BMSUptime', 'uptime'),
+    ('ChargeCurrent', 'charge'),
+    ('DischargeCurrent', 'discharge'),
+    )
+
+CellData = namedtuple('CellData', [
+    'counter', 'volts', 'avgcellvoltage', 'deltacellvoltage', 'balancercurrent',
+    'resistances', 'packvoltage', 'packpower', 'packcurrent', 'packtemp1', 'packtemp2',
+    'mostemp', 'soc', 'caparemaining', 'capanominal', 'cyclecount', 'capacycle',
+    'uptimeseconds', 'uptime', 'charge', 'discharge'])
+
+# offset of the 3 byte uptime in CELL_DATA_02
+_CD_UPTIME_OFFSET = 162
+
+def cellDataUptime(record):
+    # uptime [s] of a cell data record without decoding the rest
+    return record[_CD_UPTIME_OFFSET] | (record[_CD_UPTIME_OFFSET + 1] << 8) | (record[_CD_UPTIME_OFFSET + 2] << 16)
+
+# ---
+# Decode a 2 byte cell data record in a single pass (no copies of the record)
+# ---
+def decodeCellDataRecord02(record):
+    '''
+    Decode a complete 2 byte format cell data record into a CellData tuple
+    '''
+    v = CELL_DATA_02.unpack_from(record)
+    uptimeseconds = v[_CD_UPTIME] + (v[_CD_UPTIME + 1] << 8) + (v[_CD_UPTIME + 2] << 16)
+    return CellData(
+        counter=v[_CD_COUNTER],
+        volts=tuple([x / 1000.0 for x in v[_CD_VOLTS:_CD_VOLTS + CELL_COUNT]]),
+        avgcellvoltage=v[_CD_AVG] / 1000.0,
+        deltacellvoltage=float(v[_CD_AVG + 1]),
+        balancercurrent=v[_CD_AVG + 2] / 1000.0,
+        resistances=tuple([x / 1000.0 for x in v[_CD_RESISTANCES:_CD_RESISTANCES + RESISTANCE_COUNT]]),
+        packvoltage=v[_CD_PACK] / 1000.0,
+        packpower=v[_CD_PACK + 1] / 1000.0,
+        packcurrent=v[_CD_PACK + 2] / 1000.0,
+        packtemp1=v[_CD_PACK + 3] / 10.0,
+        packtemp2=v[_CD_PACK + 4] / 10.0,
+        mostemp=v[_CD_PACK + 5] / 10.0,
+        soc=v[_CD_SOC],
+        caparemaining=v[_CD_CAPA] / 1000.0,
+        capanominal=v[_CD_CAPA + 1] / 1000.0,
+        cyclecount=float(v[_CD_CAPA + 2]),
+        capacycle=v[_CD_CAPA + 3] / 1000.0,
+        uptimeseconds=uptimeseconds,
+        uptime=seconds2uptime(uptimeseconds),
+        charge=v[_CD_CHARGE] / 1000.0,
+        discharge=v[_CD_CHARGE + 1] / 1000.0)
+
+# ---
+# layout of the info record (type 0x03), fixed size fields, strings are padded with 0x00
+# ---
+INFO_RECORD_DATA = Struct('<'
+    '4x'        # 0   SOR 55aaeb90
+    'B'         # 4   record type
+    'B'         # 5   record counter
+    '16s'       # 6   vendor id
+    '8s'        # 22  hardware version
+    '8s'        # 30  software version
+    'I'         # 38  uptime [s]
+    'I'         # 42  power up times
+    '16s'       # 46  device name
+    '16s'       # 62  pass code
+    )
+
+InfoData = namedtuple('InfoData', [
+    'counter', 'vendorID', 'hardwareVersion', 'softwareVersion', 'uptime',
+    'powerUpTimes', 'deviceName', 'passCode'])
+
+# last info record per mac, the content only changes if the BMS restarts
+infoCache = {}
+
+# ---
+# Decode an info record in a single pass
+# ---
+def decodeInfoRecord(record):
+    '''
+    Decode a complete info record into an InfoData tuple
+    '''
+    v = INFO_RECORD_DATA.unpack_from(record)
+    text = [field.split(b'\x00', 1)[0].decode('utf-8', 'replace') for field in (v[2], v[3], v[4], v[7], v[8])]
+    return InfoData(
+        counter=v[1],
+        vendorID=text[0],
+        hardwareVersion=text[1],
+        softwareVersion=text[2],
+        uptime=v[5],
+        powerUpTimes=v[6],
+        deviceName=text[3],
+        passCode=text[4])
+
+# ---
+# layout of the settings record (type 0x01) of the JK02 protocol: 4 byte little
+# endian values from offset 10, then the 24 cell wire resistances from offset 142
+# ---
+SETTINGS_VALUES = (
+    # topic name                field                       scale       offset
+    ('CellUVP',                 'cellUVP',                  0.001),     # 10  V
+    ('CellUVPRecovery',         'cellUVPRecovery',          0.001),     # 14  V
+    ('CellOVP',                 'cellOVP',                  0.001),     # 18  V
+    ('CellOVPRecovery',         'cellOVPRecovery',          0.001),     # 22  V
+    ('BalanceTriggerVoltage',   'balanceTriggerVoltage',    0.001),     # 26  V
+    ('SOC100Voltage',           'soc100Voltage',            0.001),     # 30  V
+    ('SOC0Voltage',             'soc0Voltage',              0.001),     # 34  V
+    ('ChargeVoltage',           'chargeVoltage',            0.001),     # 38  V, request charge voltage
+    ('FloatVoltage',            'floatVoltage',             0.001),     # 42  V, request float voltage
+    ('PowerOffVoltage',         'powerOffVoltage',          0.001),     # 46  V
+    ('MaxChargeCurrent',        'maxChargeCurrent',         0.001),     # 50  A
+    ('ChargeOCPDelay',          'chargeOCPDelay',           1),         # 54  s
+    ('ChargeOCPRecovery',       'chargeOCPRecovery',        1),         # 58  s
+    ('MaxDischargeCurrent',     'maxDischargeCurrent',      0.001),     # 62  A
+    ('DischargeOCPDelay',       'dischargeOCPDelay',        1),         # 66  s
+    ('DischargeOCPRecovery',    'dischargeOCPRecovery',     1),         # 70  s
+    ('SCPRecovery',             'scpRecovery',              1),         # 74  s
+    ('MaxBalanceCurrent',       'maxBalanceCurrent',        0.001),     # 78  A
+    ('ChargeOTP',               'chargeOTP',                0.1),       # 82  °C
+    ('ChargeOTPRecovery',       'chargeOTPRecovery',        0.1),       # 86  °C
+    ('DischargeOTP',            'dischargeOTP',             0.1),       # 90  °C
+    ('DischargeOTPRecovery',    'dischargeOTPRecovery',     0.1),       # 94  °C
+    ('ChargeUTP',               'chargeUTP',                0.1),       # 98  °C, signed
+    ('ChargeUTPRecovery',       'chargeUTPRecovery',        0.1),       # 102 °C, signed
+    ('MOSOTP',                  'mosOTP',                   0.1),       # 106 °C
+    ('MOSOTPRecovery',          'mosOTPRecovery',           0.1),       # 110 °C
+    ('CellCount',               'cellCount',                1),         # 114
+    ('ChargeSwitch',            'chargeSwitch',             1),         # 118 0 / 1
+    ('DischargeSwitch',         'dischargeSwitch',          1),         # 122 0 / 1
+    ('BalancerSwitch',          'balancerSwitch',           1),         # 126 0 / 1
+    ('CapaNominal',             'capaNominal',              0.001),     # 130 Ah
+    ('SCPDelay',                'scpDelay',                 1),         # 134 us
+    ('BalanceStartVoltage',     'balanceStartVoltage',      0.001),     # 138 V
+    )
+WIRE_RESISTANCE_COUNT = 24
+WIRE_RESISTANCE_TOPICS = ['/Settings/WireResistance_{:02d}'.format(cell + 1) for cell in range(WIRE_RESISTANCE_COUNT)]
+
+SETTINGS_RECORD = Struct('<5xB4x{}i{}i'.format(len(SETTINGS_VALUES), WIRE_RESISTANCE_COUNT))
+
+SettingsData = namedtuple('SettingsData', ['counter'] + [field for _, field, _ in SETTINGS_VALUES] + ['wireResistances'])
+
+# last decoded settings record per mac
+settingsCache = {}
+
+# ---
+# decode the settings record
+# ---
+def decodeSettingsRecord(record):
+    '''
+    Decode a complete settings record into a SettingsData tuple, voltages
+    in V, currents in A, temperatures in °C, wire resistances in Ohm
+    '''
+    v = SETTINGS_RECORD.unpack_from(record)
+    values = [value if scale == 1 else round(value * scale, 3) for (_, _, scale), value in zip(SETTINGS_VALUES, v[1:])]
+    resistances = tuple(round(value * 0.001, 3) for value in v[1 + len(SETTINGS_VALUES):])
+    return SettingsData(v[0], *values, wireResistances=resistances)
+
+# ---
+# layout of the 4 byte cell data record, 24 cell voltages and 25 cell wire
+# resistances, each value in the 4 byte format decoded by decodeHex
+# ---
+CELL_DATA_04 = Struct('<4xBB{}B'.format(4 * (CELL_COUNT + RESISTANCE_COUNT)))
+
+# decodeHex as tables: byte 3 is the exponent, bytes 2..0 add fractions of it.
+# All terms are small multiples of powers of 2, so the sums are exact and the
+# result is bit for bit the one of decodeHex
+_HEX_EXPONENT = [0.0] + [2.0 ** ((byte - 0x40) * 2 + 1) for byte in range(1, 256)]
+_HEX_BYTE2 = [(((byte >> 4) - 8) / 4.0 + 1.0 if byte & 0x80 else (byte >> 4) / 8.0) + (byte & 0xf) / 128.0
+              for byte in range(256)]
+_HEX_BYTE1 = [(byte >> 4) / 2048.0 + (byte & 0xf) / 32768.0 for byte in range(256)]
+_HEX_BYTE0 = [(byte >> 4) / 524288.0 + (byte & 0xf) / 8388608.0 for byte in range(256)]
+
+# ---
+# Decode a 4 byte cell data record in one batch
+# ---
+def decodeCellDataRecord04(record):
+    '''
+    Decode a complete 4 byte format cell data record,
+    returns (counter, cell voltages, cell wire resistances)
+    '''
+    v = CELL_DATA_04.unpack_from(record)
+    exponent, byte2, byte1, byte0 = _HEX_EXPONENT, _HEX_BYTE2, _HEX_BYTE1, _HEX_BYTE0
+    values = [exponent[b3] * (((1.0 + byte2[b2]) + byte1[b1]) + byte0[b0]) if b3 else 0
+              for b0, b1, b2, b3 in zip(v[2::4], v[3::4], v[4::4], v[5::4])]
+    return v[1], values[:CELL_COUNT], values[CELL_COUNT:]
+
 # ---
 #  decodeHex values
 # ---
@@ -879,6 +1447,112 @@ def decodeHex(hexToDecode):
     return answer
 
 
+# --------------------------------------------------------------------------- #
+# configure the client logging
+# --------------------------------------------------------------------------- #
+def setupLogging(args, logName):
+    log.setLevel(logging.WARNING)
+    # create file handler which logs even debug messages
+    fh = logging.handlers.TimedRotatingFileHandler(logName,'D', 1, 5)
+    fh.setLevel(logging.INFO)
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.ERROR)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
+    # add the handlers to the logger
+    log.addHandler(fh)
+    log.addHandler(ch)
+
+    if args.info: # switch to info level
+        log.setLevel(logging.INFO)
+        ch.setLevel(logging.INFO)
+        fh.setLevel(logging.INFO)
+
+    if args.debug: # switch to debug level
+        # create formatter and add it to the handlers
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(threadName)s - '
+                                        '%(levelname)s - %(module)s:%(lineno)s - %(message)s')
+        fh.setFormatter(formatter)
+        ch.setFormatter(formatter)
+
+        log.setLevel(logging.DEBUG)
+        ch.setLevel(logging.DEBUG)
+        fh.setLevel(logging.DEBUG)
+
+
+# ---
+# parse arguments
+# ---
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description = 'Victron modbus control test')
+    parser.add_argument('--version', action='version', version='%(prog)s v')
+    parser.add_argument('--debug', action="store_true", help='enable DEBUG logging')
+    parser.add_argument('--info', action="store_true", help='enable INFO logging')
+    parser.add_argument('--name', default='defaultName', type=str, help='set the device name (informative)')
+    parser.add_argument('--mac', type=str, help='set the device name (informative)')
+    # parser.add_argument('--max', action="store_true", help='set the output of all MIs to 100 percent')
+    # parser.add_argument('--min', action="store_true", help='set the output of all MIs to 2 percent')
+    # parser.add_argument('--on', action="store_true", help='switch all MIs ON')
+    # parser.add_argument('--off', action="store_true", help='switch all MIs OFF')
+    # parser.add_argument('--mqtt', action="store_true", help= 'enable mqtt data output')
+    requiredArguments = parser.add_argument_group('required arguments')
+    parser.add_argument('--bms', default=[1], type=int, nargs='+', help='set the device number(s) to be queried (required)')
+    parser.add_argument('--all', action="store_true", help='query all configured devices')
+    parser.add_argument('--config', type=str,
+                        help='device registry (ini file, see jkbms_registry.py) instead of --bms / --all, reloaded on change or SIGHUP')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='threads polling the devices (0: one per device), streaming devices have their own thread')
+    parser.add_argument('--discovery', type=str,
+                        help='discovery cache of ble_scanner.py (jkbms_discovery.json), only devices seen by the scanner are connected')
+    parser.add_argument('--discovery-age', default=180.0, type=float,
+                        help='devices not seen by the scanner for DISCOVERY_AGE seconds are not connected')
+    parser.add_argument('--handle-cache', default='jkbms_handles.json', type=str,
+                        help='GATT handles per BMS and firmware, connections skip the service discovery (empty: keep them in memory only)')
+    parser.add_argument('--settings-interval', default=3600, type=int,
+                        help='decode the settings record again after SETTINGS_INTERVAL seconds (it is also read after a reconnect and a switch command)')
+    parser.add_argument('--queue', default=64, type=int,
+                        help='records waiting for the publisher thread (0: decode and publish in the BLE callback)')
+    parser.add_argument('--queue-policy', default=COALESCE, choices=POLICIES,
+                        help='full queue: drop the oldest record, or replace the queued record of the same BMS and type')
+    parser.add_argument('--retry-quick', default=2, type=int, help='reconnect attempts without delay after a BLE failure')
+    parser.add_argument('--retry-base', default=2.0, type=float, help='first backoff delay in seconds, doubled with each further failure')
+    parser.add_argument('--retry-cap', default=120.0, type=float, help='maximum delay between reconnect attempts in seconds (BLE and mqtt)')
+    parser.add_argument('--format', default='mqtt', choices=FORMATS,
+                        help='mqtt: one topic per value, json: one json document per record on <tag>/CellData, binary: one packed struct per record (jkbms_payload.py)')
+    parser.add_argument('--stream', action="store_true",
+                        help='keep the connection subscribed and publish every record the BMS sends')
+    parser.add_argument('--refresh', default=300, type=int,
+                        help='publish all values every REFRESH seconds, unchanged values are suppressed in between (0: publish always)')
+    parser.add_argument('--metrics-port', type=int, help='serve timing metrics (prometheus text format) on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-socket', type=str, help='serve the timing metrics on this unix socket instead')
+    parser.add_argument('--aggregate', default=0, type=float,
+                        help='publish min / max / mean / last of cell voltages, temperatures and current per AGGREGATE seconds (0: off)')
+    parser.add_argument('--raw-interval', type=float,
+                        help='publish the raw values at most every RAW_INTERVAL seconds (default: every record, with --aggregate once per window)')
+    parser.add_argument('--energy', default=0, type=float,
+                        help='count charged / discharged Wh and Ah per day and in total, published every ENERGY seconds on <tag>/Energy (0: off)')
+    parser.add_argument('--energy-dir', type=str, help='keep the energy totals in json files in this directory, so they survive a restart')
+    parser.add_argument('--energy-gap', default=120.0, type=float,
+                        help='longer intervals between two records are not integrated (must be longer than the poll interval)')
+    parser.add_argument('--spool-file', default='jkbms_ble.spool', type=str,
+                        help='messages that do not fit the memory spool while the broker is not connected are written here (empty: drop them)')
+    parser.add_argument('--spool-memory', default=10000, type=int, help='messages kept in memory while the broker is not connected')
+    parser.add_argument('--spool-size', default=50, type=int, help='maximum size of the spool file in MB')
+    parser.add_argument('--spool-rate', default=5.0, type=float, help='batches of spooled messages sent per second after the broker is back')
+    parser.add_argument('--record', type=str, help='append every BLE notification to this capture file')
+    parser.add_argument('--replay', type=str, help='publish the notifications of this capture file instead of polling the BMS')
+    parser.add_argument('--replay-speed', default=1.0, type=float, help='replay speed, 1: real time')
+    parser.add_argument('--replay-fast', action="store_true", help='replay as fast as possible')
+    parser.add_argument('--history', default=0, type=int,
+                        help='keep the cell data history in HISTORY kB per BMS (0: off), served on /history of the metrics port')
+    parser.add_argument('--history-retention', default=4.0, type=float, help='hours of history returned by queries')
+    parser.add_argument('--history-dir', type=str, help='keep the history in memory mapped files in this directory, so it survives a restart')
+
+    return parser.parse_args(argv)
+
 # ---
 # startup sequence to reset everything to "normal" if script was interrupted in an undefined state
 # ---
@@ -890,68 +1564,416 @@ def startupSequence():
 # ---
 # setup mqtt client
 # ---
-mqttClient = mqtt.Client()
-mqttClient.on_connect = on_connect
-mqttClient.on_message = on_message
+mqttClient = None       # set by setupMQTT(), or replaced by jkbms_sim.MQTTSink
+recorder = None         # CaptureWriter with --record
+discovery = None        # DiscoveryCache with --discovery
+handleCache = None      # HandleCache of --handle-cache
+recordQueue = None      # RecordQueue of the publisher thread with --queue
+
+def setupMQTT(args):
+    global mqttClient
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    client.reconnect_delay_set(min_delay=1, max_delay=int(args.retry_cap))
+
+    # client.enable_logger(logger=log)
+    client.disable_logger()
+    # connect in the background, a broker that is not reachable at boot must not stop the BMS polling;
+    # until it is connected (and during later outages) the messages go to the spool
+    client.connect_async(BROKER, PORT)
+    mqttClient = SpoolingClient(client, filename=args.spool_file or None, memory=args.spool_memory,
+                                fileSize=args.spool_size * 1024 * 1024, rate=args.spool_rate)
+    mqttClient.loop_start()
 
-# mqttClient.enable_logger(logger=log)
-mqttClient.disable_logger()
-mqttClient.connect(BROKER, PORT)
-mqttClient.loop_start()
+
+# ---
+# publisher thread: decode and publish a record of the RecordQueue
+# ---
+def publishRecord(item):
+    delegate, record, received = item
+    delegate.processRecord(record, received)
 
 
 # ---
-# main part of the script
+# mqtt values for the metrics endpoint
 # ---
-if __name__ == "__main__":
+def collectMQTTMetrics():
+    # messages queued in the paho client and not yet written to the socket (paho internal)
+    client = getattr(mqttClient, 'client', mqttClient)
+    depth = len(getattr(client, '_out_packet', ()))
+    values = [('jkbms_mqtt_queue_depth', 'gauge', 'Messages waiting in the mqtt client', {}, depth)]
+    if isinstance(mqttClient, SpoolingClient):
+        values += mqttClient.collectMetrics()
+    return values
 
-    interval = 60.0
-    lastrun = time.time() - 55
-
-    while True:
-        try:            
-            log.info("Startup; wait 10s to initialize communication")
-            time.sleep(10)      # wait 10s to give mqtt connection time to initiates
-            startupSequence()   # make shure after 1st start everything is in order
-            
-            # connect to devices and get service information
-            i = listitem
-            if i < len(namelist):
-                bms = jkbms(name=namelist[i], model=model, mac=maclist[i], command=command, tag=taglist[i], format=format, records=1, maxConnectionAttempts=30)
-                    # log.debug('peripheral device info: %s' %(bms))
-                
-                if bms.connect():
-                    log.info('Connected to {}'.format(namelist[i]))
-                else:
-                    log.info('Failed to connect to {} {}'.format(namelist[i], maclist[i]))
-                
-                while True:
-                    if bms.getBLEData():
-                        time.sleep(1)
-                    else:
-                        log.info('got 0 back from getBLEData(), try reconnecting... {}'.format(namelist[i]))
-                        if bms.connect():           # try reconnecting to the BLE-service
-                            log.info('Re-Connected to {}'.format(namelist[i]))
-                        else:
-                            log.info('Reconnect to {} has failed!'.format(namelist[i]))
+
+# ---
+# history of the cell data
+# ---
+histories = {}          # device name -> HistoryStore
+
+def createHistory(args, name):
+    filename = None
+    if args.history_dir:
+        filename = os.path.join(args.history_dir, '{}.history'.format(name))
+    histories[name] = HistoryStore(cellDataColumns(CELL_COUNT, RESISTANCE_COUNT, CELL_DATA_VALUES),
+                                   budget=args.history * 1024, retention=args.history_retention * 3600,
+                                   filename=filename)
+    return histories[name]
+
+# ---
+# energy and charge counting
+# ---
+energyCounters = {}     # device name -> EnergyCounter
+
+def createEnergyCounter(args, name):
+    filename = None
+    if args.energy_dir:
+        filename = os.path.join(args.energy_dir, '{}.energy.json'.format(name))
+    energyCounters[name] = EnergyCounter(filename, maxGap=args.energy_gap, interval=args.energy)
+    return energyCounters[name]
+
+def historyPage(params):
+    '''
+    /history: list of devices and fields
+    /history?device=NAME&field=VoltageCell_01[&start=T][&end=T]: time stamps and values, start / end in epoch seconds
+    '''
+    if 'device' not in params:
+        return 'application/json', json.dumps(dict((name, store.names) for name, store in histories.items()))
+    store = histories[params['device'][0]]
+    field = params['field'][0]
+    start = float(params['start'][0]) if 'start' in params else None
+    end = float(params['end'][0]) if 'end' in params else None
+    times, values = store.query(field, start, end)
+    return 'application/json', json.dumps({'device': params['device'][0], 'field': field, 'times': times, 'values': values})
+
+
+# ---
+# replay of a capture file
+# ---
+def replayDevice(args, mac, clock):
+    # jkbms instance for a mac of the capture, configured devices keep their name and tag
+    configs = [config for config in devices.values() if config.mac == mac]
+    if configs:
+        name, tag = configs[0].name, configs[0].tag
+    elif mac in maclist:
+        i = maclist.index(mac)
+        name, tag = namelist[i], taglist[i]
+    else:
+        name, tag = mac, 'JKBMS_' + mac.replace(':', '')
+    history = createHistory(args, name) if args.history else None
+    energy = createEnergyCounter(args, name) if args.energy else None
+    bms = jkbms(name=name, model=model, mac=mac, command=command, tag=tag, format=args.format,
+                refreshInterval=args.refresh, transport=ReplayTransport, history=history, energy=energy,
+                aggregate=args.aggregate, rawInterval=args.raw_interval)
+    bms.delegate = BLEDelegate(bms)
+    bms.delegate.clock = clock
+    metrics.addCollector(bms.collectMetrics)
+    return bms
+
+def replayCapture(args):
+    '''
+    Feed a capture file through reassembly, decode and publish, in real time
+    (scaled by --replay-speed) or as fast as possible. The records get the
+    time stamps of the capture.
+    '''
+    devices = {}
+    replayTime = [0.0]
+    clock = lambda: replayTime[0]
+    fragments = 0
+    start = None
+    lastFragment = {}
+    for timestamp, mac, data in readCapture(args.replay):
+        if start is None:
+            start = (timestamp, time.time())
+        if not args.replay_fast:
+            delay = start[1] + (timestamp - start[0]) / args.replay_speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        bms = devices.get(mac)
+        if bms is None:
+            bms = devices[mac] = replayDevice(args, mac, clock)
+        if timestamp - lastFragment.get(mac, timestamp) >= FLUSH_IDLE:
+            bms.delegate.flush()        # as after an idle wait of the live device
+        lastFragment[mac] = timestamp
+        replayTime[0] = timestamp
+        bms.delegate.handleNotification(0, data)
+        fragments += 1
+    for bms in devices.values():
+        bms.delegate.flush()
+        bms.flushAggregate()
+        log.info('Replay {}: records {}, published {}, suppressed {}'.format(
+            bms.name, bms.recordCount, bms.publishCache.published, bms.publishCache.suppressed))
+    log.info('Replayed {} notifications of {} devices from {}'.format(fragments, len(devices), args.replay))
+    return devices
+
+
+# ---
+# poll loop for one streaming BMS, runs in its own thread
+# ---
+def pollBMS(bms):
+    while bms.running:
+        try:
+            if bms.connect():
+                log.info('Connected to {}'.format(bms.name))
             else:
-                log.error('There are only {} devices selectable! --bms must be <= number of devices.'.format(len(namelist)))
-                exit()       
-        
+                # failed (retryDelay is the backoff) or not seen by the scanner (retryDelay is short)
+                log.info('Failed to connect to {} {}'.format(bms.name, bms.mac))
+                time.sleep(bms.retryDelay)
+                continue
+
+            while bms.running:
+                if not bms.connected:
+                    if bms.connect():           # try reconnecting to the BLE-service
+                        log.info('Re-Connected to {}'.format(bms.name))
+                    else:
+                        # nothing to read, wait for the backoff (or the discovery recheck) and try again
+                        log.info('Reconnect to {} has failed!'.format(bms.name))
+                        time.sleep(bms.retryDelay)
+                        continue
+                if bms.getBLEData():
+                    if not bms.stream:
+                        time.sleep(1)
+                else:
+                    log.info('got 0 back from getBLEData(), try reconnecting... {}'.format(bms.name))
+                    bms.connected = False
+                    try:
+                        bms.disconnect()        # the device may still be connected, but not answering
+                    except Exception:
+                        pass
+                    time.sleep(bms.reconnect.failure())     # no delay for the first retries
 
         except:
-            log.error('exeption raised waiting for 2 minutes before retrying')
+            delay = bms.reconnect.failure()
+            log.error('exeption raised for {}, retrying in {:.0f}s'.format(bms.name, delay))
             log.exception(sys.exc_info())
-            # raise
+            try:
+                bms.disconnect()
+            except Exception:
+                pass
+            time.sleep(delay)
+    releaseDevice(bms)
+
+
+# ---
+# one poll of a BMS for the scheduler, returns the time of the next poll
+# ---
+def pollDevice(bms, due):
+    try:
+        if not bms.connected:
+            # one attempt, the scheduler waits for the delay of the reconnect policy, not the worker
+            if bms.connect(maxAttempts=1):
+                log.info('Connected to {}'.format(bms.name))
+            else:
+                log.info('Failed to connect to {} {}, next attempt in {:.1f}s'.format(bms.name, bms.mac, bms.retryDelay))
+                return time.time() + bms.retryDelay
+        if bms.getBLEData():
+            # keep the deadlines, unless the poll took longer than the interval
+            return max(due + bms.interval, time.time())
+        log.info('got 0 back from getBLEData(), try reconnecting... {}'.format(bms.name))
+        bms.connected = False
+        try:
+            bms.disconnect()            # the device may still be connected, but not answering
+        except Exception:
+            pass
+        return time.time() + bms.reconnect.failure()
+    except Exception:
+        delay = bms.reconnect.failure()
+        log.error('exeption raised for {}, retrying in {:.0f}s'.format(bms.name, delay))
+        log.exception(sys.exc_info())
+        bms.connected = False
+        try:
             bms.disconnect()
-            time.sleep(120)
-            mqttClient.reconnect()
-            bms.connect()
+        except Exception:
+            pass
+        return time.time() + delay
 
-        '''finally:
-            log.info("finished")
 
-            # close the clients
-            mqttClient.loop_stop()
-            mqttClient.disconnect()
-            bms.disconnect()'''
+# ---
+# device registry: the polled devices, from --config or from namelist / maclist / taglist
+# ---
+devices = OrderedDict()     # name -> DeviceConfig
+pollers = {}                # name -> jkbms instance
+
+def builtinDevices(args, listitems):
+    return OrderedDict((namelist[i], DeviceConfig(
+        name=namelist[i], mac=maclist[i], tag=taglist[i], model=model, interval=1.0, priority=0,
+        format=args.format, stream=args.stream, refresh=args.refresh, aggregate=args.aggregate,
+        rawInterval=args.raw_interval)) for i in listitems)
+
+def startDevice(args, scheduler, config):
+    # a device that is replaced keeps its history and energy totals
+    history = None
+    if args.history:
+        history = histories.get(config.name) or createHistory(args, config.name)
+    energy = None
+    if args.energy:
+        energy = energyCounters.get(config.name) or createEnergyCounter(args, config.name)
+    bms = jkbms(name=config.name, model=config.model, mac=config.mac, command=command, tag=config.tag,
+                format=config.format, records=1, maxConnectionAttempts=30, refreshInterval=config.refresh,
+                stream=config.stream, history=history, energy=energy, aggregate=config.aggregate, rawInterval=config.rawInterval,
+                interval=config.interval, priority=config.priority, discovery=discovery, handleCache=handleCache,
+                reconnect=ReconnectPolicy(config.name, quick=args.retry_quick, base=args.retry_base, cap=args.retry_cap),
+                settingsInterval=args.settings_interval, queue=recordQueue)
+    metrics.addCollector(bms.collectMetrics)
+    pollers[config.name] = bms
+    if config.stream:
+        # a streaming device keeps its connection, so it has a thread of its own
+        threading.Thread(target=pollBMS, args=(bms,), name=config.name, daemon=True).start()
+    else:
+        scheduler.add(config.name, bms, config.priority)
+
+def stopDevice(scheduler, name):
+    bms = pollers.pop(name)
+    bms.running = False
+    if not bms.stream:
+        scheduler.remove(name)      # releaseDevice is called once the device is idle
+
+def releaseDevice(bms):
+    # the device was removed from the config and is not polled any more
+    metrics.removeCollector(bms.collectMetrics)
+    bms.flushAggregate()
+    try:
+        bms.disconnect()
+    except Exception:
+        pass
+    if bms.history is not None and bms.name not in devices:
+        histories.pop(bms.name).close()
+    if bms.energy is not None and bms.name not in devices:
+        energyCounters.pop(bms.name).save()
+    log.info('{} stopped'.format(bms.name))
+
+def reloadDevices(args, scheduler):
+    '''
+    Read --config again: removed devices are stopped, new ones started and
+    changed ones restarted. A change of the interval or priority only
+    updates the schedule.
+    '''
+    global devices
+    try:
+        mqttConfig, configs = loadConfig(args.config, args, model)
+    except (OSError, ValueError, configparser.Error) as e:
+        log.error('{} not reloaded: {}'.format(args.config, e))
+        return
+    if mqttConfig.get('broker', BROKER) != BROKER or int(mqttConfig.get('port', PORT)) != PORT:
+        log.warning('The mqtt broker in {} changed, restart to use it'.format(args.config))
+    old, devices = devices, configs
+    for name, config in old.items():
+        new = configs.get(name)
+        if new == config:
+            continue
+        if new is not None and not new.stream and new._replace(interval=config.interval, priority=config.priority) == config:
+            log.info('{}: interval {}s, priority {}'.format(name, new.interval, new.priority))
+            bms = pollers[name]
+            bms.interval, bms.priority = new.interval, new.priority
+            scheduler.add(name, bms, new.priority)
+            continue
+        log.info('{} {}'.format('Restarting' if new else 'Removing', name))
+        stopDevice(scheduler, name)
+        if new is not None:
+            startDevice(args, scheduler, new)
+    for name, config in configs.items():
+        if name not in old:
+            log.info('Adding {}'.format(name))
+            startDevice(args, scheduler, config)
+    scheduler.start(sum(1 for config in configs.values() if not config.stream))
+
+def configTime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+# ---
+# main part of the script
+# ---
+if __name__ == "__main__":
+
+    args = parseArguments()
+    if args.config:
+        mqttConfig, devices = loadConfig(args.config, args, model)
+        BROKER = mqttConfig.get('broker', BROKER)
+        PORT = int(mqttConfig.get('port', PORT))
+        setupLogging(args, 'jkbms_ble.log')
+    else:
+        if args.all:
+            listitems = list(range(len(namelist)))
+        else:
+            listitems = sorted(set(args.bms))
+        if max(listitems) >= len(namelist) or min(listitems) < 0:
+            # logging is not set up yet, the error goes to stderr
+            log.error('There are only {} devices selectable, --bms must be between 0 and {}'.format(len(namelist), len(namelist) - 1))
+            sys.exit(1)
+        elif len(listitems) == 1:
+            setupLogging(args, 'jkbms_ble_{}.log'.format(namelist[listitems[0]]))
+        else:
+            setupLogging(args, 'jkbms_ble.log')
+        devices = builtinDevices(args, listitems)
+    setupMQTT(args)
+    if args.queue:
+        recordQueue = RecordQueue(args.queue, args.queue_policy)
+        recordQueue.start(publishRecord)
+    if args.metrics_port or args.metrics_socket:
+        metrics.serve(port=args.metrics_port, socketPath=args.metrics_socket)
+        metrics.addCollector(collectMQTTMetrics)
+        if recordQueue is not None:
+            metrics.addCollector(recordQueue.collectMetrics)
+        metrics.addRoute('/history', historyPage)
+
+    if args.record:
+        recorder = CaptureWriter(args.record)
+    if args.discovery:
+        discovery = DiscoveryCache(args.discovery, args.discovery_age)
+    handleCache = HandleCache(args.handle_cache or None)
+
+    if not args.replay:
+        # a replay needs no BLE and publishes to the spool until the broker is connected
+        log.info("Startup; wait 10s to initialize communication")
+        time.sleep(10)      # wait 10s to give mqtt connection time to initiates
+    startupSequence()   # make shure after 1st start everything is in order
+
+    try:
+        if args.replay:
+            replayCapture(args)
+        else:
+            # the devices are polled by a pool of worker threads, the next due device first, so a slow
+            # or reconnecting device does not stall the others (mqtt reconnects are handled by the paho
+            # network loop); streaming devices have a thread of their own
+            scheduler = Scheduler(pollDevice, workers=args.workers)
+            scheduler.onRemove = releaseDevice
+            for config in devices.values():
+                startDevice(args, scheduler, config)
+            scheduler.start(sum(1 for config in devices.values() if not config.stream))
+
+            # the config is reloaded when it changes or on SIGHUP
+            reload = threading.Event()
+            signal.signal(signal.SIGHUP, lambda signum, frame: reload.set())
+            lastChange = configTime(args.config) if args.config else None
+            while True:
+                reload.wait(10)
+                if not args.config:
+                    reload.clear()
+                    continue
+                change = configTime(args.config)
+                if reload.is_set() or change != lastChange:
+                    reload.clear()
+                    lastChange = change
+                    log.info('Reloading {}'.format(args.config))
+                    reloadDevices(args, scheduler)
+    finally:
+        log.info("finished")
+        if recorder is not None:
+            recorder.close()
+        if recordQueue is not None:
+            recordQueue.stop()
+        for bms in pollers.values():
+            bms.flushAggregate()
+        for store in histories.values():
+            store.close()
+        for counter in energyCounters.values():
+            counter.save()
+        mqttClient.loop_stop()
+        mqttClient.disconnect()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""
+Capture file of the raw BLE notifications of one or several BMS.
+
+File header: 'JKCP', version (uint16). Every notification follows as
+header '<d6sH' (time stamp, mac as 6 bytes, length) plus the data, so a
+capture can be appended to and read back without an index.
+-------------------------------------------------------------------------
+"""
+
+import time
+import threading
+from struct import Struct
+
+
+MAGIC = b'JKCP'
+VERSION = 1
+FILE_HEADER = Struct('<4sH')
+FRAGMENT = Struct('<d6sH')
+
+
+def macBytes(mac):
+    return bytes.fromhex(mac.replace(':', ''))
+
+
+def macString(data):
+    return ':'.join('{:02X}'.format(b) for b in data)
+
+
+class CaptureWriter:
+    '''
+    Append notifications to a capture file, shared by all poll threads.
+    The file is flushed at most every `flushInterval` seconds.
+    '''
+    def __init__(self, filename, flushInterval=1.0):
+        self.file = open(filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.lock = threading.Lock()
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        self.fragments = 0
+        self.macs = {}          # mac string -> 6 bytes
+
+    def write(self, mac, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        macData = self.macs.get(mac)
+        if macData is None:
+            macData = self.macs[mac] = macBytes(mac)
+        with self.lock:
+            self.file.write(FRAGMENT.pack(timestamp, macData, len(data)))
+            self.file.write(data)
+            self.fragments += 1
+            if timestamp - self.lastFlush >= self.flushInterval:
+                self.file.flush()
+                self.lastFlush = timestamp
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# ---
+# read a capture file, yields (time stamp, mac, data)
+# ---
+def readCapture(filename):
+    with open(filename, 'rb') as f:
+        magic, version = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a capture file (version {})'.format(filename, VERSION))
+        while True:
+            header = f.read(FRAGMENT.size)
+            if len(header) < FRAGMENT.size:
+                return      # end of file, or a fragment cut off by a crash
+            timestamp, mac, length = FRAGMENT.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, macString(mac), data
+
+
+class ReplayTransport:
+    '''
+    Transport for jkbms instances fed from a capture, never connects
+    '''
+    def setDelegate(self, delegate):
+        pass
+
+    def connect(self, mac, addrType='public'):
+        raise Exception('replay transport, no connection to {}'.format(mac))
+
+    def discoverHandles(self):
+        return None
+
+    def getServices(self):
+        return []
+
+    def write(self, handle, data):
+        pass
+
+    def waitForNotifications(self, timeout):
+        return False
+
+    def disconnect(self):
+        pass
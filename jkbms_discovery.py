@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+Discovery cache shared by ble_scanner.py (writes) and jkbms_ble.py (reads).
+
+A json file with the devices seen by the last scans:
+
+    {"updated": 1700000000.0,
+     "devices": {"C8:47:8C:E2:81:41": {"addrType": "public", "rssi": -71, "lastSeen": 1700000000.0,
+                                       "jkService": true, "name": "JK-B2A24S15P"}}}
+
+jkService is set if the advertisement lists the JK-BMS service uuid ffe0.
+The file is replaced atomically, so a reader never sees a partial write.
+-------------------------------------------------------------------------
+"""
+
+import os
+import json
+import time
+from collections import namedtuple
+
+
+JK_SERVICE = 'ffe0'
+SERVICE_ADTYPES = (2, 3, 6, 7)      # incomplete / complete lists of 16 and 128 bit service uuids
+
+Discovery = namedtuple('Discovery', ['mac', 'addrType', 'rssi', 'lastSeen', 'jkService', 'name'])
+
+
+# ---
+# read / write the cache file
+# ---
+def readCache(filename):
+    '''
+    Returns (updated, {mac: Discovery}), (0, {}) if there is no cache yet
+    '''
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return 0, {}
+    devices = {}
+    for mac, entry in data.get('devices', {}).items():
+        devices[mac] = Discovery(mac=mac, addrType=entry.get('addrType', 'public'), rssi=entry.get('rssi'),
+                                 lastSeen=entry.get('lastSeen', 0), jkService=entry.get('jkService', False),
+                                 name=entry.get('name'))
+    return data.get('updated', 0), devices
+
+
+def writeCache(filename, devices, updated=None):
+    data = {'updated': updated or time.time(),
+            'devices': dict((mac, {'addrType': entry.addrType, 'rssi': entry.rssi, 'lastSeen': entry.lastSeen,
+                                   'jkService': entry.jkService, 'name': entry.name})
+                            for mac, entry in sorted(devices.items()))}
+    temp = filename + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(temp, filename)
+
+
+# ---
+# a Discovery from a bluepy ScanEntry
+# ---
+def scanEntry(dev, timestamp=None):
+    jkService = False
+    name = None
+    for adtype, desc, value in dev.getScanData():
+        if adtype in SERVICE_ADTYPES and JK_SERVICE in value.lower():
+            jkService = True
+        elif adtype in (8, 9):          # short / complete local name
+            name = value
+    return Discovery(mac=dev.addr.upper(), addrType=dev.addrType, rssi=dev.rssi,
+                     lastSeen=timestamp or time.time(), jkService=jkService, name=name)
+
+
+class DiscoveryCache:
+    '''
+    Read side of the cache, the file is read again when it changed.
+    maxAge:     devices not seen for maxAge seconds count as absent; if the
+                file was not updated for maxAge seconds the scanner is not
+                running and nothing is known about any device
+    '''
+    def __init__(self, filename, maxAge=180):
+        self.filename = filename
+        self.maxAge = maxAge
+        self.mtime = None
+        self.updated = 0
+        self.devices = {}
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.updated, self.devices = readCache(self.filename)
+
+    def lookup(self, mac):
+        '''
+        Returns (present, Discovery): present is None if the cache is missing
+        or stale, else whether the device was seen within maxAge. Discovery
+        is the last entry of the device, also if it is older.
+        '''
+        self.reload()
+        entry = self.devices.get(mac.upper())
+        now = time.time()
+        if now - self.updated > self.maxAge:
+            return None, entry
+        return entry is not None and now - entry.lastSeen <= self.maxAge, entry
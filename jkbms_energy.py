@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+"""
+Energy and charge counting of the decoded cell data.
+
+Integrates pack power and current between consecutive records (trapezoid
+rule) into charged / discharged Wh and Ah, in total and per local day, and
+keeps the state in a small json file. Implausible records are skipped.
+-------------------------------------------------------------------------
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class EnergyTotals:
+    '''
+    Integrated values of one period (total, one day)
+    '''
+    FIELDS = ('chargedWh', 'dischargedWh', 'chargedAh', 'dischargedAh', 'seconds',
+              'voltSeconds', 'spreadSeconds', 'spreadMax', 'gaps', 'gapSeconds', 'rejected')
+
+    def __init__(self, values=None):
+        for field in self.FIELDS:
+            setattr(self, field, 0.0)
+        for field, value in (values or {}).items():
+            if field in self.FIELDS:
+                setattr(self, field, value)
+
+    def asdict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def values(self):
+        '''
+        Published values: name -> value, the means and efficiencies only once they are defined
+        '''
+        out = {'ChargedWh': round(self.chargedWh, 2), 'DischargedWh': round(self.dischargedWh, 2),
+               'ChargedAh': round(self.chargedAh, 3), 'DischargedAh': round(self.dischargedAh, 3),
+               'SpreadMax': self.spreadMax, 'Gaps': int(self.gaps), 'Rejected': int(self.rejected)}
+        if self.seconds:
+            out['AvgCellVoltage'] = round(self.voltSeconds / self.seconds, 4)
+            out['SpreadMean'] = round(self.spreadSeconds / self.seconds, 2)
+        if self.chargedWh:
+            out['Efficiency'] = round(self.dischargedWh / self.chargedWh, 4)
+        if self.chargedAh:
+            out['CoulombicEfficiency'] = round(self.dischargedAh / self.chargedAh, 4)
+        return out
+
+
+def split(a, b, dt):
+    '''
+    Trapezoid area of a linear value from a to b over dt, as (positive part, negative part)
+    '''
+    if a >= 0 and b >= 0:
+        return (a + b) * dt / 2, 0.0
+    if a <= 0 and b <= 0:
+        return 0.0, -(a + b) * dt / 2
+    crossing = a / (a - b) * dt      # time of the zero crossing
+    if a > 0:
+        return a * crossing / 2, -b * (dt - crossing) / 2
+    return b * (dt - crossing) / 2, -a * crossing / 2
+
+
+def plausible(cellData, minCell, maxCell, maxCurrent):
+    '''
+    True if the values of a record are consistent with each other and within the limits
+    '''
+    voltage = cellData.packvoltage
+    current = cellData.packcurrent
+    if abs(current) > maxCurrent or not minCell <= cellData.avgcellvoltage <= maxCell:
+        return False
+    cells = 0
+    for volt in cellData.volts:
+        if volt:        # unused cells are 0
+            if not minCell <= volt <= maxCell:
+                return False
+            cells += 1
+    if not cells or abs(voltage - cells * cellData.avgcellvoltage) > max(0.5, 0.03 * voltage):
+        return False
+    power = abs(voltage * current)
+    return abs(cellData.packpower - power) <= max(10.0, 0.1 * power)
+
+
+def dayEnd(timestamp):
+    # the day (local time) of a time stamp and the time stamp of the following midnight
+    t = time.localtime(timestamp)
+    end = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+    return time.strftime('%Y-%m-%d', t), end
+
+
+class EnergyCounter:
+    '''
+    filename:       json state file, None keeps the state in memory only
+    maxGap:         longer intervals between two samples are not integrated (s)
+    interval:       the values are due for publishing every interval seconds
+    saveInterval:   the state file is written at most every saveInterval seconds
+    minCell, maxCell, maxCurrent:   limits of a plausible record (V, V, A)
+    '''
+    def __init__(self, filename=None, maxGap=120.0, interval=60.0, saveInterval=300.0,
+                 minCell=1.0, maxCell=5.0, maxCurrent=1000.0):
+        self.filename = filename
+        self.maxGap = maxGap
+        self.minCell = minCell
+        self.maxCell = maxCell
+        self.maxCurrent = maxCurrent
+        self.interval = interval
+        self.saveInterval = saveInterval
+        self.lock = threading.Lock()
+        self.total = EnergyTotals()
+        self.today = EnergyTotals()
+        self.yesterday = None
+        self.day = None
+        self.dayEnd = 0
+        self.last = None            # (time, voltage, current, power, avg. cell voltage, spread)
+        self.lastPublish = 0
+        self.lastSave = 0
+        if filename:
+            self.load()
+
+    def add(self, timestamp, cellData):
+        '''
+        Integrate the interval up to this record, returns True if the values are due for publishing
+        '''
+        if not plausible(cellData, self.minCell, self.maxCell, self.maxCurrent):
+            # the interval from the last good record is integrated with the next one (if within maxGap)
+            self.total.rejected += 1
+            self.today.rejected += 1
+            return False
+        voltage = cellData.packvoltage
+        current = cellData.packcurrent
+        sample = (timestamp, voltage, current, voltage * current, cellData.avgcellvoltage, cellData.deltacellvoltage)
+        last = self.last
+        if last is not None and timestamp <= last[0]:
+            return False            # out of order or repeated
+        if timestamp >= self.dayEnd:
+            self.newDay(timestamp)
+        self.last = sample
+        if last is None:
+            return False
+        dt = timestamp - last[0]
+        if dt > self.maxGap:
+            for totals in (self.total, self.today):
+                totals.gaps += 1
+                totals.gapSeconds += dt
+        else:
+            chargedWh, dischargedWh = split(last[3], sample[3], dt / 3600.0)
+            chargedAh, dischargedAh = split(last[2], current, dt / 3600.0)
+            voltSeconds = (last[4] + sample[4]) * dt / 2
+            spreadSeconds = (last[5] + sample[5]) * dt / 2
+            for totals in (self.total, self.today):
+                totals.chargedWh += chargedWh
+                totals.dischargedWh += dischargedWh
+                totals.chargedAh += chargedAh
+                totals.dischargedAh += dischargedAh
+                totals.seconds += dt
+                totals.voltSeconds += voltSeconds
+                totals.spreadSeconds += spreadSeconds
+        for totals in (self.total, self.today):
+            if sample[5] > totals.spreadMax:
+                totals.spreadMax = sample[5]
+        if timestamp - self.lastSave >= self.saveInterval:
+            self.save()
+        if timestamp - self.lastPublish >= self.interval:
+            self.lastPublish = timestamp
+            return True
+        return False
+
+    def newDay(self, timestamp):
+        day, end = dayEnd(timestamp)
+        if self.day is not None and day != self.day:
+            self.yesterday = (self.day, self.today)
+            self.today = EnergyTotals()
+        self.day = day
+        self.dayEnd = end
+
+    def values(self):
+        '''
+        Published values: {'Total': {...}, 'Today': {...}, 'Yesterday': {...}}
+        '''
+        out = {'Total': self.total.values(), 'Today': dict(self.today.values(), Day=self.day)}
+        if self.yesterday is not None:
+            out['Yesterday'] = dict(self.yesterday[1].values(), Day=self.yesterday[0])
+        return out
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.total = EnergyTotals(state.get('total'))
+        self.today = EnergyTotals(state.get('today'))
+        self.day = state.get('day')
+        if state.get('yesterday'):
+            day, values = state['yesterday']
+            self.yesterday = (day, EnergyTotals(values))
+        if state.get('last'):
+            self.last = tuple(state['last'])
+            self.lastSave = self.last[0]
+            # a restart within maxGap continues the integration, the day is checked with the next sample
+            self.dayEnd = dayEnd(self.last[0])[1]
+
+    def save(self):
+        # replace the file atomically
+        if self.last is not None:
+            self.lastSave = self.last[0]
+        if not self.filename:
+            return
+        state = {'total': self.total.asdict(), 'today': self.today.asdict(), 'day': self.day, 'last': self.last}
+        if self.yesterday is not None:
+            state['yesterday'] = [self.yesterday[0], self.yesterday[1].asdict()]
+        with self.lock:
+            temp = self.filename + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(temp, self.filename)
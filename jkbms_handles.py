@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+"""
+Cache of the GATT handles of every BMS, so a connection does not need the
+service / characteristic / descriptor discovery round trips.
+
+json file, one entry per mac with the firmware (software version of the
+info record) the handles were discovered with:
+
+    {"C8:47:8C:E2:81:41": {"firmware": "10.09", "notify": 16, "write": 16, "cccd": 17}}
+
+A different firmware or a failing write with the cached handles drops the
+entry and the handles are discovered again.
+-------------------------------------------------------------------------
+"""
+
+import os
+import json
+import threading
+from collections import namedtuple
+
+
+GattHandles = namedtuple('GattHandles', ['notify', 'write', 'cccd'])
+
+
+class HandleCache:
+    '''
+    filename:   json file, None keeps the handles in memory only
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        if filename:
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def lookup(self, mac):
+        '''
+        Returns (handles, firmware) or (None, None)
+        '''
+        entry = self.entries.get(mac)
+        if entry is None:
+            return None, None
+        return GattHandles(entry['notify'], entry['write'], entry['cccd']), entry.get('firmware')
+
+    def store(self, mac, firmware, handles):
+        with self.lock:
+            self.entries[mac] = dict(handles._asdict(), firmware=firmware)
+            self.save()
+
+    def remove(self, mac):
+        with self.lock:
+            if self.entries.pop(mac, None) is not None:
+                self.save()
+
+    def save(self):
+        # replace the file atomically (lock held)
+        if not self.filename:
+            return
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(temp, self.filename)
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+"""
+Ring buffer with the recent history of the decoded cell data of one pack.
+
+Every numeric CellData value gets a float32 column, the time stamps a double
+column. The columns live in one fixed size block (bytearray, or a memory
+mapped file so the history survives a restart), the memory is allocated
+once: capacity = budget / bytes per sample. Samples more than the retention
+period before the newest one (or the end of a query) are ignored by the
+queries and overwritten when the ring wraps. The retention is measured on
+the time stamps of the samples, so replayed and backfilled history is
+returned like live data.
+-------------------------------------------------------------------------
+"""
+
+import os
+import mmap
+import zlib
+from bisect import bisect_left, bisect_right
+from struct import Struct
+from operator import attrgetter
+
+
+HEADER = Struct('<4sHHIII')         # magic, version, reserved, capacity, columns, crc of the column names
+POSITION = Struct('<II')            # next sample, number of samples (follows the header)
+HEADER_SIZE = 64
+MAGIC = b'JKHS'
+VERSION = 1
+
+
+# ---
+# column names and how to get the values from a CellData tuple
+# ---
+def cellDataColumns(cellCount, resistanceCount, values):
+    '''
+    values: (name, CellData field) of the scalar values, see jkbms_ble.CELL_DATA_VALUES
+    returns the column names and a function(cellData) -> all values in column order
+    '''
+    names = ['VoltageCell_{:02d}'.format(cell + 1) for cell in range(cellCount)]
+    names += ['ResistanceCell_{:02d}'.format(cell) for cell in range(resistanceCount)]
+    fields = []
+    for name, field in values:
+        if field == 'uptime':
+            field = 'uptimeseconds'     # the string is derived from the seconds
+        names.append(name)
+        fields.append(field)
+    names.append('CapaRemaining')
+    fields.append('caparemaining')
+    scalars = attrgetter(*fields)
+    return names, lambda cellData: cellData.volts + cellData.resistances + scalars(cellData)
+
+
+class _Times:
+    # time column in ring order, a sequence for bisect
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.count
+
+    def __getitem__(self, index):
+        return self.store.times[self.store.index(index)]
+
+
+class HistoryStore:
+    '''
+    Fixed size history of one pack.
+
+    columns:    column names and function(cellData) -> values, see cellDataColumns
+    budget:     memory for the history in bytes
+    retention:  samples older than this [s] before the newest one are not returned
+    filename:   memory mapped file, None keeps the history in memory only
+    '''
+    def __init__(self, columns, budget=4 * 1024 * 1024, retention=4 * 3600, filename=None):
+        self.names, self.row = columns
+        self.columnIndex = dict((name, i) for i, name in enumerate(self.names))
+        self.retention = retention
+        self.filename = filename
+        rowSize = 8 + 4 * len(self.names)
+        self.capacity = max((budget - HEADER_SIZE) // rowSize, 1)
+        size = HEADER_SIZE + rowSize * self.capacity
+        crc = zlib.crc32(','.join(self.names).encode('utf-8'))
+        self.positionOffset = HEADER.size
+
+        self.file = None
+        if filename:
+            self.file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+            reuse = os.path.getsize(filename) == size
+            self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+        else:
+            reuse = False
+            self.buffer = bytearray(size)
+        self.head = 0                   # next sample is written here
+        self.count = 0
+        if reuse:
+            magic, version, _, capacity, columnCount, columnsCrc = HEADER.unpack_from(self.buffer)
+            if (magic, version, capacity, columnCount, columnsCrc) == (MAGIC, VERSION, self.capacity, len(self.names), crc):
+                self.head, self.count = POSITION.unpack_from(self.buffer, self.positionOffset)
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, 0, self.capacity, len(self.names), crc)
+        POSITION.pack_into(self.buffer, self.positionOffset, self.head, self.count)
+
+        self.view = view = memoryview(self.buffer)
+        offset = HEADER_SIZE
+        self.times = view[offset:offset + 8 * self.capacity].cast('d')
+        offset += 8 * self.capacity
+        self.columns = []
+        for _ in self.names:
+            self.columns.append(view[offset:offset + 4 * self.capacity].cast('f'))
+            offset += 4 * self.capacity
+        self.timeline = _Times(self)
+
+    def index(self, i):
+        # position of the i-th oldest sample
+        return (self.head - self.count + i) % self.capacity
+
+    def append(self, timestamp, cellData):
+        '''
+        Store the values of one CellData tuple
+        '''
+        head = self.head
+        for column, value in zip(self.columns, self.row(cellData)):
+            column[head] = value
+        self.times[head] = timestamp
+        # publish the new sample after its values are written
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        POSITION.pack_into(self.buffer, self.positionOffset, self.head, self.count)
+
+    def range(self, start=None, end=None):
+        '''
+        Index range [first, last) of the samples between start and end (time stamps)
+        '''
+        if not self.count:
+            return 0, 0
+        if end is None:
+            oldest = self.times[self.index(self.count - 1)] - self.retention
+        else:
+            oldest = end - self.retention
+        if start is None or start < oldest:
+            start = oldest
+        first = bisect_left(self.timeline, start)
+        last = self.count if end is None else bisect_right(self.timeline, end)
+        return first, max(first, last)
+
+    def query(self, name, start=None, end=None):
+        '''
+        Time stamps and values of one column between start and end,
+        returns two lists
+        '''
+        column = self.columns[self.columnIndex[name]]
+        first, last = self.range(start, end)
+        positions = [self.index(i) for i in range(first, last)]
+        return [self.times[p] for p in positions], [column[p] for p in positions]
+
+    def latest(self, name):
+        if not self.count:
+            return None
+        p = self.index(self.count - 1)
+        return self.times[p], self.columns[self.columnIndex[name]][p]
+
+    def close(self):
+        if self.file:
+            self.buffer.flush()
+            self.times.release()
+            for column in self.columns:
+                column.release()
+            self.view.release()
+            self.buffer.close()
+            self.file.close()
+            self.file = None
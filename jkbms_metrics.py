@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+"""
+Timing histograms and counters per stage and device for jkbms_ble.py,
+served in the Prometheus text format on a local http port or unix socket.
+
+Nothing is recorded until `metrics.enabled` is set (done by `serve()`),
+a disabled observe / inc / mark is a single attribute check.
+-------------------------------------------------------------------------
+"""
+
+import os
+import time
+import socket
+import threading
+import collections
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# upper bounds of the histogram buckets in seconds, from a decode (~10us) to a recovery (minutes)
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+           60.0, 120.0, 300.0, 900.0)
+
+# stages of the jkbms_ble pipeline
+CONNECT = 'connect'             # one connection attempt
+ESTABLISH = 'establish'         # jkbms.connect() until connected, all attempts
+DISCOVERY = 'discovery'         # GATT service / characteristic lookup
+WAIT = 'wait'                   # waitForNotifications, without the time spent in the delegate
+REASSEMBLY = 'reassembly'       # one notification fragment through the reassembler
+DECODE = 'decode'               # one cell data record
+PUBLISH = 'publish'             # all mqtt messages of one cell data record
+RECOVERY = 'recovery'           # first failure of an incident until the next good record
+
+RATE_WINDOW = 60.0              # window of the ..._per_minute gauges in seconds
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    '''
+    Registry of all metrics. Every device is written by its own poll thread,
+    so the values are updated without a lock; a scrape may see a histogram
+    in the middle of an update, which is fine for monitoring.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.histograms = collections.OrderedDict()    # (stage, device) -> Histogram
+        self.counters = collections.OrderedDict()      # (name, device) -> value
+        self.marks = collections.OrderedDict()         # (name, device) -> deque of times
+        self.collectors = []                           # functions returning [(name, type, help, labels, value)]
+        self.routes = {}                               # further pages of the http server, path -> function
+        self.lock = threading.Lock()                   # only for creating new entries
+        self.server = None
+
+    def observe(self, stage, device, seconds):
+        if not self.enabled:
+            return
+        key = (stage, device)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(seconds)
+
+    def inc(self, name, device, value=1):
+        if not self.enabled:
+            return
+        key = (name, device)
+        if key not in self.counters:
+            with self.lock:
+                self.counters.setdefault(key, 0)
+        self.counters[key] += value
+
+    def mark(self, name, device):
+        # event for a ..._per_minute gauge
+        if not self.enabled:
+            return
+        key = (name, device)
+        events = self.marks.get(key)
+        if events is None:
+            with self.lock:
+                events = self.marks.setdefault(key, collections.deque())
+        now = time.monotonic()
+        events.append(now)
+        while events[0] < now - RATE_WINDOW:
+            events.popleft()
+
+    def addCollector(self, collector):
+        # collector() is called for every scrape and returns values owned by other objects
+        self.collectors.append(collector)
+
+    def removeCollector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def addRoute(self, path, handler):
+        # handler(params) returns (content type, body), params as returned by parse_qs
+        self.routes[path] = handler
+
+    def render(self):
+        '''
+        All metrics in the Prometheus text exposition format
+        '''
+        lines = []
+        lines.append('# HELP jkbms_stage_seconds Time spent per stage and device')
+        lines.append('# TYPE jkbms_stage_seconds histogram')
+        for (stage, device), histogram in list(self.histograms.items()):
+            labels = 'device="{}",stage="{}"'.format(device, stage)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('jkbms_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('jkbms_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, histogram.count))
+            lines.append('jkbms_stage_seconds_sum{{{}}} {}'.format(labels, histogram.sum))
+            lines.append('jkbms_stage_seconds_count{{{}}} {}'.format(labels, histogram.count))
+
+        samples = collections.OrderedDict()     # name -> (type, help, [(labels, value)])
+        for (name, device), value in list(self.counters.items()):
+            samples.setdefault(name, ('counter', '', []))[2].append(({'device': device}, value))
+        now = time.monotonic()
+        for (name, device), events in list(self.marks.items()):
+            count = sum(1 for t in list(events) if t >= now - RATE_WINDOW)
+            samples.setdefault(name + '_per_minute', ('gauge', '', []))[2].append(({'device': device}, count * 60.0 / RATE_WINDOW))
+        for collector in self.collectors:
+            for name, type, help, labels, value in collector():
+                samples.setdefault(name, (type, help, []))[2].append((labels, value))
+        for name, (type, help, values) in samples.items():
+            if help:
+                lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            for labels, value in values:
+                lines.append('{}{{{}}} {}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=None, socketPath=None, host='127.0.0.1'):
+        '''
+        Start recording and serve the metrics on http://host:port/metrics
+        or on the unix socket socketPath, in a daemon thread
+        '''
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                contentType = 'text/plain; version=0.0.4; charset=utf-8'
+                try:
+                    if url.path in registry.routes:
+                        contentType, body = registry.routes[url.path](parse_qs(url.query))
+                    else:
+                        body = registry.render()
+                except (KeyError, ValueError) as e:
+                    self.send_error(404, str(e))
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+            def address_string(self):
+                return 'metrics'
+
+        if socketPath:
+            if os.path.exists(socketPath):
+                os.unlink(socketPath)
+            self.server = UnixHTTPServer(socketPath, Handler)
+        else:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        self.enabled = True
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        return self.server
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+# the registry used by jkbms_ble.py
+metrics = Metrics()
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+"""
+Binary payload of the cell data (jkbms_ble.py --format binary) and a
+decoder for the subscribers.
+
+One packed little endian struct per record on <tag>/CellData, all values
+as integers in the units of the BMS (mV, mA, mOhm, 0.1 degC, ...):
+
+    B       version (1)
+    B       number of cells n
+    B       number of resistances m
+    nh      cell voltages [mV]
+    mh      cell wire resistances [mOhm]
+    ...     pack values, see PACK_VALUES
+
+146 bytes for 24 cells instead of ~630 bytes of json. The layout is published
+retained on <tag>/CellData/Schema as json (SCHEMA), so subscribers in
+other languages can build the struct from it.
+
+    python3 jkbms_payload.py --broker 192.168.1.2 --topic 'JKBMS_top/CellData'
+    python3 jkbms_payload.py --hex 01181903...
+
+print every payload as the json document of --format json, including the
+spooled ones (base64 in the <tag>/Spool batches).
+-------------------------------------------------------------------------
+"""
+
+import sys
+import json
+import base64
+import argparse
+from struct import Struct
+
+
+VERSION = 1
+HEADER = Struct('<BBB')
+
+# pack values after the cells: name (as in --format json), CellData field, struct code, scale
+# the codes have the signedness of CELL_DATA_02 in jkbms_ble.py, so every decoded record packs
+PACK_VALUES = (
+    ('AvgCellVoltage', 'avgcellvoltage', 'h', 1000),
+    ('DeltaCellVoltage', 'deltacellvoltage', 'h', 1),
+    ('BalancerCurrent', 'balancercurrent', 'h', 1000),
+    ('PackVoltage', 'packvoltage', 'I', 1000),
+    ('PackPower', 'packpower', 'I', 1000),
+    ('PackCurrent', 'packcurrent', 'i', 1000),
+    ('PackTemp_1', 'packtemp1', 'h', 10),
+    ('PackTemp_2', 'packtemp2', 'h', 10),
+    ('MOSTemp', 'mostemp', 'h', 10),
+    ('PackSOC', 'soc', 'B', 1),
+    ('CapaNominal', 'capanominal', 'I', 1000),
+    ('CycleCount', 'cyclecount', 'I', 1),
+    ('CapaCycled', 'capacycle', 'I', 1000),
+    ('BMSUptime', 'uptimeseconds', 'I', 1),     # seconds, json has the formatted uptime
+    ('ChargeCurrent', 'charge', 'h', 1000),
+    ('DischargeCurrent', 'discharge', 'h', 1000),
+    )
+
+PACK_CODES = ''.join(code for _, _, code, _ in PACK_VALUES)
+
+# retained on <tag>/CellData/Schema
+SCHEMA = {
+    'version': VERSION,
+    'byteorder': 'little',
+    'header': ['version:B', 'cells:B', 'resistances:B'],
+    'arrays': [['VoltageCell', 'h', 1000, 'cells'], ['ResistanceCell', 'h', 1000, 'resistances']],
+    'values': [[name, code, scale] for name, _, code, scale in PACK_VALUES],
+    'note': 'value = integer / scale',
+    }
+
+layouts = {}            # (cells, resistances) -> Struct
+
+
+def layout(cells, resistances):
+    struct = layouts.get((cells, resistances))
+    if struct is None:
+        struct = layouts.setdefault((cells, resistances),
+                                    Struct('<BBB{}h{}h{}'.format(cells, resistances, PACK_CODES)))
+    return struct
+
+
+# ---
+# encoder, used by jkbms_ble.py
+# ---
+def encodeCellData(cellData):
+    '''
+    Pack a CellData tuple of jkbms_ble.py
+    '''
+    volts = cellData.volts
+    resistances = cellData.resistances
+    values = [VERSION, len(volts), len(resistances)]
+    values += [int(round(v * 1000)) for v in volts]
+    values += [int(round(r * 1000)) for r in resistances]
+    for _, field, _, scale in PACK_VALUES:
+        values.append(int(round(getattr(cellData, field) * scale)))
+    return layout(len(volts), len(resistances)).pack(*values)
+
+
+# ---
+# decoder for the subscribers
+# ---
+def decodeCellData(payload):
+    '''
+    Unpack a binary payload into the dict of --format json (floats in V, A, degC, ...)
+    '''
+    version, cells, resistances = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError('unknown payload version {}'.format(version))
+    v = layout(cells, resistances).unpack(payload)
+    out = {'VoltageCell': [x / 1000.0 for x in v[3:3 + cells]],
+           'ResistanceCell': [x / 1000.0 for x in v[3 + cells:3 + cells + resistances]]}
+    pos = 3 + cells + resistances
+    for i, (name, _, _, scale) in enumerate(PACK_VALUES):
+        out[name] = v[pos + i] / scale if scale != 1 else v[pos + i]
+    return out
+
+
+def decodeSpool(payload):
+    '''
+    Messages of a <tag>/Spool batch as (time, topic, payload), binary payloads decoded
+    '''
+    messages = []
+    for message in json.loads(payload):
+        timestamp, topic, data = message[:3]
+        if message[3:] == ['base64']:
+            data = decodeCellData(base64.b64decode(data))
+        messages.append((timestamp, topic, data))
+    return messages
+
+
+def printPayload(topic, payload):
+    if topic.endswith('/Schema'):
+        return
+    try:
+        if topic.endswith('/Spool'):
+            for timestamp, messageTopic, data in decodeSpool(payload):
+                print(timestamp, messageTopic, json.dumps(data, separators=(',', ':')))
+            return
+        print(topic, json.dumps(decodeCellData(payload), separators=(',', ':')))
+    except Exception as e:
+        print(topic, 'cannot decode {} bytes: {}'.format(len(payload), e), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode the binary cell data payloads of jkbms_ble.py --format binary')
+    parser.add_argument('--hex', type=str, help='decode this payload (hex) and exit')
+    parser.add_argument('--broker', default='localhost', type=str, help='mqtt broker')
+    parser.add_argument('--port', default=1883, type=int, help='mqtt port')
+    parser.add_argument('--topic', default=['+/CellData', '+/Spool'], nargs='+', help='topics to subscribe to')
+    args = parser.parse_args()
+
+    if args.hex:
+        printPayload('-', bytes.fromhex(args.hex))
+        return
+
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client()
+    client.on_connect = lambda client, userdata, flags, rc: client.subscribe([(topic, 0) for topic in args.topic])
+    client.on_message = lambda client, userdata, message: printPayload(message.topic, message.payload)
+    client.connect(args.broker, args.port)
+    client.loop_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""
+JK-BMS BLE protocol: record markers, record types and the request frames
+
+A request is a 20 byte frame:
+    aa 55 90 eb | opcode | length | value (4 bytes, little endian) | 9 x 00 | checksum
+The checksum is the sum of the first 19 bytes & 0xff.
+
+All frames used by jkbms_ble.py are built once at import time.
+-------------------------------------------------------------------------
+"""
+
+from struct import Struct
+
+
+# record types (byte 4 of a record)
+EXTENDED_RECORD = 1
+CELL_DATA = 2
+INFO_RECORD = 3
+
+SOR = bytes.fromhex('55aaeb90')             # start of record
+ACK = bytes.fromhex('aa5590eb')             # command acknowledge, also the header of a request
+RECORD_LENGTHS = (300, 320)                 # valid record lengths
+
+COMMAND_FRAME = Struct('<4sBBI9x')          # header, opcode, length, value (without checksum)
+
+# opcodes
+COMMAND_CELL_INFO = 0x96                    # settings record followed by the cell data records
+COMMAND_INFO = 0x97                         # info record
+COMMAND_CHARGE_SWITCH = 0x1d
+COMMAND_DISCHARGE_SWITCH = 0x1e
+COMMAND_BALANCER_SWITCH = 0x1f
+
+
+# ---
+# calculate crc8 checksum (sum of all bytes), summed in C over a memoryview
+# ---
+def crc8(byteData):
+    '''
+    Generate 8 bit CRC of supplied string
+    '''
+    return sum(memoryview(byteData)) & 0xff
+
+
+# ---
+# build a request frame
+# ---
+def buildCommand(opcode, value=0, length=0):
+    '''
+    Build a 20 byte request frame for the given opcode, `length` is the
+    number of bytes of `value` the BMS has to use (0 for read requests)
+    '''
+    frame = bytearray(COMMAND_FRAME.pack(ACK, opcode, length, value))
+    frame.append(crc8(frame))
+    return bytes(frame)
+
+
+# precomputed request frames
+getInfo = buildCommand(COMMAND_INFO)
+getCellInfo = buildCommand(COMMAND_CELL_INFO)
+getSettings = getCellInfo                   # the settings record is sent in reply to getCellInfo
+
+SWITCHES = {
+    'charge': COMMAND_CHARGE_SWITCH,
+    'discharge': COMMAND_DISCHARGE_SWITCH,
+    'balancer': COMMAND_BALANCER_SWITCH,
+    }
+
+# switch name -> (frame to switch off, frame to switch on)
+SWITCH_COMMANDS = dict((name, (buildCommand(opcode, 0, 4), buildCommand(opcode, 1, 4)))
+                       for name, opcode in SWITCHES.items())
+
+
+# ---
+# frame to switch the charge / discharge MOSFETs or the balancer on or off
+# ---
+def switchCommand(name, on):
+    return SWITCH_COMMANDS[name][1 if on else 0]
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""
+Bounded queue between the BLE notification callbacks and the publisher.
+
+The callbacks only reassemble the fragments and put the complete records
+into the queue, a publisher thread decodes and publishes them, so a slow
+broker or a slow decode never delays bluepy draining its helper pipe.
+put() never blocks. As long as there is space every record is queued, so
+history, energy counting and aggregation see every sample; only a full
+queue follows the overflow policy:
+
+drop-oldest:    the oldest queued record is dropped
+coalesce:       the record replaces the newest queued record of the same
+                device and type (at its position in the queue),
+                drop-oldest if there is none
+-------------------------------------------------------------------------
+"""
+
+import time
+import logging
+import threading
+import collections
+
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, COALESCE)
+
+log = logging.getLogger('jkbms_ble')
+
+
+class RecordQueue:
+    '''
+    size:       maximum number of queued records
+    policy:     DROP_OLDEST or COALESCE, see above
+    '''
+    def __init__(self, size=64, policy=COALESCE):
+        if policy not in POLICIES:
+            raise ValueError('unknown overflow policy {}'.format(policy))
+        self.size = size
+        self.policy = policy
+        self.entries = collections.deque()     # [key, item]
+        self.pending = {}                       # key -> newest queued entry of the key, for coalescing
+        self.condition = threading.Condition()
+        self.running = False
+        # statistics
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.maxDepth = 0
+
+    def put(self, key, item):
+        with self.condition:
+            self.enqueued += 1
+            if len(self.entries) >= self.size:
+                entry = self.pending.get(key) if self.policy == COALESCE else None
+                if entry is not None:
+                    entry[1] = item
+                    self.coalesced += 1
+                    return
+                oldest = self.entries.popleft()
+                if self.pending.get(oldest[0]) is oldest:
+                    del self.pending[oldest[0]]
+                self.dropped += 1
+            entry = [key, item]
+            self.entries.append(entry)
+            self.pending[key] = entry
+            if len(self.entries) > self.maxDepth:
+                self.maxDepth = len(self.entries)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        # oldest item, None after timeout
+        with self.condition:
+            if not self.entries:
+                self.condition.wait(timeout)
+                if not self.entries:
+                    return None
+            entry = self.entries.popleft()
+            if self.pending.get(entry[0]) is entry:
+                del self.pending[entry[0]]
+            return entry[1]
+
+    def depth(self):
+        return len(self.entries)
+
+    def start(self, process):
+        # publisher thread: process(item) for every queued item
+        self.running = True
+        thread = threading.Thread(target=self.worker, args=(process,), name='publisher', daemon=True)
+        thread.start()
+        return thread
+
+    def worker(self, process):
+        while self.running:
+            item = self.get(1.0)
+            if item is None:
+                continue
+            try:
+                process(item)
+            except Exception:
+                log.exception('publishing a record failed')
+
+    def stop(self, timeout=5.0):
+        # publish what is queued, then stop the publisher
+        deadline = time.time() + timeout
+        while self.entries and time.time() < deadline:
+            time.sleep(0.05)
+        self.running = False
+
+    def collectMetrics(self):
+        return [
+            ('jkbms_queue_depth', 'gauge', 'Records waiting for the publisher', {}, self.depth()),
+            ('jkbms_queue_max_depth', 'gauge', 'Highest number of records waiting for the publisher', {}, self.maxDepth),
+            ('jkbms_queue_records_total', 'counter', 'Records put into the publisher queue', {}, self.enqueued),
+            ('jkbms_queue_dropped_total', 'counter', 'Records dropped because the publisher queue was full', {}, self.dropped),
+            ('jkbms_queue_coalesced_total', 'counter', 'Records replaced by a newer record of the same device and type', {}, self.coalesced),
+            ]
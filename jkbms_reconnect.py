@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""
+Reconnect policy of jkbms_ble.py, one per BMS and one for the mqtt broker.
+
+An incident starts with the first failure (lost connection, failed connect,
+no data) and ends with the next good record. The first `quick` retries of an
+incident follow immediately, then the delay grows exponentially from `base`
+up to `cap` seconds, each delay shortened by a random part (`jitter`) so
+that several packs dropping out together do not retry in lockstep. The
+time to recovery of every incident goes to the `recovery` histogram.
+-------------------------------------------------------------------------
+"""
+
+import time
+import random
+import logging
+
+from jkbms_metrics import metrics, RECOVERY
+
+
+log = logging.getLogger('jkbms_ble')
+
+CONNECTED = 'connected'
+QUICK = 'quick'             # first retries of an incident, no delay
+BACKOFF = 'backoff'         # exponential backoff with jitter
+
+
+class ReconnectPolicy:
+    '''
+    name:       device name of the metrics
+    quick:      retries without delay at the start of an incident
+    base:       first backoff delay in s, doubled with each further failure
+    cap:        maximum delay in s
+    jitter:     up to this part of each delay is taken off at random
+    '''
+    def __init__(self, name, quick=2, base=2.0, cap=120.0, jitter=0.5, seed=None):
+        self.name = name
+        self.quick = quick
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.state = CONNECTED
+        self.failures = 0           # failures of the current incident
+        self.incidentStart = None
+        self.incidents = 0
+        self.lastRecovery = None    # time to recovery of the last incident in s
+        self.recoveryTime = 0.0     # sum of the times to recovery of all incidents in s
+
+    def failure(self):
+        '''
+        Count a failure, returns the delay before the next attempt in s
+        '''
+        if self.incidentStart is None:
+            self.incidentStart = time.time()
+            self.incidents += 1
+            metrics.inc('jkbms_incidents_total', self.name)
+        self.failures += 1
+        if self.failures <= self.quick:
+            self.state = QUICK
+            return 0.0
+        self.state = BACKOFF
+        delay = min(self.cap, self.base * 2 ** (self.failures - self.quick - 1))
+        return delay * (1.0 - self.jitter * self.random.random())
+
+    def success(self):
+        # end of an incident, called for every good record (a single check while connected)
+        if self.incidentStart is None:
+            return
+        self.lastRecovery = time.time() - self.incidentStart
+        self.recoveryTime += self.lastRecovery
+        metrics.observe(RECOVERY, self.name, self.lastRecovery)
+        log.info('{}: recovered after {:.1f}s, {} failures'.format(self.name, self.lastRecovery, self.failures))
+        self.state = CONNECTED
+        self.failures = 0
+        self.incidentStart = None
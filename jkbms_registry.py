@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+"""
+Device registry (config file) and the deadline scheduler for jkbms_ble.py
+
+Config file (ini format), one section per BMS, the [mqtt] section is optional:
+
+    [mqtt]
+    broker = mosquitto.fritz.box
+    port = 1883
+
+    [JKBMS-Top]
+    mac = C8:47:8C:E2:81:41
+    tag = JKBMS_top
+    interval = 1            ; seconds between two polls
+    priority = 0            ; lower is more important, used when several polls are due
+    format = json           ; options not given are taken from the command line
+    stream = no
+    refresh = 300
+    aggregate = 0
+    raw_interval =
+    enabled = yes
+-------------------------------------------------------------------------
+"""
+
+import time
+import heapq
+import logging
+import threading
+import itertools
+import configparser
+from collections import OrderedDict, namedtuple
+
+
+log = logging.getLogger('jkbms_ble')
+
+DeviceConfig = namedtuple('DeviceConfig', [
+    'name', 'mac', 'tag', 'model', 'interval', 'priority', 'format', 'stream',
+    'refresh', 'aggregate', 'rawInterval'])
+
+
+# ---
+# read the config file
+# ---
+def loadConfig(filename, args, model):
+    '''
+    Returns the [mqtt] options as dict and the enabled devices as
+    OrderedDict name -> DeviceConfig. `args` (command line) supplies the
+    defaults of the output options.
+    '''
+    parser = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    with open(filename) as f:
+        parser.read_file(f)
+    mqtt = dict(parser.items('mqtt')) if parser.has_section('mqtt') else {}
+    devices = OrderedDict()
+    for name in parser.sections():
+        if name == 'mqtt':
+            continue
+        section = parser[name]
+        if not section.getboolean('enabled', True):
+            continue
+        if 'mac' not in section:
+            raise ValueError('[{}] in {} has no mac'.format(name, filename))
+        rawInterval = section.get('raw_interval', '')
+        devices[name] = DeviceConfig(
+            name=name,
+            mac=section['mac'].upper(),
+            tag=section.get('tag', name),
+            model=section.get('model', model),
+            interval=section.getfloat('interval', 1.0),
+            priority=section.getint('priority', 0),
+            format=section.get('format', args.format),
+            stream=section.getboolean('stream', args.stream),
+            refresh=section.getint('refresh', args.refresh),
+            aggregate=section.getfloat('aggregate', args.aggregate),
+            rawInterval=float(rawInterval) if rawInterval else args.raw_interval)
+        if devices[name].format not in ('mqtt', 'json', 'binary'):
+            raise ValueError('[{}] in {}: format must be mqtt, json or binary'.format(name, filename))
+    return mqtt, devices
+
+
+class Scheduler:
+    '''
+    Runs poll(device, due) for every registered device in a pool of worker
+    threads, a device by at most one worker at a time. poll returns the time
+    of the next poll. When several devices are due, the one with the lowest
+    priority value goes first, then the earliest deadline.
+    '''
+    def __init__(self, poll, workers=0):
+        self.poll = poll
+        self.size = workers             # worker threads, 0: one per device
+        self.workers = 0                # started worker threads
+        self.queue = []                 # heap of (due, priority, sequence, key)
+        self.devices = {}               # key -> [device, priority, sequence of its valid queue entry]
+        self.running = set()            # keys currently polled
+        self.removed = []               # devices removed or replaced while they were polled
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.onRemove = None            # called with a removed device once it is idle
+
+    def add(self, key, device, priority=0, due=None):
+        '''
+        Add a device, or replace the device / priority of a key, first poll at `due` (default: now)
+        '''
+        removed = None
+        with self.condition:
+            entry = self.devices.get(key)
+            if entry is not None and entry[0] is not device:
+                if key in self.running:
+                    self.removed.append(entry[0])
+                else:
+                    removed = entry[0]
+            sequence = next(self.sequence)
+            self.devices[key] = [device, priority, sequence]
+            # the entry of a polled device is queued again by its worker
+            if key not in self.running:
+                heapq.heappush(self.queue, (due or time.time(), priority, sequence, key))
+            self.condition.notify()
+        if removed is not None and self.onRemove:
+            self.onRemove(removed)
+
+    def remove(self, key):
+        with self.condition:
+            device = self.devices.pop(key)[0]
+            if key in self.running:
+                self.removed.append(device)     # the worker calls onRemove when done
+                return
+        if self.onRemove:
+            self.onRemove(device)
+
+    def start(self, devices=1):
+        # start the worker threads, called again when devices are added
+        count = self.size or devices
+        while self.workers < count:
+            threading.Thread(target=self.worker, name='poll-{}'.format(self.workers), daemon=True).start()
+            self.workers += 1
+
+    def next(self):
+        # wait for the next due device (lock held), returns (key, device, due)
+        while True:
+            now = time.time()
+            due = []
+            while self.queue and self.queue[0][0] <= now:
+                entry = heapq.heappop(self.queue)
+                device = self.devices.get(entry[3])
+                if device is not None and device[2] == entry[2]:
+                    due.append(entry)       # else: replaced by a later entry, or removed
+            if due:
+                best = min(due, key=lambda entry: (entry[1], entry[0]))
+                for entry in due:
+                    if entry is not best:
+                        heapq.heappush(self.queue, entry)
+                key = best[3]
+                self.running.add(key)
+                return key, self.devices[key][0], best[0]
+            timeout = self.queue[0][0] - now if self.queue else None
+            self.condition.wait(timeout)
+
+    def worker(self):
+        while True:
+            with self.condition:
+                key, device, due = self.next()
+            try:
+                nextDue = self.poll(device, due)
+            except Exception:
+                log.exception('poll of {} failed'.format(key))
+                nextDue = time.time() + 120
+            removed = None
+            with self.condition:
+                self.running.discard(key)
+                entry = self.devices.get(key)
+                if entry is not None:
+                    if entry[0] is not device:
+                        nextDue = time.time()   # replaced while it was polled
+                    entry[2] = next(self.sequence)
+                    heapq.heappush(self.queue, (nextDue, entry[1], entry[2], key))
+                    self.condition.notify()
+                if device in self.removed:
+                    self.removed.remove(device)
+                    removed = device
+            if removed is not None and self.onRemove:
+                self.onRemove(removed)
+
+    def pending(self):
+        # (key, seconds until due) of the scheduled devices
+        with self.condition:
+            now = time.time()
+            return [(key, due - now) for due, _, sequence, key in sorted(self.queue)
+                    if key in self.devices and self.devices[key][2] == sequence]
@@ -0,0 +1,531 @@
+#!/usr/bin/python3
+"""
+Simulated JK-BMS and in-process mqtt sink
+
+Runs the complete pipeline of jkbms_ble.py (connect, commands, fragment
+reassembly, decoding, publishing) without BLE hardware and without a broker,
+to load-test and profile it on any Linux box.
+
+Example: 8 packs, streaming, 20 byte fragments, 2% lost fragments for 60s
+    python3 jkbms_sim.py --packs 8 --stream --mtu 23 --drop 0.02 --seconds 60
+-------------------------------------------------------------------------
+"""
+
+import sys
+import time
+import math
+import random
+import threading
+import logging
+import json
+import argparse
+from collections import namedtuple
+
+import jkbms_ble
+from jkbms_ble import CELL_DATA_02, CELL_COUNT, RESISTANCE_COUNT, SETTINGS_RECORD, WIRE_RESISTANCE_COUNT
+from jkbms_protocol import crc8, SOR, EXTENDED_RECORD, CELL_DATA, INFO_RECORD, getInfo, getCellInfo, SWITCH_COMMANDS
+from jkbms_registry import Scheduler
+from jkbms_reconnect import ReconnectPolicy
+from jkbms_handles import GattHandles
+from jkbms_queue import RecordQueue, POLICIES, COALESCE
+from jkbms_spool import SpoolingClient
+from jkbms_payload import encodeCellData, decodeCellData, PACK_VALUES
+
+MQTT_ERR_NO_CONN = 4        # as paho
+
+
+# ---
+# build a complete record: header, payload, zero padding, checksum
+# ---
+def buildRecord(recordType, payload, counter=0, length=300):
+    record = bytearray(length)
+    record[0:4] = SOR
+    record[4] = recordType
+    record[5] = counter & 0xff
+    record[6:6 + len(payload)] = payload
+    record[-1] = crc8(record[:-1])
+    return bytes(record)
+
+
+# ---
+# build an info record (type 0x03), fields at their fixed offsets
+# ---
+def buildInfoRecord(vendorID='JK_B2A24S15P', hardwareVersion='10.XW', softwareVersion='10.09',
+                    uptime=0, powerUpTimes=1, deviceName='JK-BMS', passCode='1234', counter=0, length=300):
+    payload = bytearray(100)
+    payload[0:16] = vendorID.encode('utf-8').ljust(16, b'\x00')[:16]
+    payload[16:24] = hardwareVersion.encode('utf-8').ljust(8, b'\x00')[:8]
+    payload[24:32] = softwareVersion.encode('utf-8').ljust(8, b'\x00')[:8]
+    payload[32:36] = uptime.to_bytes(4, 'little')
+    payload[36:40] = powerUpTimes.to_bytes(4, 'little')
+    payload[40:56] = deviceName.encode('utf-8').ljust(16, b'\x00')[:16]
+    payload[56:72] = passCode.encode('utf-8').ljust(16, b'\x00')[:16]
+    return buildRecord(INFO_RECORD, payload, counter, length)
+
+
+# ---
+# simple model of a battery pack, produces realistic cell data records
+# ---
+class PackModel:
+    def __init__(self, cells=16, capacity=280.0, seed=None):
+        self.random = random.Random(seed)
+        self.cells = cells
+        self.capacity = capacity                # Ah
+        self.soc = 0.5 + 0.3 * self.random.random()
+        self.offsets = [self.random.gauss(0, 0.004) for _ in range(cells)]
+        self.resistances = [0.05 + 0.01 * self.random.random() for _ in range(RESISTANCE_COUNT)]
+        self.phase = self.random.random() * 2 * math.pi
+        self.start = time.time()
+        self.counter = 0
+        self.cycles = 12
+        self.switches = {'charge': 1, 'discharge': 1, 'balancer': 1}
+
+    def settingsRecord(self, length=300):
+        # raw values in the order of jkbms_ble.SETTINGS_VALUES (mV, mA, s, 0.1 °C, mAh, us)
+        values = (2800, 2900, 3650, 3550, 10, 3450, 3000, 3500, 3400, 2700,
+                  100000, 30, 60, 150000, 300, 60, 60, 2000,
+                  700, 600, 700, 600, -200, -100, 900, 700,
+                  self.cells, self.switches['charge'], self.switches['discharge'], self.switches['balancer'],
+                  int(self.capacity * 1000), 1500, 3300)
+        record = bytearray(SETTINGS_RECORD.pack(self.counter & 0xff, *(values + tuple(int(r * 1000) for r in self.resistances[:WIRE_RESISTANCE_COUNT]))))
+        return buildRecord(EXTENDED_RECORD, record[6:], self.counter, length)
+
+    def cellDataRecord(self, length=300):
+        now = time.time()
+        self.counter += 1
+        current = 40.0 * math.sin(self.phase + (now - self.start) / 600.0) + self.random.gauss(0, 0.5)
+        self.soc = min(1.0, max(0.0, self.soc + current / self.capacity / 3600.0))
+        cellVolts = [3.2 + 0.2 * self.soc + current * 0.0005 + offset + self.random.gauss(0, 0.0008) for offset in self.offsets]
+        volts = [int(round(v * 1000)) for v in cellVolts] + [0] * (CELL_COUNT - self.cells)
+        packVoltage = sum(volts)
+        average = packVoltage // self.cells
+        delta = max(volts[:self.cells]) - min(volts[:self.cells])
+        uptime = int(now - self.start) + 86400
+        values = [CELL_DATA, self.counter & 0xff]
+        values += volts
+        values += [0, 0, average, delta, 0]
+        values += [int(round(r * 1000)) for r in self.resistances]
+        values += [0, 0]
+        values += [packVoltage, int(abs(packVoltage * current)), int(round(current * 1000))]
+        values += [250 + self.random.randrange(5), 248 + self.random.randrange(5), 270 + self.random.randrange(5)]
+        values += [0, 0]
+        values += [0, int(round(self.soc * 100))]
+        values += [int(self.soc * self.capacity * 1000), int(self.capacity * 1000), self.cycles, int(self.cycles * self.capacity * 1000)]
+        values += [0, 0]
+        values += [uptime & 0xff, (uptime >> 8) & 0xff, (uptime >> 16) & 0xff]
+        values += [0] * 12
+        values += [min(32767, max(0, int(current * 1000))), min(32767, max(0, int(-current * 1000)))]
+        values += [0] * 7
+        record = bytearray(length)
+        CELL_DATA_02.pack_into(record, 0, *values)
+        record[0:4] = SOR
+        record[-1] = crc8(record[:-1])
+        return bytes(record)
+
+
+# ---
+# transport that behaves like a JK-BMS connected via BLE
+# ---
+class SimulatedTransport:
+    '''
+    Drop-in replacement for jkbms_ble.BluepyTransport. Answers getInfo with an
+    info record and getCellInfo with a settings record followed by a stream
+    of cell data records, split into notifications of `mtu - 3` bytes.
+
+    rate:           cell data records per second after getCellInfo
+    recordLength:   300 or 320 byte records
+    drop:           probability that a notification is lost
+    junk:           probability that a stray notification is inserted
+    dropout:        probability per record that the connection breaks
+    connectFail:    probability that a connection attempt fails
+    realtime:       False delivers everything as fast as possible
+    '''
+    def __init__(self, mtu=23, rate=1.0, recordLength=300, drop=0.0, junk=0.0, dropout=0.0,
+                 connectFail=0.0, realtime=True, seed=None):
+        self.fragmentSize = max(mtu - 3, 1)
+        self.rate = rate
+        self.recordLength = recordLength
+        self.drop = drop
+        self.junk = junk
+        self.dropout = dropout
+        self.connectFail = connectFail
+        self.realtime = realtime
+        self.random = random.Random(seed)
+        self.pack = PackModel(seed=seed)
+        self.delegate = None
+        self.connected = False
+        self.streaming = False
+        self.nextRecord = 0
+        self.queue = []             # [time due, fragment]
+        self.notifications = 0
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+
+    def connect(self, mac, addrType='public'):
+        if self.random.random() < self.connectFail:
+            raise Exception('simulated connection failure to {}'.format(mac))
+        self.connected = True
+        self.streaming = False
+        self.queue = []
+
+    def discoverHandles(self):
+        return GattHandles(notify=0x10, write=0x10, cccd=0x11)
+
+    def getServices(self):
+        return []
+
+    def write(self, handle, data):
+        if not self.connected:
+            raise Exception('simulated device not connected')
+        now = time.time()
+        if data == getInfo:
+            self.send(buildInfoRecord(uptime=int(now - self.pack.start) + 86400, length=self.recordLength), now + 0.05)
+        elif data == getCellInfo:
+            self.send(self.pack.settingsRecord(self.recordLength), now + 0.05)
+            self.streaming = True
+            self.nextRecord = now + 0.1
+        else:
+            for name, frames in SWITCH_COMMANDS.items():
+                if data in frames:
+                    self.pack.switches[name] = frames.index(data)
+
+    def send(self, record, due):
+        # split a record into notifications, with the configured errors
+        if self.random.random() < self.dropout:
+            self.queue.append([due, None])      # connection breaks here
+            return
+        for i in range(0, len(record), self.fragmentSize):
+            if self.random.random() < self.junk:
+                self.queue.append([due, bytes(self.random.randrange(256) for _ in range(self.fragmentSize))])
+            if self.random.random() >= self.drop:
+                self.queue.append([due, record[i:i + self.fragmentSize]])
+
+    def waitForNotifications(self, timeout):
+        if not self.connected:
+            raise Exception('simulated device not connected')
+        now = time.time()
+        if self.streaming and not self.queue and (self.nextRecord <= now + timeout or not self.realtime):
+            self.send(self.pack.cellDataRecord(self.recordLength), self.nextRecord)
+            self.nextRecord = max(self.nextRecord + 1.0 / self.rate, now)
+        if not self.queue or (self.realtime and self.queue[0][0] > now + timeout):
+            # nothing to deliver, an idle device stays idle even if not in real time
+            time.sleep(timeout)
+            return False
+        due, fragment = self.queue.pop(0)
+        if self.realtime and due > now:
+            time.sleep(due - now)
+        if fragment is None:
+            self.connected = False
+            raise Exception('simulated disconnect')
+        self.notifications += 1
+        self.delegate.handleNotification(0x10, fragment)
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        self.streaming = False
+
+
+# ---
+# in-process replacement for the paho mqtt client
+# ---
+PublishResult = namedtuple('PublishResult', ['rc'])
+
+class MQTTSink:
+    '''
+    Counts (and optionally keeps) everything published, instead of sending it
+    to a broker. Assign it to jkbms_ble.mqttClient, or wrap it in a
+    SpoolingClient like a paho client (clear `connected` for an outage).
+    '''
+    def __init__(self, keep=False, delay=0.0):
+        self.lock = threading.Lock()
+        self.keep = keep
+        self.delay = delay          # time every publish takes, a slow broker
+        self.connected = True
+        self.on_connect = None
+        self.on_disconnect = None
+        self.messages = 0
+        self.bytes = 0
+        self.last = {}              # topic -> last payload
+        self.retained = {}          # topic -> retained payload, as a broker keeps it
+        self.published = []         # (topic, payload) if keep
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.connected:
+            return PublishResult(MQTT_ERR_NO_CONN)
+        if isinstance(payload, (bytes, bytearray)):
+            size = len(payload)
+        elif payload is None:
+            size = 0
+        else:
+            size = len(str(payload))
+        with self.lock:
+            self.messages += 1
+            self.bytes += len(topic) + size
+            self.last[topic] = payload
+            if retain:
+                self.retained[topic] = payload
+            if self.keep:
+                self.published.append((topic, payload))
+        if self.delay:
+            time.sleep(self.delay)
+        return PublishResult(0)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def reconnect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+# ---
+# broker outage through the SpoolingClient: the drain must not replace a newer retained value
+# ---
+def spoolCheck():
+    sink = MQTTSink(keep=True)
+    client = SpoolingClient(sink)
+    client.handleDisconnect(sink, None, 1)
+    sink.connected = False
+    client.publish('SIM_0/Energy/Total', 'old', retain=True)       # spooled, replaced live below
+    client.publish('SIM_0/Settings/CellCount', '16', retain=True)  # spooled, not published live
+    client.publish('SIM_0/CellData/PackSOC', '55')
+    client.publish('SIM_0/CellData', b'\x01\x10\x19ABC')           # binary, but also valid utf-8
+    time.sleep(0.01)
+    sink.connected = True
+    client.handleConnect(sink, None, {}, 0)
+    client.publish('SIM_0/Energy/Total', 'new', retain=True)       # live, before the drain
+    client.sendBatch(client.nextBatch())
+    history = json.loads(sink.last['SIM_0/Spool'])
+    errors = []
+    if sink.retained.get('SIM_0/Energy/Total') != 'new':
+        errors.append('stale spooled value replaced the live retained value: {!r}'.format(sink.retained.get('SIM_0/Energy/Total')))
+    if sink.retained.get('SIM_0/Settings/CellCount') != b'16':
+        errors.append('spooled retained value not restored: {!r}'.format(sink.retained.get('SIM_0/Settings/CellCount')))
+    if [message[1:] for message in history] != [['SIM_0/Energy/Total', 'old'], ['SIM_0/CellData/PackSOC', '55'],
+                                                ['SIM_0/CellData', 'ARAZQUJD', 'base64']]:
+        errors.append('unexpected spool batch: {}'.format(history))
+    for error in errors:
+        print('spool check: ' + error)
+    print('spool check: {}'.format('failed' if errors else 'ok'))
+    return not errors
+
+
+# ---
+# binary payload round trip, including negative values (a faulted cell reads 0xffff = -0.001 V)
+# ---
+def payloadCheck(records=2000):
+    rnd = random.Random(1)
+    pack = PackModel(seed=1)
+    errors = []
+    for i in range(records):
+        record = bytearray(pack.cellDataRecord() if i % 2 else rnd.getrandbits(8 * 300).to_bytes(300, 'little'))
+        record[0:4] = SOR
+        record[4] = CELL_DATA
+        if i % 4 == 1:
+            record[6:8] = b'\xff\xff'                  # cell 1
+            record[58:62] = (-5).to_bytes(2, 'little', signed=True) * 2       # avg. and delta cell voltage
+            record[64:66] = (-1).to_bytes(2, 'little', signed=True)           # wire resistance 1
+        record[-1] = crc8(record[:-1])
+        cellData = jkbms_ble.decodeCellDataRecord02(record)
+        try:
+            decoded = decodeCellData(encodeCellData(cellData))
+        except Exception as e:
+            errors.append('record {}: {}'.format(i, e))
+            continue
+        expected = {'VoltageCell': list(cellData.volts), 'ResistanceCell': list(cellData.resistances)}
+        for name, field, _, _ in PACK_VALUES:
+            expected[name] = getattr(cellData, field)
+        if decoded != expected:
+            errors.append('record {}: {} != {}'.format(i, decoded, expected))
+    for error in errors[:5]:
+        print('payload check: ' + error)
+    print('payload check: {}'.format('{} of {} records failed'.format(len(errors), records) if errors else 'ok'))
+    return not errors
+
+
+# ---
+# parse arguments
+# ---
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Run the jkbms_ble pipeline against simulated JK-BMS')
+    parser.add_argument('--packs', default=2, type=int, help='number of simulated packs')
+    parser.add_argument('--seconds', default=30.0, type=float, help='duration of the run')
+    parser.add_argument('--mtu', default=23, type=int, help='BLE MTU, notifications carry MTU-3 bytes')
+    parser.add_argument('--rate', default=1.0, type=float, help='cell data records per second and pack')
+    parser.add_argument('--length', default=300, type=int, choices=[300, 320], help='record length')
+    parser.add_argument('--drop', default=0.0, type=float, help='probability of a lost notification')
+    parser.add_argument('--junk', default=0.0, type=float, help='probability of a stray notification')
+    parser.add_argument('--dropout', default=0.0, type=float, help='probability per record of a broken connection')
+    parser.add_argument('--connect-fail', default=0.0, type=float, help='probability that a connection attempt fails')
+    parser.add_argument('--queue', default=64, type=int, help='publisher queue size (0: publish in the BLE callback)')
+    parser.add_argument('--queue-policy', default=COALESCE, choices=POLICIES, help='overflow policy of the publisher queue')
+    parser.add_argument('--publish-delay', default=0.0, type=float, help='seconds every publish to the mqtt sink takes (slow broker)')
+    parser.add_argument('--retry-quick', default=2, type=int, help='reconnect attempts without delay')
+    parser.add_argument('--retry-base', default=2.0, type=float, help='first backoff delay in seconds')
+    parser.add_argument('--retry-cap', default=120.0, type=float, help='maximum backoff delay in seconds')
+    parser.add_argument('--fast', action="store_true", help='deliver records as fast as possible instead of in real time')
+    parser.add_argument('--format', default='mqtt', choices=['mqtt', 'json', 'binary'], help='output format')
+    parser.add_argument('--stream', action="store_true", help='use streaming mode')
+    parser.add_argument('--interval', default=0.0, type=float,
+                        help='poll the packs through the jkbms_ble scheduler every INTERVAL seconds (0: one poll loop thread per pack)')
+    parser.add_argument('--workers', default=0, type=int, help='scheduler threads (0: one per pack)')
+    parser.add_argument('--refresh', default=300, type=int, help='full refresh interval of the publish cache')
+    parser.add_argument('--aggregate', default=0, type=float, help='aggregation window in seconds (0: off)')
+    parser.add_argument('--raw-interval', type=float, help='publish the raw values at most every RAW_INTERVAL seconds')
+    parser.add_argument('--metrics-port', type=int, help='serve the jkbms_ble metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--history', default=0, type=int, help='cell data history in kB per pack (0: off)')
+    parser.add_argument('--history-retention', default=4.0, type=float, help='hours of history returned by queries')
+    parser.add_argument('--history-dir', type=str, help='directory for memory mapped history files')
+    parser.add_argument('--energy', default=0, type=float, help='energy totals per pack, published every ENERGY seconds (0: off)')
+    parser.add_argument('--energy-dir', type=str, help='directory for the energy state files')
+    parser.add_argument('--energy-gap', default=120.0, type=float, help='longer intervals between records are not integrated')
+    parser.add_argument('--spool-check', action="store_true", help='check the mqtt spool against a scripted broker outage and exit')
+    parser.add_argument('--payload-check', action="store_true", help='check the binary payload round trip, incl. negative values, and exit')
+    parser.add_argument('--record', type=str, help='append every notification to this capture file')
+    parser.add_argument('--replay', type=str, help='replay this capture file into the mqtt sink instead of simulating packs')
+    parser.add_argument('--replay-speed', default=1.0, type=float, help='replay speed, 1: real time')
+    parser.add_argument('--replay-fast', action="store_true", help='replay as fast as possible')
+    parser.add_argument('--profile', type=str, help='run one pack in the main thread under cProfile, write stats to PROFILE')
+    parser.add_argument('--debug', action="store_true", help='enable DEBUG logging')
+    parser.add_argument('--info', action="store_true", help='enable INFO logging')
+    return parser.parse_args(argv)
+
+
+# ---
+# create the simulated packs
+# ---
+def createPacks(args):
+    packs = []
+    for i in range(args.packs):
+        # every connection gets a new transport, draw its seed from a per pack sequence,
+        # otherwise a reconnect would replay the same errors over and over
+        def transport(seeds=random.Random(i)):
+            return SimulatedTransport(mtu=args.mtu, rate=args.rate, recordLength=args.length,
+                                      drop=args.drop, junk=args.junk, dropout=args.dropout, connectFail=args.connect_fail,
+                                      realtime=not args.fast, seed=seeds.random())
+        name = 'SIM-{}'.format(i)
+        history = jkbms_ble.createHistory(args, name) if args.history else None
+        energy = jkbms_ble.createEnergyCounter(args, name) if args.energy else None
+        packs.append(jkbms_ble.jkbms(name=name, model='simulated', mac='00:00:00:00:00:{:02X}'.format(i),
+                                     command='command', tag='SIM_{}'.format(i), format=args.format,
+                                     refreshInterval=args.refresh, stream=args.stream, transport=transport,
+                                     history=history, energy=energy, aggregate=args.aggregate, rawInterval=args.raw_interval,
+                                     interval=args.interval, priority=i,
+                                     reconnect=ReconnectPolicy(name, quick=args.retry_quick, base=args.retry_base,
+                                                               cap=args.retry_cap, seed=i),
+                                     queue=jkbms_ble.recordQueue))
+    return packs
+
+
+# ---
+# print the results of a run
+# ---
+def report(packs, sink, seconds, cpu):
+    records = 0
+    for bms in packs:
+        reassembler = bms.reassembler
+        records += bms.recordCount.get(CELL_DATA, 0)
+        print('{}: records {}, resyncs {}, partial {}, dropped bytes {}, published {}, suppressed {}'.format(
+            bms.name, bms.recordCount, reassembler.resyncs, reassembler.partialFrames,
+            reassembler.droppedBytes, bms.publishCache.published, bms.publishCache.suppressed))
+        if bms.energy is not None:
+            total = bms.energy.total
+            print('    charged {:.2f} Wh / {:.3f} Ah, discharged {:.2f} Wh / {:.3f} Ah, {} gaps, {} rejected'.format(
+                total.chargedWh, total.chargedAh, total.dischargedWh, total.dischargedAh, int(total.gaps), int(total.rejected)))
+        if bms.reconnect.incidents:
+            print('    {} reconnect incidents, {:.1f}s until recovery in total'.format(
+                bms.reconnect.incidents, bms.reconnect.recoveryTime))
+    print('{} packs, {:.1f}s: {} cell data records ({:.2f}/s), {} mqtt messages ({:.1f}/s), {} bytes'.format(
+        len(packs), seconds, records, records / seconds, sink.messages, sink.messages / seconds, sink.bytes))
+    print('cpu {:.2f}s = {:.2f}% of one core, {:.0f} us per cell data record'.format(
+        cpu, 100.0 * cpu / seconds, 1e6 * cpu / records if records else 0))
+    queue = jkbms_ble.recordQueue
+    if queue is not None:
+        print('publisher queue: {} records, max depth {}, dropped {}, coalesced {}, {} waiting'.format(
+            queue.enqueued, queue.maxDepth, queue.dropped, queue.coalesced, queue.depth()))
+
+
+# ---
+# main part of the script
+# ---
+if __name__ == "__main__":
+
+    args = parseArguments()
+    if args.spool_check:
+        sys.exit(0 if spoolCheck() else 1)
+    if args.payload_check:
+        sys.exit(0 if payloadCheck() else 1)
+    logging.basicConfig(format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    if args.info:
+        jkbms_ble.log.setLevel(logging.INFO)
+    if args.debug:
+        jkbms_ble.log.setLevel(logging.DEBUG)
+
+    sink = MQTTSink(delay=args.publish_delay)
+    jkbms_ble.mqttClient = sink
+    if args.queue:
+        jkbms_ble.recordQueue = RecordQueue(args.queue, args.queue_policy)
+        jkbms_ble.recordQueue.start(jkbms_ble.publishRecord)
+    packs = createPacks(args)
+    if args.metrics_port:
+        jkbms_ble.metrics.serve(port=args.metrics_port)
+        jkbms_ble.metrics.addRoute('/history', jkbms_ble.historyPage)
+        for bms in packs:
+            jkbms_ble.metrics.addCollector(bms.collectMetrics)
+        if jkbms_ble.recordQueue is not None:
+            jkbms_ble.metrics.addCollector(jkbms_ble.recordQueue.collectMetrics)
+
+    if args.record:
+        jkbms_ble.recorder = jkbms_ble.CaptureWriter(args.record)
+
+    if args.replay:
+        start = time.time()
+        cpu = time.process_time()
+        packs = list(jkbms_ble.replayCapture(args).values())
+        cpu = time.process_time() - cpu
+    elif args.profile:
+        import cProfile
+        import pstats
+        bms = packs[0]
+        packs = [bms]
+        profiler = cProfile.Profile()
+        start = time.time()
+        cpu = time.process_time()
+        profiler.enable()
+        bms.connect()
+        while time.time() - start < args.seconds:
+            if not bms.getBLEData():
+                bms.connect()
+        profiler.disable()
+        cpu = time.process_time() - cpu
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        start = time.time()
+        cpu = time.process_time()
+        if args.interval and not args.stream:
+            scheduler = Scheduler(jkbms_ble.pollDevice, workers=args.workers)
+            for bms in packs:
+                scheduler.add(bms.name, bms, bms.priority)
+            scheduler.start(len(packs))
+        else:
+            for bms in packs:
+                threading.Thread(target=jkbms_ble.pollBMS, args=(bms,), name=bms.name, daemon=True).start()
+        time.sleep(args.seconds)
+        cpu = time.process_time() - cpu
+
+    for bms in packs:
+        bms.flushAggregate()
+    for counter in jkbms_ble.energyCounters.values():
+        counter.save()
+    if jkbms_ble.recorder is not None:
+        jkbms_ble.recorder.close()
+        print('{} notifications written to {}'.format(jkbms_ble.recorder.fragments, args.record))
+    report(packs, sink, time.time() - start, cpu)
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+"""
+Store and forward spool for the mqtt messages of jkbms_ble.py.
+
+SpoolingClient wraps a paho client. While the broker is not connected the
+messages are kept in a bounded memory ring and then in a spool file; once
+it is back they are sent oldest first as json batches on <tag>/Spool,
+retained messages to their own topic.
+
+Spool file record: header '<dHIB' (time, topic length, payload length,
+flags RETAIN | BINARY), topic, payload.
+-------------------------------------------------------------------------
+"""
+
+import json
+import time
+import base64
+import logging
+import threading
+import collections
+from struct import Struct
+
+
+RECORD = Struct('<dHIB')
+RETAIN = 0x01
+BINARY = 0x02           # published as bytes, not text
+
+log = logging.getLogger('jkbms_ble')
+
+
+# ---
+# paho sends numbers as their string representation
+# ---
+def payloadBytes(payload):
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return str(payload).encode('utf-8')
+
+
+class SpoolingClient:
+    '''
+    client:     paho client, connected with connect_async and loop_start
+    filename:   spool file, None keeps the memory ring only (overflow is dropped)
+    memory:     number of messages kept in memory
+    fileSize:   maximum size of the spool file in bytes, further messages are dropped
+    rate:       batches per second while draining
+    batchSize:  messages per batch
+    '''
+    def __init__(self, client, filename=None, memory=10000, fileSize=50 * 1024 * 1024, rate=5.0, batchSize=100):
+        self.client = client
+        self.filename = filename
+        self.memory = collections.deque()
+        self.memoryLimit = memory
+        self.fileSize = fileSize
+        self.rate = rate
+        self.batchSize = batchSize
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.connected = False
+        self.running = False
+        # statistics
+        self.spooled = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.drained = 0
+        self.outages = 0
+        self.superseded = 0
+        self.liveRetained = {}      # topic -> time the last retained message was published live
+
+        self.file = None
+        self.readOffset = 0
+        if filename:
+            # messages left from a previous run are drained first
+            self.file = open(filename, 'a+b')
+            if self.file.tell():
+                log.info('Spool file {} has {} bytes from a previous run'.format(filename, self.file.tell()))
+
+        self.onConnect = client.on_connect
+        self.onDisconnect = client.on_disconnect
+        client.on_connect = self.handleConnect
+        client.on_disconnect = self.handleDisconnect
+
+    def handleConnect(self, client, userdata, flags, rc):
+        self.connected = rc == 0
+        if self.connected:
+            self.wakeup.set()
+        if self.onConnect:
+            self.onConnect(client, userdata, flags, rc)
+
+    def handleDisconnect(self, client, userdata, rc):
+        if self.connected:
+            self.outages += 1
+            log.info('MQTT disconnected ({}), spooling messages'.format(rc))
+        self.connected = False
+        if self.onDisconnect:
+            self.onDisconnect(client, userdata, rc)
+
+    # ---
+    # same interface as the paho client
+    # ---
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.connected:
+            info = self.client.publish(topic, payload, qos, retain)
+            if info.rc == 0:
+                if retain:
+                    self.liveRetained[topic] = time.time()
+                return info
+            # connection lost, the disconnect callback follows
+            self.connected = False
+            self.outages += 1
+            log.info('MQTT publish failed ({}), spooling messages'.format(info.rc))
+        self.spool(time.time(), topic, payloadBytes(payload), retain, isinstance(payload, (bytes, bytearray)))
+        return None
+
+    def loop_start(self):
+        self.running = True
+        threading.Thread(target=self.drain, name='mqtt-spool', daemon=True).start()
+        return self.client.loop_start()
+
+    def loop_stop(self):
+        self.running = False
+        self.wakeup.set()
+        return self.client.loop_stop()
+
+    def disconnect(self):
+        result = self.client.disconnect()
+        self.close()
+        return result
+
+    # ---
+    # spool
+    # ---
+    def spool(self, timestamp, topic, payload, retain, binary=False):
+        with self.lock:
+            self.spooled += 1
+            self.memory.append((timestamp, topic, payload, retain, binary))
+            if len(self.memory) > self.memoryLimit:
+                self.spill(self.memory.popleft())
+
+    def spill(self, message):
+        # append the oldest message of the memory ring to the spool file (lock held)
+        if self.file is None or self.file.tell() >= self.fileSize:
+            self.dropped += 1
+            return
+        timestamp, topic, payload, retain, binary = message
+        topic = topic.encode('utf-8')
+        flags = (RETAIN if retain else 0) | (BINARY if binary else 0)
+        self.file.write(RECORD.pack(timestamp, len(topic), len(payload), flags) + topic + payload)
+        self.spilled += 1
+
+    def pending(self):
+        with self.lock:
+            fileBytes = self.file.tell() - self.readOffset if self.file else 0
+            return len(self.memory), fileBytes
+
+    def nextBatch(self):
+        # oldest messages first: spool file, then memory (lock held)
+        batch = []
+        if self.file and self.file.tell() > self.readOffset:
+            end = self.file.tell()
+            self.file.flush()
+            with open(self.filename, 'rb') as f:
+                f.seek(self.readOffset)
+                while len(batch) < self.batchSize and f.tell() < end:
+                    header = f.read(RECORD.size)
+                    if len(header) < RECORD.size:
+                        break
+                    timestamp, topicLength, payloadLength, flags = RECORD.unpack(header)
+                    topic = f.read(topicLength).decode('utf-8', 'replace')
+                    batch.append((timestamp, topic, f.read(payloadLength), bool(flags & RETAIN), bool(flags & BINARY)))
+                self.readOffset = f.tell() if f.tell() < end else end
+            if self.readOffset >= end:
+                # everything read, start the file again
+                self.file.seek(0)
+                self.file.truncate()
+                self.readOffset = 0
+        while len(batch) < self.batchSize and self.memory:
+            batch.append(self.memory.popleft())
+        return batch
+
+    def drain(self):
+        # background thread: send the spooled messages while the broker is connected
+        while self.running:
+            self.wakeup.wait(1.0)
+            self.wakeup.clear()
+            while self.running and self.connected:
+                with self.lock:
+                    batch = self.nextBatch()
+                if not batch:
+                    break
+                self.sendBatch(batch)
+                time.sleep(1.0 / self.rate)
+
+    def sendBatch(self, batch):
+        batches = collections.OrderedDict()     # tag -> [[time, topic, payload]]
+        retained = collections.OrderedDict()    # topic -> payload
+        for timestamp, topic, payload, retain, binary in batch:
+            if retain and timestamp >= self.liveRetained.get(topic, 0):
+                retained[topic] = payload
+            else:
+                if retain:
+                    self.superseded += 1    # a newer value is retained already, history only
+                tag = topic.split('/', 1)[0]
+                messages = batches.setdefault(tag, [])
+                if binary:
+                    messages.append([timestamp, topic, base64.b64encode(payload).decode('ascii'), 'base64'])
+                else:
+                    messages.append([timestamp, topic, payload.decode('utf-8', 'replace')])
+        sent = True
+        for tag, messages in batches.items():
+            sent &= self.client.publish(tag + '/Spool', json.dumps(messages, separators=(',', ':'))).rc == 0
+        for topic, payload in retained.items():
+            sent &= self.client.publish(topic, payload, retain=True).rc == 0
+        if not sent:
+            # broker lost while draining, the batch goes back to the front of the spool
+            self.connected = False
+            with self.lock:
+                self.memory.extendleft(reversed(batch))
+            return
+        self.drained += len(batch)
+        log.debug('Sent {} spooled messages'.format(len(batch)))
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                # keep what was not sent, everything still in memory is written as well
+                while self.memory:
+                    self.spill(self.memory.popleft())
+                if self.readOffset:
+                    # drop the part that was already sent
+                    self.file.flush()
+                    with open(self.filename, 'rb') as f:
+                        f.seek(self.readOffset)
+                        rest = f.read()
+                    self.file.seek(0)
+                    self.file.truncate()
+                    self.file.write(rest)
+                    self.readOffset = 0
+                self.file.close()
+                self.file = None
+
+    def collectMetrics(self):
+        memory, fileBytes = self.pending()
+        return [
+            ('jkbms_spool_memory_messages', 'gauge', 'Messages waiting in the memory ring of the mqtt spool', {}, memory),
+            ('jkbms_spool_file_bytes', 'gauge', 'Unsent bytes in the mqtt spool file', {}, fileBytes),
+            ('jkbms_spool_messages_total', 'counter', 'Messages spooled while the broker was not connected', {}, self.spooled),
+            ('jkbms_spool_dropped_total', 'counter', 'Messages dropped because the spool was full', {}, self.dropped),
+            ('jkbms_spool_drained_total', 'counter', 'Spooled messages sent after the broker came back', {}, self.drained),
+            ('jkbms_spool_superseded_total', 'counter', 'Spooled retained messages sent as history only, a newer value was published live', {}, self.superseded),
+            ('jkbms_mqtt_outages_total', 'counter', 'Lost broker connections', {}, self.outages),
+            ]